@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import sys, json, time, shutil, platform, tempfile, itertools, argparse
+
+import numpy as np
+
+sys.path.append('caltech-dataset')
+from caltech import CaltechDataset, IoU, IoU_matrix, crop_image
+import synthetic
+
+# Benchmarks of the hot paths of the dataset, post-processing & training, on fixed synthetic inputs
+# (or on an existing dataset, such as a large one generated by synthetic.py).
+# Each benchmark is called once to warm up, then repeatedly until it reaches both its minimum number of calls
+# & MIN_TIME, and reports its calls per second & percentiles of the latency of a call.
+# Results are saved as JSON, and compared with a baseline saved the same way: a benchmark is flagged
+# as a regression when its median latency is more than REGRESSION_TOLERANCE above the one of the baseline.
+
+MIN_CALLS = 20
+MIN_TIME = 2.0 # Seconds spent calling each benchmark, at least
+PERCENTILES = [50, 90, 99]
+REGRESSION_TOLERANCE = 0.25
+RANDOM_SEED = 4242 # Used for all synthetic inputs
+
+# Synthetic dataset generated when no dataset is given (see synthetic.py): sets 0 & 6, for training & testing
+SYNTHETIC_SETS = [0, 6]
+SYNTHETIC_SEQUENCES = 2 # Per set
+SYNTHETIC_FRAMES = 60 # Per sequence (the testing set keeps one frame every FRAME_MODULO)
+
+def synthetic_outputs(caltech, random_state, positive_ratio = 0.01):
+    # Outputs of the network for a frame, as fetched from the test steps: guesses, probabilities & regressions of all anchors
+    num_anchors = np.prod(caltech.anchor_grid.shape)
+    clas_prob = np.zeros((num_anchors, 2), dtype = np.float32)
+    clas_prob[:, 1] = random_state.rand(num_anchors) * (random_state.rand(num_anchors) < positive_ratio)
+    clas_prob[:, 0] = 1.0 - clas_prob[:, 1]
+    clas_guess = np.argmax(clas_prob, axis = 1)
+    reg = (0.1 * random_state.randn(num_anchors, 4)).astype(np.float32)
+
+    return clas_guess, clas_prob, reg
+
+# Benchmarks, each setting up its inputs & returning the function called repeatedly
+
+class NullOutput: # Replaces sys.stdout, so that printing is not part of the time measured
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+def benchmark_discover(caltech, random_state):
+    # Training & testing frames of a new dataset, from the manifest (without printing the sizes of the splits)
+    def discover():
+        stdout = sys.stdout
+        sys.stdout = NullOutput()
+        try:
+            dataset = CaltechDataset(caltech.dataset_location)
+            return dataset.training, dataset.testing
+        finally:
+            sys.stdout = stdout
+
+    return discover
+
+def benchmark_IoU(caltech, random_state):
+    boxes = itertools.cycle([(tuple(a), tuple(b)) for a, b in zip(caltech.anchor_grid.boxes[:1000], 100.0 * random_state.rand(1000, 4) + 50.0)])
+    return lambda: IoU(*next(boxes))
+
+def benchmark_IoU_matrix(caltech, random_state):
+    persons = 100.0 * random_state.rand(10, 4) + 50.0
+    return lambda: IoU_matrix(caltech.anchor_grid.boxes, persons)
+
+def benchmark_prepare_frame(caltech, random_state):
+    minibatches = itertools.cycle(caltech.training)
+    return lambda: caltech.prepare_frame(*next(minibatches))
+
+def benchmark_crop_image(caltech, random_state):
+    image_data = caltech.load_image(*caltech.training[0])
+    transform = caltech.get_crop_transform(*caltech.training[0][:2])
+    return lambda: crop_image(image_data, transform)
+
+def benchmark_load_frame(caltech, random_state):
+    minibatches = itertools.cycle(caltech.training)
+    return lambda: caltech.load_frame(*next(minibatches))
+
+def benchmark_get_training_minibatch(caltech, random_state):
+    # Placeholders are only used as keys of the feed dict
+    return lambda: caltech.get_training_minibatch('input', ('clas_indices', 'clas_labels'), ('reg_indices', 'reg_targets'))
+
+def benchmark_parse_results(caltech, random_state):
+    outputs = synthetic_outputs(caltech, random_state)
+    return lambda: caltech.parse_results(*outputs)
+
+def benchmark_NMS(caltech, random_state):
+    clas_guess, guess_pos, guess_scores = caltech.parse_results(*synthetic_outputs(caltech, random_state))
+    return lambda: caltech.NMS(guess_pos, guess_scores)
+
+def benchmark_compute_matches(caltech, random_state):
+    clas_guess, guess_pos, guess_scores = caltech.parse_results(*synthetic_outputs(caltech, random_state))
+    final_pos, final_scores = caltech.NMS(guess_pos, guess_scores)
+    minibatches = itertools.cycle(caltech.testing)
+    return lambda: caltech.compute_matches(*(next(minibatches) + (final_pos, final_scores)))
+
+def benchmark_train_step(caltech, random_state):
+    # A full training step (VGG16D & RPN, forward & backward), from randomly initialized weights
+    import tensorflow as tf # Only needed by this benchmark
+    from region_proposal import build_inputs, trainer
+
+    input_placeholder, clas_placeholders, reg_placeholders, image_placeholder, cached_features = build_inputs(caltech)
+    global_step, learning_rate, train_step, train_summaries, test_steps, vgg = trainer(caltech, input_placeholder, clas_placeholders, reg_placeholders)
+
+    sess = tf.Session()
+    sess.run(tf.initialize_all_variables())
+    if CaltechDataset.FEATURE_CACHE:
+        from feature_cache import build_feature_cache
+        build_feature_cache(sess, caltech, image_placeholder, cached_features, caltech.training)
+    feed_dict = caltech.get_training_minibatch(input_placeholder, clas_placeholders, reg_placeholders)
+
+    return lambda: sess.run(train_step, feed_dict = feed_dict)
+
+BENCHMARKS = [ # (name, setup, minimum number of calls)
+    ('discover', benchmark_discover, 3),
+    ('IoU', benchmark_IoU, MIN_CALLS),
+    ('IoU_matrix', benchmark_IoU_matrix, MIN_CALLS),
+    ('prepare_frame', benchmark_prepare_frame, MIN_CALLS),
+    ('crop_image', benchmark_crop_image, MIN_CALLS),
+    ('load_frame', benchmark_load_frame, MIN_CALLS),
+    ('get_training_minibatch', benchmark_get_training_minibatch, MIN_CALLS),
+    ('parse_results', benchmark_parse_results, MIN_CALLS),
+    ('NMS', benchmark_NMS, MIN_CALLS),
+    ('compute_matches', benchmark_compute_matches, MIN_CALLS),
+    ('train_step', benchmark_train_step, 3)
+]
+
+def time_calls(function, min_calls, min_time): # Returns the latencies of the calls, in seconds
+    function() # Warm-up
+
+    latencies = []
+    start_time = time.time()
+    while len(latencies) < min_calls or time.time() - start_time < min_time:
+        call_start_time = time.time()
+        function()
+        latencies.append(time.time() - call_start_time)
+
+    return np.array(latencies)
+
+def summarize(latencies):
+    summary = {
+        'calls': int(latencies.shape[0]),
+        'ops_per_sec': float(latencies.shape[0]) / max(float(np.sum(latencies)), 1e-9),
+        'mean_ms': 1000.0 * float(np.mean(latencies))
+    }
+    for percentile in PERCENTILES:
+        summary['p{}_ms'.format(percentile)] = 1000.0 * float(np.percentile(latencies, percentile))
+
+    return summary
+
+def compare(results, baseline): # Returns (name, ratio of median latencies, regression or not) of benchmarks in both
+    comparison = []
+    for name in sorted(results):
+        if name in baseline:
+            ratio = results[name]['p50_ms'] / max(baseline[name]['p50_ms'], 1e-9)
+            comparison.append((name, ratio, ratio > 1.0 + REGRESSION_TOLERANCE))
+
+    return comparison
+
+def print_results(results):
+    print('{:<24} {:>8} {:>12} {:>10} {:>10} {:>10}'.format('benchmark', 'calls', 'ops/s', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)'))
+    for name, summary in results.items():
+        print('{:<24} {:>8} {:>12.1f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(name, summary['calls'], summary['ops_per_sec'], summary['p50_ms'], summary['p90_ms'], summary['p99_ms']))
+
+def run(names, dataset_location, min_time):
+    caltech = CaltechDataset(dataset_location)
+    caltech.prepare(1)
+
+    results = {}
+    for name, setup, min_calls in BENCHMARKS:
+        if name in names:
+            function = setup(caltech, np.random.RandomState(RANDOM_SEED))
+            results[name] = summarize(time_calls(function, min_calls, min_time))
+            print('{}: {:.1f} ops/s'.format(name, results[name]['ops_per_sec']))
+
+    return results
+
+def main():
+    names = [name for name, setup, min_calls in BENCHMARKS]
+
+    parser = argparse.ArgumentParser(description = 'Benchmarks the hot paths of the dataset, post-processing & training.')
+    parser.add_argument('--only', nargs = '+', choices = names, default = names, help = 'benchmarks to run (all by default)')
+    parser.add_argument('--skip', nargs = '+', choices = names, default = [], help = 'benchmarks not to run')
+    parser.add_argument('--output', default = 'benchmark.json', help = 'where results are saved as JSON')
+    parser.add_argument('--baseline', help = 'results saved before, compared with the new ones')
+    parser.add_argument('--dataset', help = 'existing dataset used instead of a small synthetic one (only the frames kept by TRAINING_SIZE & TESTING_SIZE are prepared)')
+    parser.add_argument('--min-time', type = float, default = MIN_TIME, help = 'seconds spent on each benchmark, at least')
+    args = parser.parse_args()
+
+    names = [name for name in args.only if name not in args.skip]
+    if args.dataset:
+        results = run(names, args.dataset, args.min_time)
+    else:
+        CaltechDataset.TRAINING_SIZE = -1 # All frames of the synthetic dataset
+        CaltechDataset.TESTING_SIZE = -1
+
+        dataset_location = tempfile.mkdtemp(prefix = 'caltech-benchmark-')
+        try:
+            synthetic.generate(dataset_location, SYNTHETIC_SETS, SYNTHETIC_SEQUENCES, SYNTHETIC_FRAMES, RANDOM_SEED)
+            results = run(names, dataset_location, args.min_time)
+        finally:
+            shutil.rmtree(dataset_location)
+
+    print_results(results)
+    with open(args.output, 'w') as file:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__, 'time': time.time(), 'benchmarks': results}, file, indent = 1, sort_keys = True)
+    print('Results saved to: {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['benchmarks']
+
+        regressions = 0
+        for name, ratio, regression in compare(results, baseline):
+            print('{:<24} {:>6.2f}x baseline{}'.format(name, ratio, ' <- REGRESSION' if regression else ''))
+            regressions += regression
+
+        if regressions:
+            print('{} regression(s) (median latency more than {:.0f}% above the baseline)'.format(regressions, 100.0 * REGRESSION_TOLERANCE))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
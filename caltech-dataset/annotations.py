@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import os, glob, json
+
+import numpy as np
+
+from shards import write_atomic
+
+# Annotations of a single frame, as arrays with one row per object
+class FrameObjects:
+    def __init__(self, pos, posv, occl, lbl):
+        self.num = pos.shape[0]
+        self.pos = pos # [# objects, 4], as (y, x, h, w)
+        self.posv = posv # [# objects, 4], as (y, x, h, w), NaN when the visible part is not annotated
+        self.occl = occl # [# objects], 1 if occluded
+        self.lbl = lbl # [# objects], label of each object ('person', 'people', ...)
+
+    def has_visible_pos(self, i):
+        return not np.isnan(self.posv[i, 0])
+
+NO_OBJECTS = FrameObjects(np.zeros((0, 4)), np.zeros((0, 4)), np.zeros(0, dtype = np.uint8), np.zeros(0, dtype = np.str_))
+
+# Annotations split by sequence, built from the monolithic annotations.json:
+# - setXX/VYYY.npz holds the objects of all frames of a sequence as arrays, and the offsets of each frame in them
+# - index.json lists the sequences, with the modification time & size of the annotations.json they were built from,
+#   and is written last
+# Looking up a frame only loads the sequence it belongs to. The store is built again when annotations.json changes.
+class AnnotationStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.sequences = {} # (set, seq) -> dict of arrays, loaded lazily
+
+    def is_built(self, json_path): # Built from the current annotations.json (or built at all, if it is gone)
+        if not os.path.isfile(self.directory + '/index.json'):
+            return False
+        if not os.path.isfile(json_path):
+            return True
+
+        try:
+            with open(self.directory + '/index.json') as index_file:
+                index = json.load(index_file)
+        except ValueError: # Corrupted, simply built again
+            return False
+
+        return isinstance(index, dict) and index.get('source') == json_source(json_path)
+
+    def build(self, json_path):
+        print('Building annotation store from {}...'.format(json_path))
+        source = json_source(json_path) # Before reading, so that a change while building is seen next time
+        with open(json_path) as json_file:
+            annotations = json.load(json_file)
+
+        sets = {}
+        for set_name in sorted(annotations):
+            if not os.path.isdir(self.directory + '/' + set_name):
+                os.makedirs(self.directory + '/' + set_name)
+
+            sets[set_name] = sorted(annotations[set_name])
+            for seq_name in sets[set_name]:
+                frames = annotations[set_name][seq_name]['frames']
+                arrays = sequence_arrays([(int(frame), frames[frame]) for frame in frames])
+                write_atomic(self.directory + '/{}/{}.npz'.format(set_name, seq_name), lambda file: np.savez(file, **arrays))
+
+        # Sequences no longer in annotations.json
+        for path in glob.glob(self.directory + '/set*/V*.npz'):
+            set_name, seq_name = path[len(self.directory) + 1:-len('.npz')].split('/')
+            if seq_name not in sets.get(set_name, []):
+                os.remove(path)
+
+        write_atomic(self.directory + '/index.json', lambda file: file.write(json.dumps({'source': source, 'sets': sets}).encode('utf-8')))
+        self.sequences = {} # Loaded again from the new files
+
+    def get_sequence(self, set_number, seq_number):
+        key = (set_number, seq_number)
+        if key not in self.sequences:
+            path = self.directory + '/set{:02d}/V{:03d}.npz'.format(set_number, seq_number)
+            if os.path.isfile(path):
+                with np.load(path) as arrays:
+                    self.sequences[key] = dict((name, arrays[name]) for name in arrays.files)
+            else:
+                self.sequences[key] = None # Simply no annotations for that sequence
+
+        return self.sequences[key]
+
+    def get_objects(self, set_number, seq_number, frame_number):
+        sequence = self.get_sequence(set_number, seq_number)
+        if sequence is None:
+            return NO_OBJECTS
+
+        i = np.searchsorted(sequence['frames'], frame_number)
+        if i == sequence['frames'].shape[0] or sequence['frames'][i] != frame_number:
+            return NO_OBJECTS # Simply no objects for that frame
+
+        start, end = sequence['offsets'][i], sequence['offsets'][i + 1]
+
+        return FrameObjects(sequence['pos'][start:end], sequence['posv'][start:end], sequence['occl'][start:end], sequence['labels'][sequence['lbl'][start:end]])
+
+def json_source(json_path): # Identifies a version of annotations.json
+    return {'mtime': os.path.getmtime(json_path), 'size': os.path.getsize(json_path)}
+
+def sequence_arrays(frames): # frames as a list of (frame number, list of objects as in annotations.json)
+    frames = sorted(frames)
+
+    labels = sorted(set(o['lbl'] for frame_number, objects in frames for o in objects))
+    label_ids = dict((label, i) for i, label in enumerate(labels))
+
+    num_objects = sum(len(objects) for frame_number, objects in frames)
+    pos = np.zeros((num_objects, 4), dtype = np.float64)
+    posv = np.full((num_objects, 4), np.nan, dtype = np.float64)
+    occl = np.zeros(num_objects, dtype = np.uint8)
+    lbl = np.zeros(num_objects, dtype = np.int32)
+
+    offsets = [0]
+    i = 0
+    for frame_number, objects in frames:
+        for o in objects:
+            pos[i] = (o['pos'][1], o['pos'][0], o['pos'][3], o['pos'][2]) # Convert to (y, x, h, w)
+            if type(o['posv']) != int: # Set to 0 when there is no visible part annotated
+                posv[i] = (o['posv'][1], o['posv'][0], o['posv'][3], o['posv'][2]) # Convert to (y, x, h, w)
+            occl[i] = o['occl']
+            lbl[i] = label_ids[o['lbl']]
+            i += 1
+        offsets.append(i)
+
+    return {
+        'frames': np.array([frame_number for frame_number, objects in frames], dtype = np.int64),
+        'offsets': np.array(offsets, dtype = np.int64),
+        'pos': pos,
+        'posv': posv,
+        'occl': occl,
+        'lbl': lbl,
+        'labels': np.array(labels, dtype = np.str_)
+    }
+
+if __name__ == '__main__':
+    store = AnnotationStore('dataset/annotations')
+    store.build('dataset/annotations.json')
@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 
-import os, glob, json, time, random
+import os, time, random, multiprocessing
 from math import ceil, floor, sqrt, exp
 
 import numpy as np
 from PIL import Image, ImageDraw
 
+from shards import ShardWriter, ShardStore, write_atomic
+from annotations import AnnotationStore
+from manifest import Manifest
+from results import ResultsSink, ResultsStore
+from seq import SeqFile
+
 def IoU(anchor_box, truth_box):
     (y1, x1, h1, w1) = anchor_box
     (y2, x2, h2, w2) = truth_box
@@ -22,6 +28,59 @@ def IoA(anchor_box, truth_box): # Intersection over Area (of first parameter)
 
     return intersect / (h1 * w1)
 
+def intersection_matrix(anchor_boxes, truth_boxes): # Same as in IoU & IoA, but for all pairs of (N, 4) & (M, 4) boxes at once
+    anchor_boxes = np.asarray(anchor_boxes, dtype = np.float64).reshape(-1, 4)
+    truth_boxes = np.asarray(truth_boxes, dtype = np.float64).reshape(-1, 4)
+
+    y1, x1, h1, w1 = [anchor_boxes[:, i, np.newaxis] for i in range(4)] # [N, 1]
+    y2, x2, h2, w2 = [truth_boxes[np.newaxis, :, i] for i in range(4)] # [1, M]
+
+    intersect_y = np.maximum(0.0, np.minimum(y1+h1-1, y2+h2-1) - np.maximum(y1, y2))
+    intersect_x = np.maximum(0.0, np.minimum(x1+w1-1, x2+w2-1) - np.maximum(x1, x2))
+
+    return intersect_y * intersect_x, h1 * w1, h2 * w2
+
+def IoU_matrix(anchor_boxes, truth_boxes): # [N, M] matrix of IoU(anchor_boxes[i], truth_boxes[j])
+    intersect, area1, area2 = intersection_matrix(anchor_boxes, truth_boxes)
+
+    return intersect / (area1 + area2 - intersect)
+
+def IoA_matrix(anchor_boxes, truth_boxes): # [N, M] matrix of IoA(anchor_boxes[i], truth_boxes[j])
+    intersect, area1, area2 = intersection_matrix(anchor_boxes, truth_boxes)
+
+    return intersect / area1
+
+def match_detections(guess_pos, persons, undesirables, threshold = 0.5):
+    # Greedy matching of guesses, sorted by decreasing score, to the ground truth:
+    # each guess is matched to the first person not matched yet with IoU > threshold,
+    # otherwise it is ignored if it mostly covers an undesirable (IoA > threshold)
+    # Returns which guesses are matched, which are ignored, & which persons are matched
+    overlaps = IoU_matrix(guess_pos, persons) > threshold # [# guesses, # persons]
+    guess_matched = np.zeros(overlaps.shape[0], dtype = bool)
+    person_matched = np.zeros(overlaps.shape[1], dtype = bool)
+
+    for row in np.flatnonzero(overlaps.any(axis = 1)):
+        candidates = overlaps[row] & ~person_matched
+        if candidates.any():
+            person_matched[np.argmax(candidates)] = True
+            guess_matched[row] = True
+
+    guess_ignored = ~guess_matched & (IoA_matrix(guess_pos, undesirables) > threshold).any(axis = 1)
+
+    return guess_matched, guess_ignored, person_matched
+
+PREPARED_FIELDS = ['input', 'negative', 'positive', 'reg'] # Files of a frame prepared as separate files
+
+def make_dirs(path): # Like os.makedirs, but fine with several processes creating the same folder
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def save_atomic(path, array): # Like np.save, but an interrupted write never leaves a partial file at path
+    write_atomic(path, lambda file: np.save(file, array))
+
 def transform_cropped_pos(pos, transform):
     return (int(round(float(pos[0] - transform[0, 0]) * transform[1, 0])),
             int(round(float(pos[1] - transform[0, 1]) * transform[1, 1])),
@@ -34,6 +93,91 @@ def untransform_cropped_pos(pos, transform):
             int(round(float(pos[2]) / transform[1, 0])),
             int(round(float(pos[3]) / transform[1, 1])))
 
+# Batched versions, over [?, 4] arrays of (y, x, h, w) boxes
+def transform_cropped_boxes(boxes, transform):
+    boxes = np.asarray(boxes, dtype = np.float64).reshape(-1, 4)
+    delta = np.tile(transform[0].astype(np.float64), 2) * [1, 1, 0, 0]
+    scale = np.tile(transform[1].astype(np.float64), 2)
+
+    return np.round((boxes - delta) * scale).astype(np.int64)
+
+def untransform_cropped_boxes(boxes, transform):
+    boxes = np.asarray(boxes, dtype = np.float64).reshape(-1, 4)
+    delta = np.tile(transform[0].astype(np.float64), 2) * [1, 1, 0, 0]
+    scale = np.tile(transform[1].astype(np.float64), 2)
+
+    return np.round(boxes / scale + delta).astype(np.int64)
+
+def decode_image(file, size = None):
+    # Decodes an image (path or file object) as a [height, width, RGB] uint8 array, straight from the decoder's buffer
+    # Given a (width, height) size, JPEG images are decoded at the smallest reduced scale (1/2, 1/4, 1/8) still as large, then resized
+    image = Image.open(file)
+    if size is not None:
+        image.draft('RGB', tuple(size))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if size is not None and image.size != tuple(size):
+        image = image.resize(tuple(size))
+
+    return np.asarray(image)
+
+def crop_image(image_data, transform): # Crops the borders of an image, & resizes it back to its original size
+    (dy, dx), (h, w) = transform[0].astype(int), transform[2].astype(int)
+    cropped_image = Image.fromarray(image_data[dy:dy + h, dx:dx + w])
+
+    return np.asarray(cropped_image.resize((image_data.shape[1], image_data.shape[0])))
+
+def non_maximum_suppression(boxes, scores, iou_threshold, top_n, pre_top_n = -1, frames = None, block_size = 256):
+    # Greedy NMS, returning indices of kept boxes by decreasing score (per frame, when frames are given)
+    boxes = np.asarray(boxes, dtype = np.float64).reshape(-1, 4)
+    scores = np.asarray(scores).reshape(-1)
+    if frames is None:
+        frames = np.zeros(scores.shape, dtype = np.int64)
+    else:
+        frames = np.unique(frames, return_inverse = True)[1].reshape(-1) # Renumber frames from 0
+
+    # Sort by frame, then by decreasing score, then by decreasing index (ties as in np.argsort(scores)[::-1] with a stable sort)
+    order = np.lexsort((-np.arange(scores.shape[0]), -scores, frames))
+
+    if pre_top_n != -1:
+        sorted_frames = frames[order]
+        rank = np.arange(order.shape[0]) - np.searchsorted(sorted_frames, sorted_frames) # Rank within its frame
+        order = order[rank < pre_top_n]
+
+    num_frames = frames.max() + 1 if frames.shape[0] > 0 else 0
+    kept_per_frame = np.zeros(num_frames, dtype = np.int64)
+    kept = np.zeros(min(order.shape[0], top_n * num_frames), dtype = np.int64)
+    num_kept = 0
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        for start in range(0, order.shape[0], block_size):
+            block = order[start:start + block_size]
+            block_frames = frames[block]
+
+            # Suppressed by guesses kept from previous blocks
+            suppressed = kept_per_frame[block_frames] >= top_n
+            if num_kept > 0:
+                overlaps = IoU_matrix(boxes[block], boxes[kept[:num_kept]]) > iou_threshold
+                overlaps &= block_frames[:, np.newaxis] == frames[kept[:num_kept]][np.newaxis, :]
+                suppressed |= overlaps.any(axis = 1)
+
+            # Then greedily within the block
+            overlaps = IoU_matrix(boxes[block], boxes[block]) > iou_threshold
+            overlaps &= block_frames[:, np.newaxis] == block_frames[np.newaxis, :]
+            for i in range(block.shape[0]):
+                if suppressed[i] or kept_per_frame[block_frames[i]] >= top_n:
+                    continue
+
+                kept[num_kept] = block[i]
+                num_kept += 1
+                kept_per_frame[block_frames[i]] += 1
+                suppressed |= overlaps[i]
+
+            if np.all(kept_per_frame >= top_n):
+                break
+
+    return kept[:num_kept]
+
 class Anchors:
     def __init__(self, heights, width_to_height_ratios):
         self.num = len(heights) * len(width_to_height_ratios)
@@ -46,7 +190,46 @@ class Anchors:
                 self.heights.append(float(h))
                 self.widths.append(w)
 
-class CaltechDataset:
+class AnchorGrid:
+    grids = {} # Grids already built, per configuration
+
+    @staticmethod
+    def get(anchors, input_size, output_size, cell_size):
+        key = (tuple(anchors.heights), tuple(anchors.widths), tuple(input_size), tuple(output_size), float(cell_size))
+        if key not in AnchorGrid.grids:
+            AnchorGrid.grids[key] = AnchorGrid(anchors, input_size, output_size, cell_size)
+
+        return AnchorGrid.grids[key]
+
+    def __init__(self, anchors, input_size, output_size, cell_size):
+        self.shape = (output_size[0], output_size[1], anchors.num) # [height, width, # anchors]
+
+        center_y = cell_size * (np.arange(output_size[0], dtype = np.float64) + 0.5)
+        center_x = cell_size * (np.arange(output_size[1], dtype = np.float64) + 0.5)
+
+        heights = np.array(anchors.heights, dtype = np.float64)
+        widths = np.array(anchors.widths, dtype = np.float64)
+
+        boxes = np.zeros(self.shape + (4,), dtype = np.float64) # [height, width, # anchors, 4]
+        boxes[:, :, :, 0] = center_y[:, np.newaxis, np.newaxis] - heights / 2.0 # top_y
+        boxes[:, :, :, 1] = center_x[np.newaxis, :, np.newaxis] - widths / 2.0 # top_x
+        boxes[:, :, :, 2] = heights
+        boxes[:, :, :, 3] = widths
+
+        # Exact positions as a big list, used for IoUs
+        self.boxes = boxes.reshape(-1, 4)
+
+        # Positions as used for regression (parametrize & unparametrize)
+        self.positions = boxes.astype(np.float32)
+
+        # Anchors crossing the boundaries of the image, removed from training
+        self.cross_boundaries = (self.boxes[:, 0] < 0) | (self.boxes[:, 0] + self.boxes[:, 2] >= input_size[0]) | (self.boxes[:, 1] < 0) | (self.boxes[:, 1] + self.boxes[:, 3] >= input_size[1])
+
+        # Shared between all users, so make sure nobody modifies them
+        for array in [self.boxes, self.positions, self.cross_boundaries]:
+            array.setflags(write = False)
+
+class CaltechDataset(object): # New-style class, for the split properties in Python 2
     ### Input & output sizes ###
     INPUT_SIZE = (480, 640)
     OUTPUT_SIZE = (30, 40)
@@ -69,22 +252,49 @@ class CaltechDataset:
     ### Parameters that control the learning ###
     MAX_EPOCHS = 15
     MINIBATCH_SIZE = 64 # Number of examples (positive, negative or neither) used per image as a minibatch
+    IMAGES_PER_STEP = 1 # Number of images in each minibatch
     CLAS_POSITIVE_WEIGHT = 1.0 # Weight of positive example in the classification loss
+    PREFETCH_DEPTH = 4 # Number of minibatches prepared in advance by a background thread (see prefetch.py)
+    PROFILE_INTERVAL = 100 # Number of steps between reports of the time spent in each stage of the loops (see profiler.py)
+    TRACE_STEPS = [] # Training steps whose timeline is saved as a Chrome trace, in log/timeline/
+    SUMMARY_INTERVALS = {'scalars': 10, 'histograms': 500} # Number of training steps between two summaries of each group (see summaries.py)
     # LOSS_LAMBDA = # Defined dynamically because it depends on the number of anchors
 
     ### Parameters controlling the final output ###
     NMS_IOU_THRESHOLD = 0.0
     NMS_TOP_N = 20 # Kept after NMS
+    NMS_PRE_TOP_N = -1 # Kept before NMS, by decreasing score (-1 to keep all)
+    NMS_BLOCK_SIZE = 256 # Number of guesses compared at once during NMS
 
     ### Parameters controlling cropping of images ###
     USE_CROPPING = True
     CROPPING_THRESHOLD = 20
+    CROPPING_SAMPLE_FRAMES = 16 # Number of frames of a sequence used to find its borders
+
+    ### Parameters controlling the preparation of frames ###
+    PREPARE_WORKERS = 1 # Number of processes used for cropping & preparing frames
+    PREPARE_CHUNK_SIZE = 16 # Number of frames sent at once to a worker
+    PREPARE_PROGRESS_INTERVAL = 100 # Number of frames between progress reports
+    USE_SEQ_FILES = False # If set to true, frames are read from the .seq videos in data/ (see seq.py), instead of images extracted from them
+    USE_SHARDS = False # If set to true, prepared frames are read from shards (see shards.py) when available
+    SHARD_SIZE = 1024 # Number of frames per shard
+    REG_DTYPE = np.float32 # Type used for saving regression targets (np.float16 halves their size)
+    FEATURE_CACHE = None # Cut point of VGG16D ('m4_5', or 'l13' to only train the RPN) whose cached activations are fed instead of images (see feature_cache.py)
 
     def __init__(self, dataset_location = 'caltech-dataset/dataset'):
         self.dataset_location = dataset_location
         self.annotations = None
+        self.manifest = None
+        self.crop_transforms = {} # (set, seq) -> crop transform
+        self.results_sink = None
+        self.results_store = None
+        self.seq_files = {} # (set, seq) -> SeqFile, opened lazily
+        self.shard_store = None
+        self.feature_store = None
+        self.input_buffers = {}
 
         self.anchors = Anchors([30, 60, 100, 200, 350], [0.41])
+        self.anchor_grid = AnchorGrid.get(self.anchors, CaltechDataset.INPUT_SIZE, CaltechDataset.OUTPUT_SIZE, CaltechDataset.OUTPUT_CELL_SIZE)
         CaltechDataset.LOSS_LAMBDA = 2 * float(CaltechDataset.OUTPUT_SIZE[0] * CaltechDataset.OUTPUT_SIZE[1] * self.anchors.num) / float(CaltechDataset.MINIBATCH_SIZE)
 
         self.epoch = 0
@@ -92,13 +302,50 @@ class CaltechDataset:
         self.validation_minibatch = 0
         self.testing_minibatch = 0
 
+        # Splits are only discovered when first used (see the properties below)
+        self.training_split = None
+        self.validation_split = None
+        self.testing_split = None
+
         # self.set_training([(0, 1, 975), (3, 8, 240), (3, 8, 262), (3, 8, 279), (3, 8, 280), (3, 8, 293), (3, 8, 294), (3, 8, 295), (3, 8, 299), (3, 8, 300), (3, 8, 306), (3, 8, 308), (3, 8, 309), (3, 8, 313), (3, 8, 314), (3, 8, 315), (3, 8, 316), (3, 8, 317), (3, 8, 318), (3, 8, 321), (3, 8, 322), (3, 8, 326), (3, 8, 327), (3, 8, 334), (3, 8, 335), (3, 8, 336), (3, 8, 342), (3, 8, 345), (3, 8, 347), (3, 8, 348), (3, 8, 349), (3, 8, 350), (3, 8, 351), (3, 8, 358), (3, 8, 359), (3, 8, 360), (3, 8, 361), (3, 8, 362), (3, 8, 363), (3, 8, 364), (3, 8, 365), (3, 8, 368), (3, 8, 369), (3, 8, 370), (3, 8, 371), (3, 8, 372), (3, 8, 373), (3, 8, 374), (3, 8, 380), (3, 8, 381), (3, 8, 382), (3, 8, 391), (3, 8, 392), (3, 8, 393), (3, 8, 396), (3, 8, 397), (3, 8, 398), (3, 8, 401), (3, 8, 404), (3, 8, 410), (3, 8, 420), (3, 8, 427), (3, 8, 429), (3, 8, 430), (3, 8, 431), (3, 8, 434), (3, 8, 437), (3, 8, 443), (3, 8, 444), (3, 8, 451), (3, 8, 455), (3, 8, 456), (3, 8, 457), (3, 8, 458), (3, 8, 459), (3, 8, 460), (3, 8, 462), (3, 8, 466), (3, 8, 467), (3, 8, 478), (3, 8, 479), (3, 8, 480), (3, 8, 492), (3, 8, 493), (3, 8, 514), (3, 8, 515)])
-        self.discover_training()
 
-        self.discover_testing()
+    @property
+    def training(self):
+        if self.training_split is None:
+            self.discover_training()
+        return self.training_split
+
+    @training.setter
+    def training(self, training):
+        self.training_split = training
+
+    @property
+    def validation(self):
+        if self.validation_split is None:
+            self.discover_training()
+        return self.validation_split
+
+    @validation.setter
+    def validation(self, validation):
+        self.validation_split = validation
+
+    @property
+    def testing(self):
+        if self.testing_split is None:
+            self.discover_testing()
+        return self.testing_split
+
+    @testing.setter
+    def testing(self, testing):
+        self.testing_split = testing
+
+    def get_manifest(self):
+        if self.manifest is None:
+            self.manifest = Manifest(self.dataset_location + ('/data' if CaltechDataset.USE_SEQ_FILES else '/images'))
+        return self.manifest
 
     def discover_seq(self, set_number, seq_number, skip_frames):
-        num_frames = len(glob.glob(self.dataset_location + '/images/set{:02d}/V{:03d}.seq/*.jpg'.format(set_number, seq_number)))
+        num_frames = self.get_manifest().num_frames(set_number, seq_number)
 
         if skip_frames:
             num_frames = int(floor(num_frames / CaltechDataset.FRAME_MODULO))
@@ -108,10 +355,8 @@ class CaltechDataset:
             return [(set_number, seq_number, i) for i in range(num_frames)]
 
     def discover_set(self, set_number, skip_frames = False):
-        num_sequences = len(glob.glob(self.dataset_location + '/images/set{:02d}/V*.seq'.format(set_number)))
-
         tuples = []
-        for seq_number in range(num_sequences):
+        for seq_number in self.get_manifest().get_sequence_numbers(set_number):
             tuples += self.discover_seq(set_number, seq_number, skip_frames)
 
         return tuples
@@ -143,7 +388,7 @@ class CaltechDataset:
     def set_training(self, training):
         # Select a portion of the training set for validation
         random.seed(CaltechDataset.RANDOM_SEED) # For reproducibility
-        indices = range(len(training))
+        indices = list(range(len(training)))
         random.shuffle(indices)
         num_training = len(training) - int(float(len(training)) * CaltechDataset.VALIDATION_RATIO)
 
@@ -158,99 +403,131 @@ class CaltechDataset:
         random.seed(CaltechDataset.RANDOM_SEED + self.epoch)
         random.shuffle(self.training)
 
-    def get_training_minibatch(self, input_placeholder, clas_placeholder, reg_placeholder):
-        input_data, clas_negative, clas_positive, reg_positive = self.load_frame(*self.training[self.training_minibatch])
-        self.training_minibatch = self.training_minibatch + 1
-        if self.training_minibatch == len(self.training):
-            self.training_minibatch = 0
-            self.epoch += 1
-            self.shuffle_training()
-
-        if clas_negative.shape[1] > CaltechDataset.MINIBATCH_SIZE / 2:
-            selected = np.random.choice(clas_negative.shape[1], CaltechDataset.MINIBATCH_SIZE / 2, replace = False)
-            clas_negative = clas_negative[:, selected]
-
-        if clas_positive.shape[1] > CaltechDataset.MINIBATCH_SIZE / 2:
-            selected = np.random.choice(clas_positive.shape[1], CaltechDataset.MINIBATCH_SIZE / 2, replace = False)
-            clas_positive = clas_positive[:, selected]
-            reg_positive = reg_positive[selected, :]
-
-        clas_data = np.zeros((1, CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 2)) # [?, height, width, # anchors, 2]
-        reg_data = np.zeros((1, CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 4)) # [?, height, width, # anchors, 4]
-
-        clas_data[(0,) + tuple(clas_negative) + (0,)] = 1.0
-        clas_data[(0,) + tuple(clas_positive) + (1,)] = 1.0
-        reg_data[(0,) + tuple(clas_positive)] = reg_positive
-
-        return {
-            input_placeholder: input_data,
-            clas_placeholder: clas_data,
-            reg_placeholder: reg_data
-        }
-
-    def get_validation_minibatch(self, input_placeholder, clas_placeholder, reg_placeholder):
-        input_data, clas_negative, clas_positive, reg_positive = self.load_frame(*self.validation[self.validation_minibatch])
-        self.validation_minibatch = self.validation_minibatch + 1
+    def get_training_minibatch(self, input_placeholder, clas_placeholders, reg_placeholders):
+        # Up to IMAGES_PER_STEP images, fewer at the end of an epoch so that each minibatch belongs to a single epoch
+        minibatches_used = []
+        epoch = self.epoch
+        while len(minibatches_used) < CaltechDataset.IMAGES_PER_STEP and self.epoch == epoch:
+            minibatches_used.append(self.training[self.training_minibatch])
+            self.training_minibatch = self.training_minibatch + 1
+            if self.training_minibatch == len(self.training):
+                self.training_minibatch = 0
+                self.epoch += 1
+                self.shuffle_training()
+
+        return self.build_minibatch('training', minibatches_used, input_placeholder, clas_placeholders, reg_placeholders)
+
+    def get_validation_minibatch(self, input_placeholder, clas_placeholders, reg_placeholders):
+        minibatches_used = self.validation[self.validation_minibatch:self.validation_minibatch + CaltechDataset.IMAGES_PER_STEP]
+        self.validation_minibatch = self.validation_minibatch + len(minibatches_used)
         if self.validation_minibatch == len(self.validation):
             self.validation_minibatch = 0
             last_frame = True
         else:
             last_frame = False
 
-        clas_data = np.zeros((1, CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 2)) # [?, height, width, # anchors, 2]
-        reg_data = np.zeros((1, CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 4)) # [?, height, width, # anchors, 4]
-
-        clas_data[(0,) + tuple(clas_negative) + (0,)] = 1.0
-        clas_data[(0,) + tuple(clas_positive) + (1,)] = 1.0
-        reg_data[(0,) + tuple(clas_positive)] = reg_positive
+        return self.build_minibatch('validation', minibatches_used, input_placeholder, clas_placeholders, reg_placeholders), last_frame
 
-        return {
-            input_placeholder: input_data,
-            clas_placeholder: clas_data,
-            reg_placeholder: reg_data
-        }, last_frame
-
-    def get_testing_minibatch(self, input_placeholder, clas_placeholder, reg_placeholder):
-        minibatch_used = self.testing[self.testing_minibatch]
-        input_data, clas_negative, clas_positive, reg_positive = self.load_frame(*minibatch_used)
-        self.testing_minibatch = self.testing_minibatch + 1
+    def get_testing_minibatch(self, input_placeholder, clas_placeholders, reg_placeholders):
+        minibatches_used = self.testing[self.testing_minibatch:self.testing_minibatch + CaltechDataset.IMAGES_PER_STEP]
+        self.testing_minibatch = self.testing_minibatch + len(minibatches_used)
         if self.testing_minibatch == len(self.testing):
             self.testing_minibatch = 0
             last_frame = True
         else:
             last_frame = False
 
-        clas_data = np.zeros((1, CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 2)) # [?, height, width, # anchors, 2]
-        reg_data = np.zeros((1, CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 4)) # [?, height, width, # anchors, 4]
+        return self.build_minibatch('testing', minibatches_used, input_placeholder, clas_placeholders, reg_placeholders), minibatches_used, last_frame
+
+    def build_minibatch(self, name, minibatches_used, input_placeholder, clas_placeholders, reg_placeholders):
+        # Labels are fed sparsely, as indices in the flattened [?, height, width, # anchors] minibatch:
+        # clas_placeholders are (indices, labels) of examples, with label 0 for negative & 1 for positive
+        # reg_placeholders are (indices, regression targets) of positive examples
+        num_images = len(minibatches_used)
+        num_anchors = np.prod(self.anchor_grid.shape)
+
+        input_data = None
+        clas_indices = []
+        clas_labels = []
+        reg_indices = []
+        reg_targets = []
+
+        for i, minibatch in enumerate(minibatches_used):
+            if CaltechDataset.FEATURE_CACHE is not None: # Activations of the frozen part of VGG16D instead of the image, which is not read
+                frame_input = self.get_feature_store().load(minibatch)['input']
+                clas_negative, clas_positive, reg_positive = self.load_labels(*minibatch)
+            else:
+                frame_input, clas_negative, clas_positive, reg_positive = self.load_frame(*minibatch)
+
+            if name == 'training': # Each image keeps its own sampling of MINIBATCH_SIZE examples
+                if clas_negative.shape[0] > CaltechDataset.MINIBATCH_SIZE // 2:
+                    selected = np.random.choice(clas_negative.shape[0], CaltechDataset.MINIBATCH_SIZE // 2, replace = False)
+                    clas_negative = clas_negative[selected]
+
+                if clas_positive.shape[0] > CaltechDataset.MINIBATCH_SIZE // 2:
+                    selected = np.random.choice(clas_positive.shape[0], CaltechDataset.MINIBATCH_SIZE // 2, replace = False)
+                    clas_positive = clas_positive[selected]
+                    reg_positive = reg_positive[selected, :]
+
+            if num_images == 1:
+                input_data = frame_input # No need to copy
+            else:
+                if input_data is None:
+                    input_data = self.get_input_buffer(name, (num_images,) + frame_input.shape[1:], frame_input.dtype) # [?, height, width, RGB]
+                input_data[i] = frame_input[0]
 
-        clas_data[(0,) + tuple(clas_negative) + (0,)] = 1.0
-        clas_data[(0,) + tuple(clas_positive) + (1,)] = 1.0
-        reg_data[(0,) + tuple(clas_positive)] = reg_positive
+            clas_indices += [clas_negative + i * num_anchors, clas_positive + i * num_anchors]
+            clas_labels += [np.zeros(clas_negative.shape[0], dtype = np.int32), np.ones(clas_positive.shape[0], dtype = np.int32)]
+            reg_indices.append(clas_positive + i * num_anchors)
+            reg_targets.append(reg_positive)
 
         return {
             input_placeholder: input_data,
-            clas_placeholder: clas_data,
-            reg_placeholder: reg_data
-        }, minibatch_used, last_frame
+            clas_placeholders[0]: np.concatenate(clas_indices).astype(np.int32),
+            clas_placeholders[1]: np.concatenate(clas_labels),
+            reg_placeholders[0]: np.concatenate(reg_indices).astype(np.int32),
+            reg_placeholders[1]: np.concatenate(reg_targets).astype(np.float32)
+        }
+
+    def get_input_buffer(self, name, shape, dtype):
+        # Buffers for stacking images are reused in turn, with enough of them for all minibatches waiting in a Prefetcher
+        key = (name, shape, np.dtype(dtype))
+        if key not in self.input_buffers:
+            self.input_buffers[key] = [np.zeros(shape, dtype = dtype) for i in range(CaltechDataset.PREFETCH_DEPTH + 2)]
+
+        buffers = self.input_buffers[key]
+        buffers.append(buffers.pop(0))
 
-    def get_anchor_at(self, anchor_id, y, x):
-        center_y = CaltechDataset.OUTPUT_CELL_SIZE * (float(y) + 0.5)
-        center_x = CaltechDataset.OUTPUT_CELL_SIZE * (float(x) + 0.5)
+        return buffers[-1]
 
-        height = self.anchors.heights[anchor_id]
-        width = self.anchors.widths[anchor_id]
+    # Generators over minibatches, to be used with a Prefetcher
 
-        top_y = center_y - height / 2.0
-        top_x = center_x - width / 2.0
+    def training_minibatches(self, input_placeholder, clas_placeholders, reg_placeholders):
+        # Yields the epoch reached after each minibatch, as seen when calling get_training_minibatch directly
+        while self.epoch < CaltechDataset.MAX_EPOCHS:
+            feed_dict = self.get_training_minibatch(input_placeholder, clas_placeholders, reg_placeholders)
+            yield feed_dict, self.epoch
 
-        return (top_y, top_x, height, width)
+    def validation_minibatches(self, input_placeholder, clas_placeholders, reg_placeholders):
+        last_frame = False
+        while not last_frame:
+            feed_dict, last_frame = self.get_validation_minibatch(input_placeholder, clas_placeholders, reg_placeholders)
+            yield feed_dict
+
+    def testing_minibatches(self, input_placeholder, clas_placeholders, reg_placeholders):
+        last_frame = False
+        while not last_frame:
+            feed_dict, minibatches_used, last_frame = self.get_testing_minibatch(input_placeholder, clas_placeholders, reg_placeholders)
+            yield feed_dict, minibatches_used
 
     def load_annotations(self):
         if self.annotations:
             return
 
-        with open(self.dataset_location + '/annotations.json') as json_file:
-            self.annotations = json.load(json_file)
+        # Annotations are indexed by sequence, and built again from annotations.json whenever it changes
+        self.annotations = AnnotationStore(self.dataset_location + '/annotations')
+        if not self.annotations.is_built(self.dataset_location + '/annotations.json'):
+            self.annotations.build(self.dataset_location + '/annotations.json')
 
     def parametrize(self, person_pos, anchor_pos):
         reg = np.zeros(anchor_pos.shape, dtype = np.float32)
@@ -301,180 +578,174 @@ class CaltechDataset:
         return guess_pos
 
     def parse_results(self, clas_guess, clas_prob, reg_guess):
-        clas_guess = clas_guess.reshape((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num))
-        clas_prob = clas_prob.reshape((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 2))
-        reg_guess = reg_guess.reshape((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 4))
-
-        anchor_pos = np.zeros(reg_guess.shape, dtype = np.float32)
-        for y in range(CaltechDataset.OUTPUT_SIZE[0]):
-            for x in range(CaltechDataset.OUTPUT_SIZE[1]):
-                for anchor_id in range(self.anchors.num):
-                    pos = self.get_anchor_at(anchor_id, y, x)
-                    anchor_pos[y, x, anchor_id] = pos
-
-        positive_reg_pos = reg_guess[clas_guess[:, :, :] == 1.0]
-        positive_anchor_pos = anchor_pos[clas_guess[:, :, :] == 1.0]
+        clas_guess, guess_pos, guess_scores, guess_frames = self.parse_batch_results(clas_guess, clas_prob, reg_guess)
+
+        return clas_guess[0], guess_pos, guess_scores
+
+    def parse_batch_results(self, clas_guess, clas_prob, reg_guess): # Same as parse_results, for several frames at once
+        clas_guess = clas_guess.reshape((-1,) + self.anchor_grid.shape) # [?, height, width, # anchors]
+        clas_prob = clas_prob.reshape((-1,) + self.anchor_grid.shape + (2,)) # [?, height, width, # anchors, 2]
+        reg_guess = reg_guess.reshape((-1,) + self.anchor_grid.shape + (4,)) # [?, height, width, # anchors, 4]
+
+        positive = clas_guess == 1.0
+        guess_frames, ys, xs, anchor_ids = np.nonzero(positive) # Index of the frame in the batch, and anchor
+
+        positive_reg_pos = reg_guess[positive]
+        positive_anchor_pos = self.anchor_grid.positions[ys, xs, anchor_ids]
         guess_pos = self.unparametrize(positive_reg_pos, positive_anchor_pos)
 
-        guess_scores = clas_prob[clas_guess[:, :, :] == 1.0, 1]
+        guess_scores = clas_prob[positive, 1]
 
         # Remove guesses where h or w equals 0
-        current = guess_pos[:, 2] != 0 # h = 0
-        guess_pos = guess_pos[current]
-        guess_scores = guess_scores[current]
+        current = (guess_pos[:, 2] != 0) & (guess_pos[:, 3] != 0)
 
-        current = guess_pos[:, 3] != 0 # w = 0
-        guess_pos = guess_pos[current]
-        guess_scores = guess_scores[current]
+        return clas_guess, guess_pos[current], guess_scores[current], guess_frames[current]
 
-        return clas_guess, guess_pos, guess_scores
+    def NMS(self, guess_pos, guess_scores, guess_frames = None):
+        # If guess_frames is given, guesses come from several frames, which are suppressed independently
+        kept = non_maximum_suppression(guess_pos, guess_scores, CaltechDataset.NMS_IOU_THRESHOLD, CaltechDataset.NMS_TOP_N, CaltechDataset.NMS_PRE_TOP_N, guess_frames, CaltechDataset.NMS_BLOCK_SIZE)
 
-    def NMS(self, guess_pos, guess_scores):
-        index = np.argsort(guess_scores[:])[::-1] # Decreasing order with [::-1]
+        final_pos = np.asarray(guess_pos[kept], dtype = np.float64)
+        final_scores = guess_scores[kept]
+
+        if guess_frames is None:
+            return final_pos, final_scores
+        else:
+            return final_pos, final_scores, guess_frames[kept]
 
-        final_pos = np.zeros((0, 4))
-        final_scores = []
-        while len(index) > 0 and len(final_scores) < CaltechDataset.NMS_TOP_N:
-            final_pos = np.vstack([final_pos, guess_pos[index[0]]])
-            final_scores.append(guess_scores[index[0]])
+    def label_anchors(self, persons, undesirables):
+        anchor_boxes = self.anchor_grid.boxes # [# anchors in total, 4]
 
-            to_keep = []
-            for i in range(1, len(index)):
-                if IoU(guess_pos[index[0]], guess_pos[index[i]]) <= CaltechDataset.NMS_IOU_THRESHOLD:
-                    to_keep.append(i)
+        # Compute IoUs for positive & negative examples, as [# anchors in total, # objects] matrices
+        IoUs = IoU_matrix(anchor_boxes, persons)
+        IoUs_negatives = np.hstack([IoUs, IoU_matrix(anchor_boxes, undesirables)])
 
-            index = index[to_keep]
+        clas_data = np.zeros((anchor_boxes.shape[0], 2), dtype = np.uint8) # [# anchors in total, 2]
 
-        return final_pos, np.array(final_scores)
+        # Negative examples
+        if IoUs_negatives.shape[1] > 0:
+            clas_data[np.max(IoUs_negatives, axis = 1) <= CaltechDataset.NEGATIVE_THRESHOLD, 0] = 1.0
+        else:
+            clas_data[:, 0] = 1.0
 
-    def prepare_frame(self, set_number, seq_number, frame_number):
-        self.load_annotations() # Will be needed
+        # Positive examples
+        if persons.shape[0] > 0:
+            # Set best IoU for each person above threshold to create at least a positive example
+            IoUs[IoUs.argmax(axis = 0), np.arange(persons.shape[0])] = 1.0
 
-        # For saving
-        if not os.path.isdir(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq'.format(set_number, seq_number)):
-            os.makedirs(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq'.format(set_number, seq_number))
+            max_IoUs = np.max(IoUs, axis = 1)
+            argmax_IoUs = np.argmax(IoUs, axis = 1)
 
-        if CaltechDataset.USE_CROPPING:
-            image = Image.open(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
-            transform = np.load(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.transform.npy'.format(set_number, seq_number, frame_number))
+            clas_data[max_IoUs >= CaltechDataset.POSITIVE_THRESHOLD, 1] = 1.0
+            clas_data[max_IoUs >= CaltechDataset.POSITIVE_THRESHOLD, 0] = 0.0 # We want no overlap, so positives win over negatives
+
+        # Remove cross-boundaries
+        clas_data[self.anchor_grid.cross_boundaries, :] = 0.0
+
+        # Compute regression for final positive examples
+        if persons.shape[0] > 0:
+            positive = clas_data[:, 1] == 1.0
+            positive_anchor_pos = self.anchor_grid.positions.reshape(-1, 4)[positive]
+            positive_person_pos = persons[argmax_IoUs[positive]]
+
+            reg_positive = self.parametrize(positive_person_pos, positive_anchor_pos)
         else:
-            image = Image.open(self.dataset_location + '/images/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
+            reg_positive = np.zeros((0, 4), dtype = np.float32)
 
-        input_data = np.expand_dims(np.reshape(np.array(image.getdata(), dtype = np.uint8), [image.size[1], image.size[0], 3]), axis = 0) # [?, height, width, RGB]
-        np.save(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.input.npy'.format(set_number, seq_number, frame_number), input_data)
+        return clas_data.reshape(self.anchor_grid.shape + (2,)), reg_positive
 
-        # Retrieve objects for that frame in annotations
-        try:
-            objects = self.annotations['set{:02d}'.format(set_number)]['V{:03d}'.format(seq_number)]['frames']['{}'.format(frame_number)]
-        except KeyError as e:
-            objects = None # Simply no objects for that frame
+    def prepare_frame(self, set_number, seq_number, frame_number): # Saved as separate files
+        input_data, clas_negative, clas_positive, reg_positive = self.compute_frame(set_number, seq_number, frame_number)
 
-        persons = []
-        undesirables = []
-        if objects:
-            for o in objects:
-                good = False
-                pos = (o['pos'][1], o['pos'][0], o['pos'][3], o['pos'][2]) # Convert to (y, x, h, w)
-                if CaltechDataset.USE_CROPPING:
-                    pos = transform_cropped_pos(pos, transform)
-
-                if o['lbl'] in ['person']:
-                    good = True
-
-                    # Remove objects with very small width (are they errors in labeling?!)
-                    if pos[3] < CaltechDataset.MINIMUM_WIDTH:
-                        good = False
+        make_dirs(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq'.format(set_number, seq_number))
+        save_atomic(self.get_prepared_path(set_number, seq_number, frame_number, 'input'), input_data)
+        save_atomic(self.get_prepared_path(set_number, seq_number, frame_number, 'negative'), clas_negative)
+        save_atomic(self.get_prepared_path(set_number, seq_number, frame_number, 'positive'), clas_positive)
+        save_atomic(self.get_prepared_path(set_number, seq_number, frame_number, 'reg'), reg_positive)
 
-                    if o['occl'] == 1:
-                        if type(o['posv']) == int:
-                            good = False
-                        else:
-                            visible_pos = (o['posv'][1], o['posv'][0], o['posv'][3], o['posv'][2]) # Convert to (y, x, h, w)
-                            if CaltechDataset.USE_CROPPING:
-                                visible_pos = transform_cropped_pos(visible_pos, transform)
-                            if visible_pos[2] * visible_pos[3] < CaltechDataset.MINIMUM_VISIBLE_RATIO * pos[2] * pos[3]:
-                                good = False
-                                pos = visible_pos
+    def prepare_shard(self, shard_id, minibatches): # Saved straight into a new shard, without separate files
+        writer = None
+        for minibatch in minibatches:
+            input_data, clas_negative, clas_positive, reg_positive = self.compute_frame(*minibatch)
+            if writer is None:
+                writer = ShardWriter(self.get_shard_directory(), shard_id, len(minibatches), input_data.shape[1:], input_data.dtype)
 
-                if good:
-                    persons.append(pos)
-                elif CaltechDataset.USE_UNDESIRABLES:
-                    undesirables.append(pos)
+            writer.add(minibatch, input_data[0], {'negative': clas_negative, 'positive': clas_positive, 'reg': reg_positive})
 
-        # Move data to numpy
-        persons = np.array(persons, dtype = np.float32)
-        undesirables = np.array(undesirables, dtype = np.float32)
+        writer.close()
 
-        # Compute IoUs for positive & negative examples
-        IoUs = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, persons.shape[0]))
-        IoUs_negatives = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, persons.shape[0] + undesirables.shape[0]))
+    def compute_frame(self, set_number, seq_number, frame_number):
+        # Returns the input of a frame & its labels, in the compact encoding used for saving
+        self.load_annotations() # Will be needed
 
-        # Keep track of cross boundaries anchors, to remove them from training
-        cross_boundaries = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num), dtype = np.uint8)
+        image_data, transform = self.load_frame_image(set_number, seq_number, frame_number)
+        input_data = np.expand_dims(image_data, axis = 0) # [?, height, width, RGB]
 
-        # Keep anchor positions for regression
-        anchor_pos = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 4), dtype = np.float32)
+        # Retrieve objects for that frame in annotations
+        objects = self.annotations.get_objects(set_number, seq_number, frame_number)
 
-        for y in range(CaltechDataset.OUTPUT_SIZE[0]):
-            for x in range(CaltechDataset.OUTPUT_SIZE[1]):
-                for anchor_id in range(self.anchors.num):
-                    pos = self.get_anchor_at(anchor_id, y, x)
-                    anchor_pos[y, x, anchor_id] = pos
+        persons = []
+        undesirables = []
+        for i in range(objects.num):
+            good = False
+            pos = tuple(objects.pos[i]) # As (y, x, h, w)
+            if CaltechDataset.USE_CROPPING:
+                pos = transform_cropped_pos(pos, transform)
 
-                    if pos[0] < 0 or pos[0] + pos[2] >= CaltechDataset.INPUT_SIZE[0] or pos[1] < 0 or pos[1] + pos[3] >= CaltechDataset.INPUT_SIZE[1]:
-                        cross_boundaries[y, x, anchor_id] = 1.0
+            if objects.lbl[i] in ['person']:
+                good = True
 
-                    maxIoU = 0.0
-                    for i in range(persons.shape[0]):
-                        IoUs[y, x, anchor_id, i] = IoU(pos, persons[i])
-                        IoUs_negatives[y, x, anchor_id, i] = IoU(pos, persons[i])
-                    for i in range(undesirables.shape[0]):
-                        IoUs_negatives[y, x, anchor_id, persons.shape[0] + i] = IoU(pos, undesirables[i])
+                # Remove objects with very small width (are they errors in labeling?!)
+                if pos[3] < CaltechDataset.MINIMUM_WIDTH:
+                    good = False
 
-        clas_data = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], self.anchors.num, 2), dtype = np.uint8) # [height, width, # anchors, 2]
+                if objects.occl[i] == 1:
+                    if not objects.has_visible_pos(i):
+                        good = False
+                    else:
+                        visible_pos = tuple(objects.posv[i]) # As (y, x, h, w)
+                        if CaltechDataset.USE_CROPPING:
+                            visible_pos = transform_cropped_pos(visible_pos, transform)
+                        if visible_pos[2] * visible_pos[3] < CaltechDataset.MINIMUM_VISIBLE_RATIO * pos[2] * pos[3]:
+                            good = False
+                            pos = visible_pos
 
-        # Negative examples
-        if persons.shape[0] + undesirables.shape[0] > 0:
-            IoUs_negatives = np.max(IoUs_negatives, axis = 3)
+            if good:
+                persons.append(pos)
+            elif CaltechDataset.USE_UNDESIRABLES:
+                undesirables.append(pos)
 
-            clas_data[IoUs_negatives <= CaltechDataset.NEGATIVE_THRESHOLD, 0] = 1.0
-        else:
-            clas_data[:, :, :, 0] = 1.0
+        # Move data to numpy
+        persons = np.array(persons, dtype = np.float32)
+        undesirables = np.array(undesirables, dtype = np.float32)
 
-        # Positive examples
-        if persons.shape[0] > 0:
-            # Set best IoU for each person above threshold to create at least a positive example
-            max_idx = IoUs.reshape(-1, IoUs.shape[3]).argmax(axis = 0) # Reshape IoUs for easier computation of argmax per person
-            maxs = np.column_stack(np.unravel_index(max_idx, IoUs.shape[:3])) # Compute back maxima indices in regular IoUs shape
-            for i in range(persons.shape[0]):
-                index = tuple(maxs[i]) + (i,)
-                IoUs[index] = 1.0
+        clas_data, reg_positive = self.label_anchors(persons, undesirables)
 
-            max_IoUs = np.max(IoUs, axis = 3)
-            argmax_IoUS = np.argmax(IoUs, axis = 3)
+        clas_negative = np.flatnonzero(clas_data[:, :, :, 0] == 1.0)
+        clas_positive = np.flatnonzero(clas_data[:, :, :, 1] == 1.0)
+        clas_negative, clas_positive, reg_positive = self.encode_labels(clas_negative, clas_positive, reg_positive)
 
-            clas_data[max_IoUs >= CaltechDataset.POSITIVE_THRESHOLD, 1] = 1.0
-            clas_data[max_IoUs >= CaltechDataset.POSITIVE_THRESHOLD, 0] = 0.0 # We want no overlap, so positives win over negatives
+        return input_data, clas_negative, clas_positive, reg_positive
 
-        # Remove cross-boundaries
-        clas_data[cross_boundaries == 1.0, 0] = 0.0
-        clas_data[cross_boundaries == 1.0, 1] = 0.0
+    def encode_labels(self, clas_negative, clas_positive, reg_positive):
+        # Compact encoding for saving: negatives as a bit mask over the grid, positives as uint16 indices
+        num_anchors = np.prod(self.anchor_grid.shape)
 
-        # Compute regression for final positive examples
-        if persons.shape[0] > 0:
-            positive_anchor_pos = anchor_pos[clas_data[:, :, :, 1] == 1.0]
-            argmax_IoUS = argmax_IoUS[clas_data[:, :, :, 1] == 1.0]
-            positive_person_pos = persons[argmax_IoUS]
+        negative_mask = np.zeros(num_anchors, dtype = np.bool_)
+        negative_mask[clas_negative] = True
 
-            reg_positive = self.parametrize(positive_person_pos, positive_anchor_pos)
+        return np.packbits(negative_mask), clas_positive.astype(np.uint16 if num_anchors <= 2**16 else np.uint32), reg_positive.astype(CaltechDataset.REG_DTYPE)
+
+    def decode_labels(self, clas_negative, clas_positive, reg_positive):
+        # Returns indices in the flattened [height, width, # anchors] grid, whatever the encoding saved
+        if clas_negative.ndim == 2: # Frames prepared before compact encoding, (y, x, anchor_id) as rows
+            clas_negative = np.ravel_multi_index(tuple(clas_negative), self.anchor_grid.shape)
+            clas_positive = np.ravel_multi_index(tuple(clas_positive), self.anchor_grid.shape)
         else:
-            reg_positive = np.zeros((0, 4), dtype = np.float32)
+            clas_negative = np.flatnonzero(np.unpackbits(clas_negative)[:np.prod(self.anchor_grid.shape)])
+            clas_positive = clas_positive.astype(np.int64)
 
-        clas_negative = np.where(clas_data[:, :, :, 0] == 1.0)
-        np.save(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.negative.npy'.format(set_number, seq_number, frame_number), clas_negative)
-        clas_positive = np.where(clas_data[:, :, :, 1] == 1.0)
-        np.save(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.positive.npy'.format(set_number, seq_number, frame_number), clas_positive)
-        np.save(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.reg.npy'.format(set_number, seq_number, frame_number), reg_positive)
+        return clas_negative, clas_positive, reg_positive.astype(np.float32)
 
     def show_frame(self, set_number, seq_number, frame_number):
         self.load_annotations() # Will be needed
@@ -483,59 +754,52 @@ class CaltechDataset:
         if not self.is_frame_prepared(set_number, seq_number, frame_number):
             self.prepare_frame(set_number, seq_number, frame_number)
 
-        if CaltechDataset.USE_CROPPING:
-            image = Image.open(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
-            transform = np.load(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.transform.npy'.format(set_number, seq_number, frame_number))
-        else:
-            image = Image.open(self.dataset_location + '/images/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
+        image_data, transform = self.load_frame_image(set_number, seq_number, frame_number)
+        image = Image.fromarray(image_data)
         dr = ImageDraw.Draw(image)
 
         # Retrieve objects for that frame in annotations
-        try:
-            objects = self.annotations['set{:02d}'.format(set_number)]['V{:03d}'.format(seq_number)]['frames']['{}'.format(frame_number)]
-        except KeyError as e:
-            objects = None # Simply no objects for that frame
+        objects = self.annotations.get_objects(set_number, seq_number, frame_number)
 
-        if objects:
-            for o in objects:
-                pos = (o['pos'][1], o['pos'][0], o['pos'][3], o['pos'][2]) # Convert to (y, x, h, w)
-                if CaltechDataset.USE_CROPPING:
-                    pos = transform_cropped_pos(pos, transform)
+        for i in range(objects.num):
+            pos = tuple(objects.pos[i]) # As (y, x, h, w)
+            if CaltechDataset.USE_CROPPING:
+                pos = transform_cropped_pos(pos, transform)
 
-                if o['lbl'] in ['person']:
-                    good = True
+            if objects.lbl[i] in ['person']:
+                good = True
 
-                    # Remove objects with very small width (are they errors in labeling?!)
-                    if pos[3] < CaltechDataset.MINIMUM_WIDTH:
-                        good = False
+                # Remove objects with very small width (are they errors in labeling?!)
+                if pos[3] < CaltechDataset.MINIMUM_WIDTH:
+                    good = False
 
-                    if o['occl'] == 1:
-                        if type(o['posv']) == int:
-                            good = False
-                        else:
-                            visible_pos = (o['posv'][1], o['posv'][0], o['posv'][3], o['posv'][2]) # Convert to (y, x, h, w)
-                            if CaltechDataset.USE_CROPPING:
-                                visible_pos = transform_cropped_pos(visible_pos, transform)
-                            if visible_pos[2] * visible_pos[3] < CaltechDataset.MINIMUM_VISIBLE_RATIO * pos[2] * pos[3]:
-                                good = False
-                                pos = visible_pos
-
-                    if good:
-                        dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'blue')
+                if objects.occl[i] == 1:
+                    if not objects.has_visible_pos(i):
+                        good = False
                     else:
-                        dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'pink')
+                        visible_pos = tuple(objects.posv[i]) # As (y, x, h, w)
+                        if CaltechDataset.USE_CROPPING:
+                            visible_pos = transform_cropped_pos(visible_pos, transform)
+                        if visible_pos[2] * visible_pos[3] < CaltechDataset.MINIMUM_VISIBLE_RATIO * pos[2] * pos[3]:
+                            good = False
+                            pos = visible_pos
+
+                if good:
+                    dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'blue')
                 else:
-                    dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'black')
+                    dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'pink')
+            else:
+                dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'black')
+
+        input_data, clas_negative, clas_positive, reg_positive = self.load_frame(set_number, seq_number, frame_number)
 
-        clas_negative = np.load(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.negative.npy'.format(set_number, seq_number, frame_number))
-        for i in range(clas_negative.shape[1]):
-            y, x, anchor_id = clas_negative[:, i]
+        for i in range(clas_negative.shape[0]):
+            y, x, anchor_id = np.unravel_index(clas_negative[i], self.anchor_grid.shape)
             dr.rectangle((CaltechDataset.OUTPUT_CELL_SIZE * x, CaltechDataset.OUTPUT_CELL_SIZE * y, CaltechDataset.OUTPUT_CELL_SIZE * (x+1) - 1, CaltechDataset.OUTPUT_CELL_SIZE * (y+1) - 1), outline = 'red')
 
-        clas_positive = np.load(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.positive.npy'.format(set_number, seq_number, frame_number))
-        for i in range(clas_positive.shape[1]):
-            y, x, anchor_id = clas_positive[:, i]
-            pos = self.get_anchor_at(anchor_id, y, x)
+        for i in range(clas_positive.shape[0]):
+            y, x, anchor_id = np.unravel_index(clas_positive[i], self.anchor_grid.shape)
+            pos = self.anchor_grid.positions[y, x, anchor_id]
             dr.rectangle((CaltechDataset.OUTPUT_CELL_SIZE * x, CaltechDataset.OUTPUT_CELL_SIZE * y, CaltechDataset.OUTPUT_CELL_SIZE * (x+1) - 1, CaltechDataset.OUTPUT_CELL_SIZE * (y+1) - 1), outline = 'green')
             dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'green')
 
@@ -544,52 +808,42 @@ class CaltechDataset:
     def show_results(self, set_number, seq_number, frame_number, clas_guess, guess_pos, guess_scores, original_image = False):
         self.load_annotations() # Will be needed
 
-        if CaltechDataset.USE_CROPPING:
-            if original_image:
-                image = Image.open(self.dataset_location + '/images/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
-            else:
-                image = Image.open(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
-            transform = np.load(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.transform.npy'.format(set_number, seq_number, frame_number))
-        else:
-            image = Image.open(self.dataset_location + '/images/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
+        image_data, transform = self.load_frame_image(set_number, seq_number, frame_number, original_image)
+        image = Image.fromarray(image_data)
         dr = ImageDraw.Draw(image)
 
         # Retrieve objects for that frame in annotations
-        try:
-            objects = self.annotations['set{:02d}'.format(set_number)]['V{:03d}'.format(seq_number)]['frames']['{}'.format(frame_number)]
-        except KeyError as e:
-            objects = None # Simply no objects for that frame
+        objects = self.annotations.get_objects(set_number, seq_number, frame_number)
 
-        if objects:
-            for o in objects:
-                pos = (o['pos'][1], o['pos'][0], o['pos'][3], o['pos'][2]) # Convert to (y, x, h, w)
-                if CaltechDataset.USE_CROPPING and not original_image:
-                    pos = transform_cropped_pos(pos, transform)
+        for i in range(objects.num):
+            pos = tuple(objects.pos[i]) # As (y, x, h, w)
+            if CaltechDataset.USE_CROPPING and not original_image:
+                pos = transform_cropped_pos(pos, transform)
 
-                if o['lbl'] in ['person']:
-                    good = True
+            if objects.lbl[i] in ['person']:
+                good = True
 
-                    # Remove objects with very small width (are they errors in labeling?!)
-                    if pos[3] < CaltechDataset.MINIMUM_WIDTH:
-                        good = False
+                # Remove objects with very small width (are they errors in labeling?!)
+                if pos[3] < CaltechDataset.MINIMUM_WIDTH:
+                    good = False
 
-                    if o['occl'] == 1:
-                        if type(o['posv']) == int:
-                            good = False
-                        else:
-                            visible_pos = (o['posv'][1], o['posv'][0], o['posv'][3], o['posv'][2]) # Convert to (y, x, h, w)
-                            if CaltechDataset.USE_CROPPING and not original_image:
-                                visible_pos = transform_cropped_pos(visible_pos, transform)
-                            if visible_pos[2] * visible_pos[3] < CaltechDataset.MINIMUM_VISIBLE_RATIO * pos[2] * pos[3]:
-                                good = False
-                                pos = visible_pos
-
-                    if good:
-                        dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'blue')
+                if objects.occl[i] == 1:
+                    if not objects.has_visible_pos(i):
+                        good = False
                     else:
-                        dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'pink')
+                        visible_pos = tuple(objects.posv[i]) # As (y, x, h, w)
+                        if CaltechDataset.USE_CROPPING and not original_image:
+                            visible_pos = transform_cropped_pos(visible_pos, transform)
+                        if visible_pos[2] * visible_pos[3] < CaltechDataset.MINIMUM_VISIBLE_RATIO * pos[2] * pos[3]:
+                            good = False
+                            pos = visible_pos
+
+                if good:
+                    dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'blue')
                 else:
-                    dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'black')
+                    dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'pink')
+            else:
+                dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'black')
 
         if not CaltechDataset.USE_CROPPING or not original_image:
             for y in range(clas_guess.shape[0]):
@@ -600,134 +854,125 @@ class CaltechDataset:
                         else: # Positive
                             dr.rectangle((CaltechDataset.OUTPUT_CELL_SIZE * x, CaltechDataset.OUTPUT_CELL_SIZE * y, CaltechDataset.OUTPUT_CELL_SIZE * (x+1) - 1, CaltechDataset.OUTPUT_CELL_SIZE * (y+1) - 1), outline = 'green')
 
+        if CaltechDataset.USE_CROPPING and original_image:
+            guess_pos = untransform_cropped_boxes(guess_pos, transform)
+
         for row in range(guess_pos.shape[0]):
             pos = guess_pos[row]
-            if CaltechDataset.USE_CROPPING and original_image:
-                pos = untransform_cropped_pos(pos, transform)
             dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'green')
             dr.text((pos[1], pos[0]), '{:.3f}'.format(guess_scores[row]))
 
         image.show()
 
     def save_results(self, set_number, seq_number, frame_number, guess_pos, guess_scores, original_image = False):
-        # For saving
-        if not os.path.isdir(self.dataset_location + '/results/set{:02d}/V{:03d}'.format(set_number, seq_number)):
-            os.makedirs(self.dataset_location + '/results/set{:02d}/V{:03d}'.format(set_number, seq_number))
-
+        # Buffered by sequence & written in the background (see results.py), until close_results is called
         if CaltechDataset.USE_CROPPING and original_image:
-            transform = np.load(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.transform.npy'.format(set_number, seq_number, frame_number))
+            guess_pos = untransform_cropped_boxes(guess_pos, self.get_crop_transform(set_number, seq_number))
 
-        with open(self.dataset_location + '/results/set{:02d}/V{:03d}/I{:05d}.txt'.format(set_number, seq_number, frame_number), 'w') as file:
-            for row in range(guess_pos.shape[0]):
-                pos = guess_pos[row]
-                if CaltechDataset.USE_CROPPING and original_image:
-                    pos = untransform_cropped_pos(pos, transform)
-                score = guess_scores[row]
+        if self.results_sink is None:
+            self.results_sink = ResultsSink(self.dataset_location + '/results')
+        self.results_sink.add(set_number, seq_number, frame_number, guess_pos, guess_scores)
 
-                file.write('{}, {}, {}, {}, {}\n'.format(pos[1], pos[0], pos[3], pos[2], score))
+    def close_results(self): # Writes all results left
+        if self.results_sink is not None:
+            self.results_sink.close()
+            self.results_sink = None
+            self.results_store = None # Reload with the new results
 
-    def compute_matches(self, set_number, seq_number, frame_number, guess_pos, guess_scores, original_image = False, display_image = False):
+    def load_results(self, set_number, seq_number, frame_number): # Guesses saved by save_results, as (y, x, h, w) positions & scores
+        if self.results_store is None:
+            self.results_store = ResultsStore(self.dataset_location + '/results')
+        if self.results_store.has_sequence(set_number, seq_number):
+            return self.results_store.get(set_number, seq_number, frame_number)
+
+        # Results saved before as one text file per frame
+        path = self.dataset_location + '/results/set{:02d}/V{:03d}/I{:05d}.txt'.format(set_number, seq_number, frame_number)
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return np.zeros((0, 4)), np.zeros(0)
+
+        rows = np.loadtxt(path, delimiter = ',', ndmin = 2)
+
+        return rows[:, [1, 0, 3, 2]], rows[:, 4]
+
+    def match_frame(self, set_number, seq_number, frame_number, guess_pos, guess_scores, original_image = False):
+        # Matches the guesses of a frame to its ground truth, see match_detections
+        # Returns guesses sorted by decreasing score (positions in the same image as the ground truth), & the matching
         self.load_annotations() # Will be needed
 
         if CaltechDataset.USE_CROPPING:
-            if display_image:
-                if original_image:
-                    image = Image.open(self.dataset_location + '/images/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
-                else:
-                    image = Image.open(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
-            transform = np.load(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.transform.npy'.format(set_number, seq_number, frame_number))
-        elif display_image:
-            image = Image.open(self.dataset_location + '/images/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
-
-        if display_image:
-            dr = ImageDraw.Draw(image)
+            transform = self.get_crop_transform(set_number, seq_number)
 
         # Retrieve objects for that frame in annotations
-        try:
-            objects = self.annotations['set{:02d}'.format(set_number)]['V{:03d}'.format(seq_number)]['frames']['{}'.format(frame_number)]
-        except KeyError as e:
-            objects = None # Simply no objects for that frame
+        objects = self.annotations.get_objects(set_number, seq_number, frame_number)
 
         # We attempt to mimic the reasonable test set
         # i.e. 50 pixels or taller, no occlusion (not even partial)
         persons = []
         undesirables = []
-        if objects:
-            for o in objects:
-                good = False
-                pos = (o['pos'][1], o['pos'][0], o['pos'][3], o['pos'][2]) # Convert to (y, x, h, w)
-                if CaltechDataset.USE_CROPPING and not original_image:
-                    pos = transform_cropped_pos(pos, transform)
-
-                if o['lbl'] in ['person']:
-                    good = True
-
-                    # 50 pixels or taller
-                    if pos[2] < 50:
-                        good = False
+        for i in range(objects.num):
+            good = False
+            pos = tuple(objects.pos[i]) # As (y, x, h, w)
+            if CaltechDataset.USE_CROPPING and not original_image:
+                pos = transform_cropped_pos(pos, transform)
 
-                    if o['occl'] == 1:
-                        good = False
+            if objects.lbl[i] in ['person']:
+                good = True
 
-                if good:
-                    persons.append(pos)
-                    if display_image:
-                        dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'blue')
-                else:
-                    undesirables.append(pos)
-                    if display_image:
-                        dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'pink')
+                # 50 pixels or taller
+                if pos[2] < 50:
+                    good = False
+
+                if objects.occl[i] == 1:
+                    good = False
+
+            if good:
+                persons.append(pos)
+            else:
+                undesirables.append(pos)
 
         # Move data to numpy
-        persons = np.array(persons, dtype = np.float32)
-        undesirables = np.array(undesirables, dtype = np.float32)
+        persons = np.array(persons, dtype = np.float32).reshape(-1, 4)
+        undesirables = np.array(undesirables, dtype = np.float32).reshape(-1, 4)
 
         # Sort guesses
         index = np.argsort(guess_scores[:])[::-1] # Decreasing order with [::-1]
         guess_pos = guess_pos[index]
         guess_scores = guess_scores[index]
 
-        default_false_positives = 0
-        guess_matched = np.zeros(guess_scores.shape, dtype = np.bool)
+        if CaltechDataset.USE_CROPPING and original_image:
+            guess_pos = untransform_cropped_boxes(guess_pos, transform)
 
-        for row in range(guess_pos.shape[0]):
-            pos = guess_pos[row]
-            if CaltechDataset.USE_CROPPING and original_image:
-                pos = untransform_cropped_pos(pos, transform)
-
-            # Try matching
-            matched = False
-            if persons.shape[0] > 0:
-                for r in range(persons.shape[0]):
-                    if IoU(pos, persons[r]) > 0.5:
-                        matched = True
-                        persons = np.delete(persons, r, 0)
-                        break
-
-            if matched:
-                guess_matched[row] = True
-                if display_image:
+        guess_matched, guess_ignored, person_matched = match_detections(guess_pos, persons, undesirables)
+
+        return guess_pos, guess_scores, guess_matched, guess_ignored, persons, person_matched, undesirables
+
+    def compute_matches(self, set_number, seq_number, frame_number, guess_pos, guess_scores, original_image = False, display_image = False):
+        guess_pos, guess_scores, guess_matched, guess_ignored, persons, person_matched, undesirables = self.match_frame(set_number, seq_number, frame_number, guess_pos, guess_scores, original_image)
+        default_false_positives = np.sum(~guess_matched & ~guess_ignored)
+
+        if display_image:
+            image_data, transform = self.load_frame_image(set_number, seq_number, frame_number, original_image)
+            image = Image.fromarray(image_data)
+            dr = ImageDraw.Draw(image)
+
+            for pos in persons:
+                dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'blue')
+            for pos in undesirables:
+                dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'pink')
+
+            for row in range(guess_pos.shape[0]):
+                pos = guess_pos[row]
+                if guess_matched[row]:
                     dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'green')
-            else:
-                if undesirables.shape[0] > 0:
-                    for r in range(undesirables.shape[0]):
-                        if IoA(pos, undesirables[r]) > 0.5:
-                            matched = True
-                            break
-
-                if not matched:
-                    default_false_positives += 1
-                    if display_image:
-                        dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'red')
-                elif display_image:
+                elif guess_ignored[row]:
                     dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'yellow')
-
-            if display_image:
+                else:
+                    dr.rectangle((pos[1], pos[0], pos[1] + pos[3], pos[0] + pos[2]), outline = 'red')
                 dr.text((pos[1], pos[0]), '{:.3f}'.format(guess_scores[row]))
 
-        # Sorted scores of all matches made for computing curves
+        # Sorted scores of all matches made for computing curves, & numbers of unmatched guesses & persons
         matched_scores = guess_scores[guess_matched]
-        default = np.array([default_false_positives, persons.shape[0]])
+        default = np.array([default_false_positives, persons.shape[0] - np.sum(person_matched)])
 
         if display_image:
             image.show()
@@ -735,72 +980,279 @@ class CaltechDataset:
         return matched_scores, default
 
     def is_frame_prepared(self, set_number, seq_number, frame_number):
-        return os.path.isfile(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.input.npy'.format(set_number, seq_number, frame_number)) and os.path.isfile(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.negative.npy'.format(set_number, seq_number, frame_number)) and os.path.isfile(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.positive.npy'.format(set_number, seq_number, frame_number)) and os.path.isfile(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.reg.npy'.format(set_number, seq_number, frame_number))
+        if CaltechDataset.USE_SHARDS and (set_number, seq_number, frame_number) in self.get_shard_store():
+            return True
+
+        return all(os.path.isfile(self.get_prepared_path(set_number, seq_number, frame_number, field)) for field in PREPARED_FIELDS)
+
+    def get_prepared_path(self, set_number, seq_number, frame_number, field): # File of a frame prepared as separate files
+        return self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.{}.npy'.format(set_number, seq_number, frame_number, field)
+
+    def get_shard_directory(self):
+        return self.dataset_location + '/prepared-shards'
+
+    def get_shard_store(self):
+        if self.shard_store is None:
+            self.shard_store = ShardStore(self.get_shard_directory())
+
+        return self.shard_store
 
     def load_frame(self, set_number, seq_number, frame_number):
-        input_data = np.load(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.input.npy'.format(set_number, seq_number, frame_number))
-        clas_negative = np.load(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.negative.npy'.format(set_number, seq_number, frame_number))
-        clas_positive = np.load(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.positive.npy'.format(set_number, seq_number, frame_number))
-        reg_positive = np.load(self.dataset_location + '/prepared/set{:02d}/V{:03d}.seq/{}.reg.npy'.format(set_number, seq_number, frame_number))
+        if CaltechDataset.USE_SHARDS and (set_number, seq_number, frame_number) in self.get_shard_store():
+            frame = self.get_shard_store().load((set_number, seq_number, frame_number)) # Views on the memory-mapped shard, no copy
+            return (frame['input'],) + self.decode_labels(frame['negative'], frame['positive'], frame['reg'])
 
-        return input_data, clas_negative, clas_positive, reg_positive
+        input_data = np.load(self.get_prepared_path(set_number, seq_number, frame_number, 'input'))
 
-    def crop_frame(self, set_number, seq_number, frame_number):
-        self.load_annotations() # Will be needed
+        return (input_data,) + self.load_labels(set_number, seq_number, frame_number)
+
+    def load_labels(self, set_number, seq_number, frame_number): # Same as load_frame, without the input
+        if CaltechDataset.USE_SHARDS and (set_number, seq_number, frame_number) in self.get_shard_store():
+            frame = self.get_shard_store().load((set_number, seq_number, frame_number))
+            return self.decode_labels(frame['negative'], frame['positive'], frame['reg'])
+
+        return self.decode_labels(*[np.load(self.get_prepared_path(set_number, seq_number, frame_number, field)) for field in ['negative', 'positive', 'reg']])
+
+    def load_frame_files(self, set_number, seq_number, frame_number):
+        return tuple(np.load(self.get_prepared_path(set_number, seq_number, frame_number, field)) for field in PREPARED_FIELDS)
+
+    def pack_shards(self, minibatches = None, remove_files = False):
+        # Move frames prepared as separate files into new shards
+        # Files are kept, unless remove_files: then they are removed once their frame is read back identical from the shards
+        if minibatches is None:
+            minibatches = self.training + self.validation + self.testing
+
+        store = self.get_shard_store()
+        to_pack = [minibatch for minibatch in minibatches if minibatch not in store and self.is_frame_prepared(*minibatch)]
+        print('{} frames to pack in shards of {}'.format(len(to_pack), CaltechDataset.SHARD_SIZE))
+
+        make_dirs(store.directory)
+        shard_id = store.num_shards
+        for start in range(0, len(to_pack), CaltechDataset.SHARD_SIZE):
+            shard_minibatches = to_pack[start:start + CaltechDataset.SHARD_SIZE]
+
+            writer = None
+            for minibatch in shard_minibatches:
+                input_data, clas_negative, clas_positive, reg_positive = self.load_frame_files(*minibatch)
+                if writer is None:
+                    writer = ShardWriter(store.directory, shard_id, len(shard_minibatches), input_data.shape[1:], input_data.dtype)
+
+                clas_negative, clas_positive, reg_positive = self.encode_labels(*self.decode_labels(clas_negative, clas_positive, reg_positive))
+                writer.add(minibatch, input_data[0], {'negative': clas_negative, 'positive': clas_positive, 'reg': reg_positive})
+
+            writer.close()
+            print('Shard {} written ({} frames)'.format(shard_id, len(shard_minibatches)))
+            shard_id += 1
+
+        self.shard_store = None # Reload with the new shards
+
+        if remove_files:
+            self.remove_packed_files(to_pack)
+
+    def remove_packed_files(self, minibatches):
+        store = self.get_shard_store()
+
+        num_removed = 0
+        for set_number, seq_number, frame_number in minibatches:
+            if (set_number, seq_number, frame_number) not in store:
+                continue
+
+            frame = store.load((set_number, seq_number, frame_number))
+            input_data, clas_negative, clas_positive, reg_positive = self.load_frame_files(set_number, seq_number, frame_number)
+            packed = np.array_equal(frame['input'], input_data)
+            for packed_labels, file_labels in zip(self.decode_labels(frame['negative'], frame['positive'], frame['reg']), self.decode_labels(clas_negative, clas_positive, reg_positive)):
+                packed = packed and np.array_equal(packed_labels, file_labels)
+
+            if not packed:
+                print('Frame {} differs in the shards, its files are kept'.format((set_number, seq_number, frame_number)))
+                continue
+
+            for field in PREPARED_FIELDS:
+                os.remove(self.get_prepared_path(set_number, seq_number, frame_number, field))
+            num_removed += 1
+
+        print('Files of {} packed frames removed'.format(num_removed))
+
+    def get_feature_store(self):
+        if self.feature_store is None:
+            self.feature_store = ShardStore(self.dataset_location + '/features-' + CaltechDataset.FEATURE_CACHE)
+
+        return self.feature_store
+
+    def cache_features(self, compute_features, minibatches = None, batch_size = 16):
+        # Write the activations of frames not cached yet into new float16 shards, with compute_features
+        # giving the [?, height, width, depth] activations of a [?, height, width, RGB] batch of prepared inputs
+        if minibatches is None:
+            minibatches = self.training + self.validation + self.testing
+
+        store = self.get_feature_store()
+        to_cache = [minibatch for minibatch in minibatches if minibatch not in store]
+        print('{} frames to cache in {}'.format(len(to_cache), store.directory))
 
-        # For saving
-        if not os.path.isdir(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq'.format(set_number, seq_number)):
-            os.makedirs(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq'.format(set_number, seq_number))
+        make_dirs(store.directory)
+        shard_id = store.num_shards
+        for start in range(0, len(to_cache), CaltechDataset.SHARD_SIZE):
+            shard_minibatches = to_cache[start:start + CaltechDataset.SHARD_SIZE]
 
-        image = Image.open(self.dataset_location + '/images/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
+            writer = None
+            for batch_start in range(0, len(shard_minibatches), batch_size):
+                batch_minibatches = shard_minibatches[batch_start:batch_start + batch_size]
+                features = compute_features(np.concatenate([self.load_frame(*minibatch)[0] for minibatch in batch_minibatches]))
+                if writer is None:
+                    writer = ShardWriter(store.directory, shard_id, len(shard_minibatches), features.shape[1:], np.float16)
 
-        image_data = np.reshape(np.array(image.getdata(), dtype = np.uint8), [image.size[1], image.size[0], 3])
-        greyscale_data = np.mean(image_data, axis = 2)
+                for minibatch, frame_features in zip(batch_minibatches, features):
+                    writer.add(minibatch, frame_features, {})
 
-        y_data = np.mean(greyscale_data, axis = 1)
-        ys = y_data >= CaltechDataset.CROPPING_THRESHOLD
+            writer.close()
+            print('Feature shard {} written ({} frames)'.format(shard_id, len(shard_minibatches)))
+            shard_id += 1
 
-        x_data = np.mean(greyscale_data, axis = 0)
-        xs = x_data >= CaltechDataset.CROPPING_THRESHOLD
+        self.feature_store = None # Reload with the new shards
 
-        cropped_data = image_data[ys, :]
-        cropped_data = cropped_data[:, xs]
+    def load_image(self, set_number, seq_number, frame_number): # Original image of a frame, as a [height, width, RGB] array
+        if CaltechDataset.USE_SEQ_FILES:
+            return self.get_seq_file(set_number, seq_number).decode_frame(frame_number)
 
-        cropped_image = Image.fromarray(cropped_data)
-        cropped_image = cropped_image.resize(image.size)
-        cropped_image.save(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
+        return decode_image(self.dataset_location + '/images/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number))
 
-        dy = 0
-        if not ys[0]:
-            while not ys[dy]:
-                dy += 1
-        dx = 0
-        if not xs[0]:
-            while not xs[dx]:
-                dx += 1
-        delta = (dy, dx)
+    def get_seq_file(self, set_number, seq_number):
+        key = (set_number, seq_number)
+        if key not in self.seq_files:
+            self.seq_files[key] = SeqFile(self.dataset_location + '/data/set{:02d}/V{:03d}.seq'.format(set_number, seq_number))
 
-        scale = (float(image.size[1]) / float(ys.sum()), float(image.size[0]) / float(xs.sum()))
+        return self.seq_files[key]
 
-        transform = np.array([delta, scale], dtype = np.float32)
-        np.save(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.transform.npy'.format(set_number, seq_number, frame_number), transform)
+    def load_frame_image(self, set_number, seq_number, frame_number, original_image = False):
+        # Image of a frame as seen by the network (unless original_image), & its crop transform if USE_CROPPING
+        image_data = self.load_image(set_number, seq_number, frame_number)
+        if not CaltechDataset.USE_CROPPING:
+            return image_data, None
 
-    def is_frame_cropped(self, set_number, seq_number, frame_number):
-        return os.path.isfile(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.jpg'.format(set_number, seq_number, frame_number)) and os.path.isfile(self.dataset_location + '/images-cropped/set{:02d}/V{:03d}.seq/{}.transform.npy'.format(set_number, seq_number, frame_number))
+        transform = self.get_crop_transform(set_number, seq_number)
+        if not original_image:
+            image_data = crop_image(image_data, transform)
+
+        return image_data, transform
+
+    def get_crop_transform_path(self, set_number, seq_number):
+        return self.dataset_location + '/crop-transforms/set{:02d}/V{:03d}.npy'.format(set_number, seq_number)
+
+    def get_crop_transform(self, set_number, seq_number):
+        key = (set_number, seq_number)
+        if key not in self.crop_transforms:
+            path = self.get_crop_transform_path(set_number, seq_number)
+            if not os.path.isfile(path):
+                self.compute_crop_transform(set_number, seq_number)
+            self.crop_transforms[key] = np.load(path)
+
+        return self.crop_transforms[key]
+
+    def compute_crop_transform(self, set_number, seq_number):
+        # The black borders are the same for all frames of a sequence, so they are found once from a sample of its frames
+        # The transform is saved as [[dy, dx], [scale y, scale x], [cropped height, cropped width]]
+        make_dirs(self.dataset_location + '/crop-transforms/set{:02d}'.format(set_number))
+
+        num_frames = self.get_manifest().num_frames(set_number, seq_number)
+        frame_numbers = np.unique(np.linspace(0, num_frames - 1, min(num_frames, CaltechDataset.CROPPING_SAMPLE_FRAMES)).astype(int))
+
+        y_data = 0.0
+        x_data = 0.0
+        for frame_number in frame_numbers:
+            greyscale_data = np.mean(self.load_image(set_number, seq_number, frame_number), axis = 2, dtype = np.float64)
+            y_data = y_data + np.mean(greyscale_data, axis = 1) / len(frame_numbers)
+            x_data = x_data + np.mean(greyscale_data, axis = 0) / len(frame_numbers)
+
+        # Keep everything between the first & last rows (columns) that are not part of a border
+        ys = np.flatnonzero(y_data >= CaltechDataset.CROPPING_THRESHOLD)
+        if ys.shape[0] == 0:
+            ys = np.array([0, y_data.shape[0] - 1])
+        xs = np.flatnonzero(x_data >= CaltechDataset.CROPPING_THRESHOLD)
+        if xs.shape[0] == 0:
+            xs = np.array([0, x_data.shape[0] - 1])
+
+        delta = (ys[0], xs[0])
+        size = (ys[-1] - ys[0] + 1, xs[-1] - xs[0] + 1)
+        scale = (float(y_data.shape[0]) / float(size[0]), float(x_data.shape[0]) / float(size[1]))
+
+        transform = np.array([delta, scale, size], dtype = np.float32)
+        save_atomic(self.get_crop_transform_path(set_number, seq_number), transform)
+
+    def prepare(self, num_workers = None):
+        if num_workers is None:
+            num_workers = CaltechDataset.PREPARE_WORKERS
+
+        minibatches = self.training + self.validation + self.testing
 
-    def prepare(self):
         if CaltechDataset.USE_CROPPING:
-            for minibatch in self.training + self.validation + self.testing:
-                if not self.is_frame_cropped(*minibatch):
-                    self.crop_frame(*minibatch)
+            sequences = sorted(set((set_number, seq_number) for set_number, seq_number, frame_number in minibatches))
+            to_crop = [sequence for sequence in sequences if not os.path.isfile(self.get_crop_transform_path(*sequence))]
+            self.run_prepare_tasks('compute_crop_transform', to_crop, num_workers, 'sequences')
+
+        to_prepare = [minibatch for minibatch in minibatches if not self.is_frame_prepared(*minibatch)]
+
+        if not CaltechDataset.USE_SHARDS:
+            self.run_prepare_tasks('prepare_frame', to_prepare, num_workers)
+            return
+
+        self.pack_shards() # Frames prepared before as separate files
+
+        # New frames go straight into shards, smaller than SHARD_SIZE if need be to keep all workers busy
+        shard_size = min(CaltechDataset.SHARD_SIZE, max(1, int(ceil(float(len(to_prepare)) / float(num_workers)))))
+        shard_id = self.get_shard_store().num_shards
+        tasks = [(shard_id + i, to_prepare[start:start + shard_size]) for i, start in enumerate(range(0, len(to_prepare), shard_size))]
+
+        make_dirs(self.get_shard_directory())
+        self.run_prepare_tasks('prepare_shard', tasks, num_workers, 'shards', chunk_size = 1, progress_interval = 1)
+        self.shard_store = None # Reload with the new shards
+
+    def run_prepare_tasks(self, function_name, minibatches, num_workers, unit = 'frames', chunk_size = None, progress_interval = None):
+        # Calls function_name with the arguments of each task in minibatches, reporting progress every progress_interval tasks
+        if chunk_size is None:
+            chunk_size = CaltechDataset.PREPARE_CHUNK_SIZE
+        if progress_interval is None:
+            progress_interval = CaltechDataset.PREPARE_PROGRESS_INTERVAL
+
+        if len(minibatches) == 0:
+            return
+
+        print('{}: {} {} to process with {} worker(s)'.format(function_name, len(minibatches), unit, num_workers))
+        self.load_annotations() # Built here if need be, rather than by each worker
+
+        pool = None
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers, init_prepare_worker, (self.dataset_location,))
+            done_minibatches = pool.imap_unordered(run_prepare_worker, [(function_name, minibatch) for minibatch in minibatches], chunksize = chunk_size)
+        else:
+            done_minibatches = (getattr(self, function_name)(*minibatch) for minibatch in minibatches)
+
+        try:
+            start_time = time.time()
+            for num_done, _ in enumerate(done_minibatches, 1):
+                if num_done % progress_interval == 0 or num_done == len(minibatches):
+                    elapsed = time.time() - start_time
+                    print('{}: {}/{} {} ({:.1f} {}/s)'.format(function_name, num_done, len(minibatches), unit, float(num_done) / max(elapsed, 1e-6), unit))
+        finally:
+            if pool:
+                pool.terminate() # All tasks are done at this point, unless interrupted
+                pool.join()
+
+prepare_worker_dataset = None # Dataset used by each worker process of CaltechDataset.prepare
+
+def init_prepare_worker(dataset_location):
+    global prepare_worker_dataset
+    prepare_worker_dataset = CaltechDataset(dataset_location)
+    prepare_worker_dataset.load_annotations() # Only once per worker
+
+def run_prepare_worker(task):
+    function_name, minibatch = task
+    getattr(prepare_worker_dataset, function_name)(*minibatch)
 
-        for minibatch in self.training + self.validation + self.testing:
-            if not self.is_frame_prepared(*minibatch):
-                self.prepare_frame(*minibatch)
+    return minibatch
 
 if __name__ == '__main__':
     caltech = CaltechDataset('dataset')
-    caltech.prepare()
+    caltech.prepare(multiprocessing.cpu_count())
     caltech.show_frame(*caltech.training[0])
 
     # Some statistics on the sets used
@@ -808,8 +1260,8 @@ if __name__ == '__main__':
     num_positives = 0
     for minibatch in caltech.training:
         input_data, clas_negative, clas_positive, reg_positive = caltech.load_frame(*minibatch)
-        num_negatives += clas_negative.shape[1]
-        num_positives += clas_positive.shape[1]
+        num_negatives += clas_negative.shape[0]
+        num_positives += clas_positive.shape[0]
     print('Training set:')
     print('Positive examples: {}'.format(num_positives))
     print('Negative examples: {}'.format(num_negatives))
@@ -819,8 +1271,8 @@ if __name__ == '__main__':
     num_positives = 0
     for minibatch in caltech.validation:
         input_data, clas_negative, clas_positive, reg_positive = caltech.load_frame(*minibatch)
-        num_negatives += clas_negative.shape[1]
-        num_positives += clas_positive.shape[1]
+        num_negatives += clas_negative.shape[0]
+        num_positives += clas_positive.shape[0]
     print('Validation set:')
     print('Positive examples: {}'.format(num_positives))
     print('Negative examples: {}'.format(num_negatives))
@@ -830,8 +1282,8 @@ if __name__ == '__main__':
     num_positives = 0
     for minibatch in caltech.testing:
         input_data, clas_negative, clas_positive, reg_positive = caltech.load_frame(*minibatch)
-        num_negatives += clas_negative.shape[1]
-        num_positives += clas_positive.shape[1]
+        num_negatives += clas_negative.shape[0]
+        num_positives += clas_positive.shape[0]
     print('Testing set:')
     print('Positive examples: {}'.format(num_positives))
     print('Negative examples: {}'.format(num_negatives))
@@ -29,9 +29,11 @@ cd caltech-pedestrian-dataset-extractor
 # Download with the caltech-pedestrian-dataset-extractor/download.sh script
 bash download.sh
 
-# Extract images
-npm install
-node caltech_pd.js
+# Extract images, unless frames are read directly from the .seq files (CaltechDataset.USE_SEQ_FILES)
+if [ "$1" != "--no-images" ]; then
+    npm install
+    node caltech_pd.js
+fi
 cd ..
 
 cd caltech-pedestrian-dataset-converter
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import multiprocessing
+
+import numpy as np
+
+from caltech import CaltechDataset
+
+# Miss rate vs false positives per image (FPPI), as in the Caltech evaluation, accumulated frame by frame:
+# scores of matched guesses & of false positives (neither matched nor ignored, see match_detections) are
+# folded into fixed-size histograms, so memory does not grow with the number of guesses.
+# A threshold t keeps the guesses scoring at least t, and the curve has a point per bin edge.
+class MissRateAccumulator:
+    NUM_BINS = 1000 # Scores are probabilities, in [0, 1]
+    REFERENCE_FPPI = np.logspace(-2.0, 0.0, 9) # FPPI values averaged for the log-average miss rate
+
+    def __init__(self, num_bins = None):
+        self.num_bins = num_bins if num_bins else MissRateAccumulator.NUM_BINS
+        self.matched = np.zeros(self.num_bins, dtype = np.int64) # Histogram of scores of matched guesses
+        self.false_positives = np.zeros(self.num_bins, dtype = np.int64) # Histogram of scores of false positives
+        self.num_persons = 0
+        self.num_frames = 0
+
+    def get_bins(self, scores):
+        return np.clip(np.floor(np.asarray(scores, dtype = np.float64) * self.num_bins), 0, self.num_bins - 1).astype(np.int64)
+
+    def add(self, matched_scores, false_positive_scores, num_persons, num_frames = 1):
+        self.matched += np.bincount(self.get_bins(matched_scores), minlength = self.num_bins)
+        self.false_positives += np.bincount(self.get_bins(false_positive_scores), minlength = self.num_bins)
+        self.num_persons += num_persons
+        self.num_frames += num_frames
+
+    def add_frame(self, caltech, minibatch, guess_pos, guess_scores, original_image = False):
+        guess_pos, guess_scores, guess_matched, guess_ignored, persons, person_matched, undesirables = caltech.match_frame(minibatch[0], minibatch[1], minibatch[2], guess_pos, guess_scores, original_image)
+
+        self.add(guess_scores[guess_matched], guess_scores[~guess_matched & ~guess_ignored], persons.shape[0])
+
+    def merge(self, other):
+        assert self.num_bins == other.num_bins
+
+        self.matched += other.matched
+        self.false_positives += other.false_positives
+        self.num_persons += other.num_persons
+        self.num_frames += other.num_frames
+
+        return self
+
+    def curve(self): # Returns (thresholds, miss rates, FPPI), by decreasing threshold
+        thresholds = np.arange(self.num_bins)[::-1] / float(self.num_bins)
+        true_positives = np.cumsum(self.matched[::-1])
+        false_positives = np.cumsum(self.false_positives[::-1])
+
+        miss_rates = 1.0 - true_positives / float(max(self.num_persons, 1))
+        fppi = false_positives / float(max(self.num_frames, 1))
+
+        return thresholds, miss_rates, fppi
+
+    def reference_miss_rates(self):
+        # Miss rate at each reference FPPI, taken at the lowest threshold with at most that FPPI
+        # (1 when even the highest threshold gives more false positives)
+        thresholds, miss_rates, fppi = self.curve()
+
+        reference_miss_rates = np.ones(MissRateAccumulator.REFERENCE_FPPI.shape[0])
+        for i, reference in enumerate(MissRateAccumulator.REFERENCE_FPPI):
+            below = np.flatnonzero(fppi <= reference)
+            if below.shape[0] > 0:
+                reference_miss_rates[i] = miss_rates[below[-1]]
+
+        return reference_miss_rates
+
+    def log_average_miss_rate(self): # Geometric mean of the reference miss rates
+        return np.exp(np.mean(np.log(np.maximum(self.reference_miss_rates(), 1e-10))))
+
+    def summary(self):
+        lines = ['Log-average miss rate: {:.2f}% ({} frames, {} persons)'.format(100.0 * self.log_average_miss_rate(), self.num_frames, self.num_persons)]
+        for reference, miss_rate in zip(MissRateAccumulator.REFERENCE_FPPI, self.reference_miss_rates()):
+            lines.append('  {:.3f} FPPI: {:.2f}% miss rate'.format(reference, 100.0 * miss_rate))
+
+        return '\n'.join(lines)
+
+    def save(self, path): # Curve & raw histograms, to be compared or merged later
+        thresholds, miss_rates, fppi = self.curve()
+        np.savez(path, thresholds = thresholds, miss_rates = miss_rates, fppi = fppi, matched = self.matched,
+                 false_positives = self.false_positives, num_persons = self.num_persons, num_frames = self.num_frames)
+
+def evaluate_results(dataset_location, minibatches, num_workers = 1, original_image = True):
+    # Evaluates results saved by CaltechDataset.save_results, with the frames split across num_workers processes
+    if num_workers <= 1:
+        return evaluate_results_worker((dataset_location, minibatches, original_image))
+
+    shards = [minibatches[i::num_workers] for i in range(num_workers)]
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        accumulators = pool.map(evaluate_results_worker, [(dataset_location, shard, original_image) for shard in shards])
+    finally:
+        pool.terminate()
+        pool.join()
+
+    accumulator = MissRateAccumulator()
+    for partial in accumulators:
+        accumulator.merge(partial)
+
+    return accumulator
+
+def evaluate_results_worker(task):
+    dataset_location, minibatches, original_image = task
+    caltech = CaltechDataset(dataset_location)
+
+    accumulator = MissRateAccumulator()
+    for minibatch in minibatches:
+        guess_pos, guess_scores = caltech.load_results(*minibatch)
+        accumulator.add_frame(caltech, minibatch, guess_pos, guess_scores, original_image)
+
+    return accumulator
+
+if __name__ == '__main__':
+    caltech = CaltechDataset('dataset')
+    caltech.load_annotations() # Built here if need be, rather than by each worker
+    accumulator = evaluate_results('dataset', caltech.testing, multiprocessing.cpu_count())
+    print(accumulator.summary())
+    accumulator.save('dataset/results/mr-fppi.npz')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import os, json
+
+from shards import write_atomic
+from seq import SeqFile
+
+# Sets, sequences & number of frames of the extracted images, persisted next to the images directory
+# (images.manifest.json), so that they are not discovered again by crawling every sequence at each startup.
+# Sequences are either folders of extracted frames (setXX/VYYY.seq/*.jpg) or the .seq videos themselves.
+# Each set & sequence is stored with the modification time of its directory (or .seq file): adding or removing
+# frames changes the one of the sequence, & adding or removing sequences the one of the set, so only the
+# directories whose time changed are listed again. Checking the manifest only requires a stat per directory.
+class Manifest:
+    def __init__(self, images_directory, path = None):
+        self.images_directory = images_directory
+        self.path = path if path else images_directory.rstrip('/') + '.manifest.json'
+        self.sets = {} # setXX -> {'mtime': ..., 'sequences': {VYYY.seq -> {'mtime': ..., 'num_frames': ...}}}
+
+        self.load()
+
+    def load(self):
+        cached = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as json_file:
+                    cached = json.load(json_file)
+            except ValueError: # Corrupted, simply built again
+                cached = {}
+
+        if not os.path.isdir(self.images_directory):
+            self.sets = {}
+            return
+
+        changed = False
+        sets = {}
+        for set_name in sorted(os.listdir(self.images_directory)):
+            set_directory = self.images_directory + '/' + set_name
+            if not set_name.startswith('set') or not os.path.isdir(set_directory):
+                continue
+
+            mtime = os.path.getmtime(set_directory)
+            cached_set = cached.get(set_name)
+            if cached_set is None or cached_set['mtime'] != mtime:
+                changed = True
+                cached_sequences = cached_set['sequences'] if cached_set else {}
+                sequence_names = sorted(s for s in os.listdir(set_directory) if s.endswith('.seq'))
+            else:
+                cached_sequences = cached_set['sequences']
+                sequence_names = sorted(cached_sequences)
+
+            sequences = {}
+            for seq_name in sequence_names:
+                seq_path = set_directory + '/' + seq_name
+                if not os.path.exists(seq_path): # Removed, but the set directory has not been modified
+                    changed = True
+                    continue
+
+                seq_mtime = os.path.getmtime(seq_path)
+                cached_sequence = cached_sequences.get(seq_name)
+                if cached_sequence is None or cached_sequence['mtime'] != seq_mtime:
+                    changed = True
+                    if os.path.isdir(seq_path):
+                        num_frames = len([f for f in os.listdir(seq_path) if f.endswith('.jpg')])
+                    else:
+                        seq_file = SeqFile(seq_path)
+                        num_frames = seq_file.num_frames
+                        seq_file.close()
+                    cached_sequence = {'mtime': seq_mtime, 'num_frames': num_frames}
+                sequences[seq_name] = cached_sequence
+
+            sets[set_name] = {'mtime': mtime, 'sequences': sequences}
+
+        self.sets = sets
+        if changed or len(sets) != len(cached):
+            write_atomic(self.path, lambda file: file.write(json.dumps(sets, indent = 1, sort_keys = True).encode('utf-8')))
+
+    def get_sequences(self, set_number):
+        set_entry = self.sets.get('set{:02d}'.format(set_number))
+        return sorted(set_entry['sequences']) if set_entry else []
+
+    def get_sequence_numbers(self, set_number): # As found in the names of the sequences, not necessarily contiguous
+        return [int(seq_name[1:-len('.seq')]) for seq_name in self.get_sequences(set_number)]
+
+    def num_frames(self, set_number, seq_number):
+        set_entry = self.sets.get('set{:02d}'.format(set_number))
+        if not set_entry:
+            return 0
+
+        sequence = set_entry['sequences'].get('V{:03d}.seq'.format(seq_number))
+        return sequence['num_frames'] if sequence else 0
+
+if __name__ == '__main__':
+    manifest = Manifest('dataset/images')
+    for set_name in sorted(manifest.sets):
+        sequences = manifest.sets[set_name]['sequences']
+        print('{}: {} sequences, {} frames'.format(set_name, len(sequences), sum(s['num_frames'] for s in sequences.values())))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import threading, contextlib
+
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+# Iterates over items produced by a background thread, which keeps up to depth items ready in advance.
+# Items are produced by a single thread & in order, so iterating gives exactly the same items as without prefetching.
+# Producing can be paused, e.g. while another Prefetcher uses the same dataset, which is not thread-safe.
+class Prefetcher:
+    def __init__(self, iterable, depth):
+        self.depth = depth
+        self.queue = queue.Queue(maxsize = depth)
+        self.stopped = threading.Event()
+        self.producing = threading.Lock() # Held while producing an item, & while paused
+        self.finished = False
+
+        # Statistics on the queue depth, when items are requested
+        self.num_items = 0
+        self.total_depth = 0
+        self.num_waits = 0 # Number of items for which the queue was empty, i.e. not prefetched in time
+
+        self.thread = threading.Thread(target = self.fill, args = (iter(iterable),))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, entry):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def fill(self, iterator):
+        try:
+            while True:
+                with self.producing:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+
+                if not self.put(('item', item)):
+                    return
+        except Exception as e:
+            self.put(('error', e))
+            return
+
+        self.put(('end', None))
+
+    @contextlib.contextmanager
+    def paused(self): # No item is produced within, & the one being produced is finished first
+        self.producing.acquire()
+        try:
+            yield
+        finally:
+            self.producing.release()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+
+        depth = self.queue.qsize()
+        if depth == 0:
+            self.num_waits += 1
+
+        kind, value = self.queue.get()
+        if kind != 'item':
+            self.finished = True
+            if kind == 'error':
+                raise value
+            raise StopIteration
+
+        self.num_items += 1
+        self.total_depth += depth
+
+        return value
+
+    next = __next__ # Python 2
+
+    def close(self):
+        self.stopped.set()
+        while not self.queue.empty():
+            self.queue.get()
+        self.thread.join()
+
+    def stats(self):
+        mean_depth = float(self.total_depth) / float(max(self.num_items, 1))
+
+        return 'Prefetching: mean queue depth {:.2f}/{}, waited for {} out of {} minibatches'.format(mean_depth, self.depth, self.num_waits, self.num_items)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import os, glob, re, threading
+
+import numpy as np
+
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+from shards import write_atomic
+
+# Results (guessed boxes & scores) stored by sequence, instead of one text file per frame:
+# - setXX/VYYY.npz holds the frame numbers, the offsets of each frame in the boxes & scores,
+#   the (y, x, h, w) boxes & their scores, for all frames of the sequence with results
+# The Caltech text layout (setXX/VYYY/IZZZZZ.txt, one "x, y, w, h, score" line per box) can be exported from it.
+
+def sequence_path(directory, set_number, seq_number):
+    return directory + '/set{:02d}/V{:03d}.npz'.format(set_number, seq_number)
+
+def load_sequence(path):
+    with np.load(path) as arrays:
+        return dict((name, arrays[name]) for name in arrays.files)
+
+def merge_frames(sequence, frames): # Adds frames (list of (frame, boxes, scores)) to arrays of a sequence, replacing frames already there
+    if sequence is not None:
+        for i, frame_number in enumerate(sequence['frames']):
+            start, end = sequence['offsets'][i], sequence['offsets'][i + 1]
+            frames = [(frame_number, sequence['boxes'][start:end], sequence['scores'][start:end])] + frames
+
+    by_frame = dict((int(frame_number), (boxes, scores)) for frame_number, boxes, scores in frames) # Latest frames win
+    frame_numbers = sorted(by_frame)
+
+    return {
+        'frames': np.array(frame_numbers, dtype = np.int64),
+        'offsets': np.cumsum([0] + [by_frame[f][0].shape[0] for f in frame_numbers]).astype(np.int64),
+        'boxes': np.concatenate([by_frame[f][0].reshape(-1, 4) for f in frame_numbers], axis = 0),
+        'scores': np.concatenate([by_frame[f][1].reshape(-1) for f in frame_numbers], axis = 0)
+    }
+
+# Buffers the results of each sequence, & writes a sequence on a background thread once a frame
+# of another sequence is added (test frames come sequence by sequence), or when closing.
+class ResultsSink:
+    def __init__(self, directory):
+        self.directory = directory
+        self.buffers = {} # (set, seq) -> list of (frame, boxes, scores)
+        self.last_key = None
+        self.written = set() # Sequences written by this sink, merged with their file if written again
+        self.error = None
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self.write_sequences)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, set_number, seq_number, frame_number, boxes, scores):
+        key = (set_number, seq_number)
+        if self.last_key is not None and key != self.last_key:
+            self.flush(self.last_key)
+        self.last_key = key
+
+        self.buffers.setdefault(key, []).append((frame_number, np.array(boxes).reshape(-1, 4), np.array(scores).reshape(-1)))
+
+    def flush(self, key):
+        frames = self.buffers.pop(key, None)
+        if frames:
+            self.queue.put((key, frames))
+
+    def write_sequences(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+
+            key, frames = task
+            try:
+                path = sequence_path(self.directory, *key)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+
+                sequence = load_sequence(path) if key in self.written else None # Older files are replaced
+                arrays = merge_frames(sequence, frames)
+                write_atomic(path, lambda file: np.savez(file, **arrays))
+                self.written.add(key)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        for key in list(self.buffers):
+            self.flush(key)
+        self.last_key = None
+
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+class ResultsStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.sequences = {} # (set, seq) -> dict of arrays, loaded lazily
+
+    def get_sequence(self, set_number, seq_number):
+        key = (set_number, seq_number)
+        if key not in self.sequences:
+            path = sequence_path(self.directory, set_number, seq_number)
+            self.sequences[key] = load_sequence(path) if os.path.isfile(path) else None
+
+        return self.sequences[key]
+
+    def has_sequence(self, set_number, seq_number):
+        return self.get_sequence(set_number, seq_number) is not None
+
+    def get(self, set_number, seq_number, frame_number): # Returns (boxes, scores) of a frame, empty if it has no results
+        sequence = self.get_sequence(set_number, seq_number)
+        if sequence is not None:
+            i = np.searchsorted(sequence['frames'], frame_number)
+            if i < sequence['frames'].shape[0] and sequence['frames'][i] == frame_number:
+                start, end = sequence['offsets'][i], sequence['offsets'][i + 1]
+                return sequence['boxes'][start:end], sequence['scores'][start:end]
+
+        return np.zeros((0, 4)), np.zeros(0)
+
+def export_text(directory, output_directory = None):
+    # Writes results in the layout of the Caltech evaluation code, next to the sequences by default
+    if output_directory is None:
+        output_directory = directory
+
+    for path in sorted(glob.glob(directory + '/set*/V*.npz')):
+        set_number, seq_number = [int(n) for n in re.search(r'set(\d+)/V(\d+)\.npz$', path).groups()]
+        sequence = load_sequence(path)
+
+        seq_directory = output_directory + '/set{:02d}/V{:03d}'.format(set_number, seq_number)
+        if not os.path.isdir(seq_directory):
+            os.makedirs(seq_directory)
+
+        for i, frame_number in enumerate(sequence['frames']):
+            start, end = sequence['offsets'][i], sequence['offsets'][i + 1]
+            with open(seq_directory + '/I{:05d}.txt'.format(frame_number), 'w') as file:
+                for pos, score in zip(sequence['boxes'][start:end], sequence['scores'][start:end]):
+                    file.write('{}, {}, {}, {}, {}\n'.format(pos[1], pos[0], pos[3], pos[2], score))
+
+if __name__ == '__main__':
+    export_text('dataset/results')
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import io, struct, threading
+
+import numpy as np
+
+# Reader for the Norpix .seq videos of the Caltech dataset, giving access to their JPEG frames without extracting them.
+# Layout (as in seqIo.m of the Caltech toolbox):
+# - a 1024 bytes header, starting with 0xFEED & 'Norpix seq', with the image size, format & number of frames at 548
+# - then one record per frame: its size as uint32 (counting these 4 bytes), the JPEG data, & 8 more bytes (timestamp)
+# Offsets of frames are found by walking the records once, & checked against the JPEG start of image marker.
+# From the first record that does not match (e.g. a different padding between records), the rest of the file is
+# scanned for JPEG markers instead, reading it in chunks.
+
+HEADER_SIZE = 1024
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+JPEG_FORMATS = [102, 201] # Image formats of JPEG compressed frames
+SCAN_CHUNK_SIZE = 1 << 20 # Bytes read at once when scanning for JPEG markers
+
+class SeqFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.lock = threading.Lock() # Frames may be read from several threads
+
+        header = self.file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE or struct.unpack('<I', header[0:4])[0] != 0xFEED or header[4:24].decode('utf-16-le') != 'Norpix seq':
+            raise ValueError('{} is not a Norpix .seq file'.format(path))
+
+        self.version, header_size = struct.unpack('<iI', header[28:36])
+        (self.width, self.height, self.bit_depth, self.bit_depth_real, self.image_size_bytes,
+         self.image_format, self.header_num_frames, _, self.true_image_size) = struct.unpack('<9I', header[548:584])
+        self.fps = struct.unpack('<d', header[584:592])[0]
+
+        if self.image_format not in JPEG_FORMATS:
+            raise ValueError('{}: image format {} is not supported, only JPEG frames are'.format(path, self.image_format))
+
+        self.offsets, self.sizes = self.index_frames()
+        self.num_frames = self.offsets.shape[0]
+
+    def index_frames(self): # Returns offsets & sizes of the JPEG data of all frames
+        self.file.seek(0, 2)
+        file_size = self.file.tell()
+
+        offsets = []
+        sizes = []
+        position = HEADER_SIZE
+        while position + 4 <= file_size and (self.header_num_frames == 0 or len(offsets) < self.header_num_frames):
+            self.file.seek(position)
+            size = struct.unpack('<I', self.file.read(4))[0]
+            if size <= 4 or position + size > file_size or self.file.read(2) != JPEG_SOI:
+                return self.scan_frames(position, file_size, offsets, sizes)
+
+            offsets.append(position + 4)
+            sizes.append(size - 4)
+            position += size + 8
+
+        return np.array(offsets, dtype = np.int64), np.array(sizes, dtype = np.int64)
+
+    def scan_frames(self, start, file_size, offsets, sizes):
+        # Slower indexing from start on, from the size preceding each JPEG start of image marker
+        # Frames are added to the offsets & sizes already found before start, which are returned as arrays
+        chunk_start = 0
+        chunk = b''
+        position = start + 4 # Where to look for the next marker, after the size of its record
+        while position + 2 <= file_size:
+            if position - 4 < chunk_start or position + 2 > chunk_start + len(chunk): # Chunk starting with the size before position
+                chunk_start = position - 4
+                self.file.seek(chunk_start)
+                chunk = self.file.read(SCAN_CHUNK_SIZE)
+
+            i = chunk.find(JPEG_SOI, position - chunk_start)
+            if i == -1:
+                position = chunk_start + len(chunk) - 1 # A marker may be split between two chunks
+                continue
+
+            marker = chunk_start + i
+            size = struct.unpack('<I', chunk[i - 4:i])[0] - 4
+            end = marker + size
+            if size > 0 and end <= file_size:
+                if end <= chunk_start + len(chunk):
+                    end_marker = chunk[end - 2 - chunk_start:end - chunk_start]
+                else:
+                    self.file.seek(end - 2)
+                    end_marker = self.file.read(2)
+            else:
+                end_marker = None
+
+            if end_marker == JPEG_EOI:
+                offsets.append(marker)
+                sizes.append(size)
+                position = end + 4
+            else:
+                position = marker + 2
+
+        return np.array(offsets, dtype = np.int64), np.array(sizes, dtype = np.int64)
+
+    def __len__(self):
+        return self.num_frames
+
+    def read_frame(self, frame_number): # JPEG data of a frame
+        with self.lock:
+            self.file.seek(self.offsets[frame_number])
+            return self.file.read(self.sizes[frame_number])
+
+    def decode_frame(self, frame_number, size = None): # [height, width, RGB] array of a frame
+        from caltech import decode_image # Not at the top, as caltech imports this module
+
+        return decode_image(io.BytesIO(self.read_frame(frame_number)), size)
+
+    def __getitem__(self, frame_number):
+        return self.decode_frame(frame_number)
+
+    def frames(self, start = 0, end = None, size = None): # Yields (frame number, decoded frame), reading the file sequentially
+        end = self.num_frames if end is None else min(end, self.num_frames)
+        for frame_number in range(start, end):
+            yield frame_number, self.decode_frame(frame_number, size)
+
+    def close(self):
+        self.file.close()
+
+if __name__ == '__main__':
+    import sys
+
+    for path in sys.argv[1:]:
+        seq_file = SeqFile(path)
+        print('{}: {} frames of {}x{} ({} in header), {:.1f} fps'.format(path, seq_file.num_frames, seq_file.width, seq_file.height, seq_file.header_num_frames, seq_file.fps))
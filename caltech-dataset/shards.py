@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import os, glob, re
+
+import numpy as np
+
+# Prepared frames packed in shards, instead of one file per array per frame:
+# - shardXXXX.input.npy holds the input images of all frames of the shard, as one [?, height, width, RGB] array (memory-mapped when reading)
+# - shardXXXX.<field>.npy holds the variable-length label arrays of all frames of the shard, concatenated along their first axis
+# - shardXXXX.index.npz holds the (set, seq, frame) of each row, and the offsets of each frame in the label arrays
+# The index is written last, so a shard without index is simply ignored.
+
+def shard_path(directory, shard_id):
+    return directory + '/shard{:04d}'.format(shard_id)
+
+class ShardWriter:
+    def __init__(self, directory, shard_id, num_frames, input_shape, input_dtype = np.uint8):
+        self.path = shard_path(directory, shard_id)
+        self.num_frames = num_frames
+
+        self.temporary_input_path = '{}.input.npy.{}.tmp'.format(self.path, os.getpid())
+        self.inputs = np.lib.format.open_memmap(self.temporary_input_path, mode = 'w+', dtype = input_dtype, shape = (num_frames,) + tuple(input_shape))
+
+        self.keys = []
+        self.fields = {}
+
+    def add(self, key, input_data, fields):
+        self.inputs[len(self.keys)] = input_data
+        self.keys.append(key)
+
+        for name, array in fields.items():
+            self.fields.setdefault(name, []).append(array)
+
+    def close(self):
+        assert len(self.keys) == self.num_frames
+
+        self.inputs.flush()
+        del self.inputs
+        os.rename(self.temporary_input_path, self.path + '.input.npy')
+
+        index = {'keys': np.array(self.keys, dtype = np.int64).reshape(-1, 3)}
+        for name, arrays in self.fields.items():
+            index['offsets_' + name] = np.cumsum([0] + [array.shape[0] for array in arrays]).astype(np.int64)
+            write_atomic(self.path + '.{}.npy'.format(name), lambda file: np.save(file, np.concatenate(arrays, axis = 0)))
+
+        write_atomic(self.path + '.index.npz', lambda file: np.savez(file, **index))
+
+class ShardStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.frames = {} # (set, seq, frame) -> (shard_id, row)
+        self.shards = {} # shard_id -> dict of arrays, loaded lazily
+        self.num_shards = 0
+
+        for index_path in sorted(glob.glob(directory + '/shard*.index.npz')):
+            shard_id = int(re.search(r'shard(\d+)\.index\.npz$', index_path).group(1))
+            self.num_shards = max(self.num_shards, shard_id + 1)
+
+            with np.load(index_path) as index:
+                for row, key in enumerate(index['keys']):
+                    self.frames[tuple(int(k) for k in key)] = (shard_id, row)
+
+    def __contains__(self, key):
+        return tuple(key) in self.frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get_shard(self, shard_id):
+        if shard_id not in self.shards:
+            path = shard_path(self.directory, shard_id)
+
+            shard = {'input': np.load(path + '.input.npy', mmap_mode = 'r')}
+            with np.load(path + '.index.npz') as index:
+                for name in index.files:
+                    if name.startswith('offsets_'):
+                        field = name[len('offsets_'):]
+                        shard[name] = index[name]
+                        shard[field] = np.load(path + '.{}.npy'.format(field), mmap_mode = 'r')
+
+            self.shards[shard_id] = shard
+
+        return self.shards[shard_id]
+
+    def load(self, key): # Returns views (no copy) on the input [1, height, width, RGB] & label arrays of a frame
+        shard_id, row = self.frames[tuple(key)]
+        shard = self.get_shard(shard_id)
+
+        frame = {'input': shard['input'][row:row + 1]}
+        for name in shard:
+            if name.startswith('offsets_'):
+                field = name[len('offsets_'):]
+                start, end = shard[name][row], shard[name][row + 1]
+                frame[field] = shard[field][start:end]
+
+        return frame
+
+def write_atomic(path, write):
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as file:
+        write(file)
+    os.rename(temporary_path, path)
+
+if __name__ == '__main__':
+    import argparse
+    from caltech import CaltechDataset
+
+    parser = argparse.ArgumentParser(description = 'Packs frames already prepared as separate files into shards.')
+    parser.add_argument('--remove-files', action = 'store_true', help = 'remove the files of each frame once read back identical from the shards')
+    args = parser.parse_args()
+
+    caltech = CaltechDataset('dataset')
+    caltech.pack_shards(remove_files = args.remove_files)
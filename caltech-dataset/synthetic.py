@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import os, json, argparse, multiprocessing
+
+import numpy as np
+from PIL import Image
+
+from shards import write_atomic
+
+# Synthetic dataset in the layout of the extracted Caltech dataset, for testing & benchmarking at any scale without it:
+# - images/setXX/VYYY.seq/N.jpg, frames of a fixed background with pedestrians walking across it, and black
+#   letterbox borders at the top & bottom (of a height drawn per sequence, found by the crop transform)
+# - annotations.json, with the pos, posv, occl & lbl fields of each object, as written by download_parse.sh
+# Each sequence is drawn from its own seed, so sequences can be generated in parallel, and sequences whose
+# frames already exist are not drawn again (their annotations are the same).
+
+IMAGE_SIZE = (480, 640)
+MAX_BORDER = 40 # Height of the letterbox borders, at most
+TRACKS_PER_SEQUENCE = 12 # Pedestrians walking across each sequence
+LABELS = ['person', 'person', 'person', 'people', 'person?'] # Drawn uniformly, so mostly persons
+OCCLUSION_RATIO = 0.2 # Ratio of tracks partly occluded, with only the top of their box visible
+JPEG_QUALITY = 85
+
+def sequence_seed(seed, set_number, seq_number):
+    return (seed * 1000003 + set_number * 1009 + seq_number) % (2**32)
+
+def make_background(random_state, border):
+    # Sky above a road, with low-frequency noise, between two black borders
+    height, width = IMAGE_SIZE
+    horizon = random_state.randint(height // 3, height // 2)
+
+    background = np.zeros((height, width, 3), dtype = np.float32)
+    background[:horizon] = random_state.uniform(120, 200, 3)
+    background[horizon:] = random_state.uniform(50, 110, 3)
+    noise = random_state.uniform(-25, 25, (height // 16, width // 16, 1))
+    background += np.repeat(np.repeat(noise, 16, axis = 0), 16, axis = 1)
+
+    background = np.clip(background, 0, 255).astype(np.uint8)
+    if border > 0:
+        background[:border] = 0
+        background[-border:] = 0
+
+    return background, horizon
+
+def make_tracks(random_state, num_frames, horizon, border):
+    # Each track is a pedestrian walking at constant speed, seen from a first to a last frame
+    tracks = []
+    for i in range(TRACKS_PER_SEQUENCE):
+        start = random_state.randint(0, num_frames)
+        height = random_state.uniform(25, 250)
+        tracks.append({
+            'start': start,
+            'end': min(num_frames, start + random_state.randint(10, 300)),
+            'x': random_state.uniform(0, IMAGE_SIZE[1]),
+            'speed': random_state.uniform(-3.0, 3.0), # Pixels per frame
+            'y': min(horizon + 0.5 * height, IMAGE_SIZE[0] - border - height), # Feet on the road, but within the frame
+            'height': height,
+            'growth': random_state.uniform(0.998, 1.002), # Getting closer or further
+            'occluded': random_state.rand() < OCCLUSION_RATIO,
+            'lbl': LABELS[random_state.randint(len(LABELS))],
+            'color': random_state.randint(0, 256, 3)
+        })
+
+    return tracks
+
+def track_objects(tracks, frame_number): # Objects of a frame, as in annotations.json (boxes as [x, y, w, h])
+    objects = []
+    for track in tracks:
+        if not track['start'] <= frame_number < track['end']:
+            continue
+
+        t = frame_number - track['start']
+        h = track['height'] * track['growth'] ** t
+        w = 0.41 * h * (2.0 if track['lbl'] == 'people' else 1.0)
+        x = track['x'] + track['speed'] * t
+        y = track['y'] + track['height'] - h # Feet stay on the ground
+        if x + w <= 0 or x >= IMAGE_SIZE[1]:
+            continue
+
+        objects.append({
+            'pos': [x, y, w, h],
+            'posv': [x, y, w, 0.6 * h] if track['occluded'] else 0,
+            'occl': 1 if track['occluded'] else 0,
+            'lbl': track['lbl'],
+            'color': track['color'] # Removed before saving
+        })
+
+    return objects
+
+def draw_frame(background, objects):
+    image_data = background.copy()
+    for o in objects:
+        x, y, w, h = o['pos']
+
+        fill_box(image_data, x + w / 3.0, y, w / 3.0, h / 7.0, (224, 172, 140)) # Head
+        fill_box(image_data, x, y + h / 7.0, w, h * 6.0 / 7.0, o['color']) # Body
+        if o['occl']: # Something in front of the bottom of the pedestrian
+            fill_box(image_data, x, y + 0.6 * h, w, 0.4 * h, (90, 90, 90))
+
+    return image_data
+
+def fill_box(image_data, x, y, w, h, color): # Box clipped to the image
+    y0, y1 = int(np.clip(round(y), 0, IMAGE_SIZE[0])), int(np.clip(round(y + h), 0, IMAGE_SIZE[0]))
+    x0, x1 = int(np.clip(round(x), 0, IMAGE_SIZE[1])), int(np.clip(round(x + w), 0, IMAGE_SIZE[1]))
+    image_data[y0:y1, x0:x1] = color
+
+def generate_sequence(dataset_location, set_number, seq_number, num_frames, seed):
+    # Draws the frames of a sequence (unless already there) & returns its annotations
+    random_state = np.random.RandomState(sequence_seed(seed, set_number, seq_number))
+    border = random_state.randint(0, MAX_BORDER + 1)
+    background, horizon = make_background(random_state, border)
+    tracks = make_tracks(random_state, num_frames, horizon, border)
+
+    seq_directory = dataset_location + '/images/set{:02d}/V{:03d}.seq'.format(set_number, seq_number)
+    if not os.path.isdir(seq_directory):
+        os.makedirs(seq_directory)
+    done = os.path.isfile(seq_directory + '/{}.jpg'.format(num_frames - 1)) # Frames are written in order
+
+    frames = {}
+    for frame_number in range(num_frames):
+        objects = track_objects(tracks, frame_number)
+        if not done:
+            path = seq_directory + '/{}.jpg'.format(frame_number)
+            write_atomic(path, lambda file: Image.fromarray(draw_frame(background, objects)).save(file, format = 'JPEG', quality = JPEG_QUALITY))
+
+        for o in objects:
+            del o['color']
+        frames[str(frame_number)] = objects
+
+    return set_number, seq_number, frames
+
+def generate_sequence_task(task):
+    return generate_sequence(*task)
+
+def generate(dataset_location, sets = range(11), num_sequences = 2, num_frames = 450, seed = 0, num_workers = 1):
+    # Sets 0 to 5 are used for training, and 6 to 10 for testing
+    tasks = [(dataset_location, set_number, seq_number, num_frames, seed) for set_number in sets for seq_number in range(num_sequences)]
+    print('Generating {} sequences of {} frames in {}'.format(len(tasks), num_frames, dataset_location))
+
+    annotations = {}
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    try:
+        results = pool.imap_unordered(generate_sequence_task, tasks) if pool else (generate_sequence_task(task) for task in tasks)
+        for num_done, (set_number, seq_number, frames) in enumerate(results, 1):
+            annotations.setdefault('set{:02d}'.format(set_number), {})['V{:03d}'.format(seq_number)] = {'nFrame': num_frames, 'frames': frames}
+            print('{}/{} sequences'.format(num_done, len(tasks)))
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    write_atomic(dataset_location + '/annotations.json', lambda file: file.write(json.dumps(annotations).encode('utf-8')))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Generates a synthetic dataset in the layout of the Caltech dataset.')
+    parser.add_argument('dataset', help = 'folder of the dataset (as dataset/)')
+    parser.add_argument('--sets', type = int, default = 11, help = 'number of sets (0 to 5 for training, 6 to 10 for testing)')
+    parser.add_argument('--sequences', type = int, default = 2, help = 'sequences per set')
+    parser.add_argument('--frames', type = int, default = 450, help = 'frames per sequence')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--workers', type = int, default = multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    generate(args.dataset, range(args.sets), args.sequences, args.frames, args.seed, args.workers)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import os, sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from caltech import CaltechDataset, IoU
+
+# Parity of the vectorized CaltechDataset.label_anchors with the per-anchor loop it replaced (scalar IoU for each
+# anchor & object), on random & edge-case boxes: same negative & positive anchors, and same regression targets.
+# Run with pytest, or directly.
+
+NUM_RANDOM_FRAMES = 50
+RANDOM_SEED = 1234
+
+def reference_anchor_at(caltech, anchor_id, y, x): # Geometry of an anchor, as computed before AnchorGrid
+    center_y = CaltechDataset.OUTPUT_CELL_SIZE * (float(y) + 0.5)
+    center_x = CaltechDataset.OUTPUT_CELL_SIZE * (float(x) + 0.5)
+
+    height = caltech.anchors.heights[anchor_id]
+    width = caltech.anchors.widths[anchor_id]
+
+    return (center_y - height / 2.0, center_x - width / 2.0, height, width)
+
+def reference_label_anchors(caltech, persons, undesirables):
+    # The per-anchor loop of prepare_frame, returning flat indices of negatives & positives, & regression targets
+    IoUs = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], caltech.anchors.num, persons.shape[0]))
+    IoUs_negatives = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], caltech.anchors.num, persons.shape[0] + undesirables.shape[0]))
+    cross_boundaries = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], caltech.anchors.num), dtype = np.uint8)
+    anchor_pos = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], caltech.anchors.num, 4), dtype = np.float32)
+
+    for y in range(CaltechDataset.OUTPUT_SIZE[0]):
+        for x in range(CaltechDataset.OUTPUT_SIZE[1]):
+            for anchor_id in range(caltech.anchors.num):
+                pos = reference_anchor_at(caltech, anchor_id, y, x)
+                anchor_pos[y, x, anchor_id] = pos
+
+                if pos[0] < 0 or pos[0] + pos[2] >= CaltechDataset.INPUT_SIZE[0] or pos[1] < 0 or pos[1] + pos[3] >= CaltechDataset.INPUT_SIZE[1]:
+                    cross_boundaries[y, x, anchor_id] = 1.0
+
+                for i in range(persons.shape[0]):
+                    IoUs[y, x, anchor_id, i] = IoU(pos, persons[i])
+                    IoUs_negatives[y, x, anchor_id, i] = IoU(pos, persons[i])
+                for i in range(undesirables.shape[0]):
+                    IoUs_negatives[y, x, anchor_id, persons.shape[0] + i] = IoU(pos, undesirables[i])
+
+    clas_data = np.zeros((CaltechDataset.OUTPUT_SIZE[0], CaltechDataset.OUTPUT_SIZE[1], caltech.anchors.num, 2), dtype = np.uint8)
+
+    if persons.shape[0] + undesirables.shape[0] > 0:
+        clas_data[np.max(IoUs_negatives, axis = 3) <= CaltechDataset.NEGATIVE_THRESHOLD, 0] = 1.0
+    else:
+        clas_data[:, :, :, 0] = 1.0
+
+    if persons.shape[0] > 0:
+        max_idx = IoUs.reshape(-1, IoUs.shape[3]).argmax(axis = 0)
+        maxs = np.column_stack(np.unravel_index(max_idx, IoUs.shape[:3]))
+        for i in range(persons.shape[0]):
+            IoUs[tuple(maxs[i]) + (i,)] = 1.0
+
+        max_IoUs = np.max(IoUs, axis = 3)
+        argmax_IoUs = np.argmax(IoUs, axis = 3)
+
+        clas_data[max_IoUs >= CaltechDataset.POSITIVE_THRESHOLD, 1] = 1.0
+        clas_data[max_IoUs >= CaltechDataset.POSITIVE_THRESHOLD, 0] = 0.0
+
+    clas_data[cross_boundaries == 1.0, 0] = 0.0
+    clas_data[cross_boundaries == 1.0, 1] = 0.0
+
+    if persons.shape[0] > 0:
+        positive = clas_data[:, :, :, 1] == 1.0
+        reg_positive = caltech.parametrize(persons[argmax_IoUs[positive]], anchor_pos[positive])
+    else:
+        reg_positive = np.zeros((0, 4), dtype = np.float32)
+
+    return np.flatnonzero(clas_data[:, :, :, 0] == 1.0), np.flatnonzero(clas_data[:, :, :, 1] == 1.0), reg_positive
+
+def check_parity(caltech, persons, undesirables):
+    persons = np.array(persons, dtype = np.float32).reshape(-1, 4)
+    undesirables = np.array(undesirables, dtype = np.float32).reshape(-1, 4)
+
+    expected_negative, expected_positive, expected_reg = reference_label_anchors(caltech, persons, undesirables)
+
+    clas_data, reg_positive = caltech.label_anchors(persons, undesirables)
+    clas_negative = np.flatnonzero(clas_data[:, :, :, 0] == 1.0)
+    clas_positive = np.flatnonzero(clas_data[:, :, :, 1] == 1.0)
+
+    assert clas_data.shape == caltech.anchor_grid.shape + (2,)
+    assert np.array_equal(clas_negative, expected_negative)
+    assert np.array_equal(clas_positive, expected_positive)
+    assert reg_positive.shape == expected_reg.shape
+    assert np.array_equal(reg_positive, expected_reg)
+
+def random_boxes(random_state, num_boxes): # (y, x, h, w) boxes of pedestrian-like shapes, some crossing the image borders
+    heights = random_state.uniform(10, 400, num_boxes)
+    widths = heights * random_state.uniform(0.3, 0.6, num_boxes)
+    ys = random_state.uniform(-50, CaltechDataset.INPUT_SIZE[0], num_boxes)
+    xs = random_state.uniform(-50, CaltechDataset.INPUT_SIZE[1], num_boxes)
+
+    return np.round(np.stack([ys, xs, heights, widths], axis = 1))
+
+def test_random_frames():
+    caltech = CaltechDataset()
+    random_state = np.random.RandomState(RANDOM_SEED)
+    for i in range(NUM_RANDOM_FRAMES):
+        check_parity(caltech, random_boxes(random_state, random_state.randint(0, 8)), random_boxes(random_state, random_state.randint(0, 4)))
+
+def test_no_objects():
+    check_parity(CaltechDataset(), [], [])
+
+def test_only_undesirables():
+    check_parity(CaltechDataset(), [], [(100, 200, 150, 60), (0, 0, 480, 640)])
+
+def test_boxes_on_anchors():
+    # Persons exactly on an anchor (IoU of 1), on an anchor crossing the borders, & two identical persons (ties)
+    caltech = CaltechDataset()
+    inside = caltech.anchor_grid.positions[15, 20, 2]
+    crossing = caltech.anchor_grid.positions[0, 0, 4]
+    check_parity(caltech, [inside, crossing, inside], [])
+
+def test_degenerate_boxes():
+    # Tiny, outside of the image, & covering the whole image
+    check_parity(CaltechDataset(), [(200, 300, 2, 1), (-500, -500, 50, 20), (0, 0, 479, 639)], [(1000, 1000, 10, 10)])
+
+def test_overlapping_persons_and_undesirables():
+    check_parity(CaltechDataset(), [(100, 100, 200, 82), (110, 120, 190, 78)], [(105, 110, 195, 80)])
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('{}: ok'.format(name))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os, sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from caltech import CaltechDataset, IoU
+
+# Parity of the vectorized CaltechDataset.NMS with the greedy loop it replaced (scalar IoU against each guess left),
+# on random guesses with distinct & tied scores (float32 probabilities often saturate at 1.0): same kept guesses, in
+# the same order. Guesses of several frames at once must give the same as each frame on its own.
+# The former loop sorted with np.argsort(scores)[::-1], whose default sort is not stable in recent versions of NumPy,
+# so the reference uses a stable sort: tied guesses are taken by decreasing index.
+# Run with pytest, or directly.
+
+NUM_TRIALS = 100
+RANDOM_SEED = 4321
+
+def reference_NMS(guess_pos, guess_scores): # The former loop, with the parameters of CaltechDataset
+    index = np.argsort(guess_scores[:], kind = 'mergesort')[::-1] # Decreasing order with [::-1]
+
+    final_pos = np.zeros((0, 4))
+    final_scores = []
+    while len(index) > 0 and len(final_scores) < CaltechDataset.NMS_TOP_N:
+        final_pos = np.vstack([final_pos, guess_pos[index[0]]])
+        final_scores.append(guess_scores[index[0]])
+
+        to_keep = []
+        for i in range(1, len(index)):
+            if IoU(guess_pos[index[0]], guess_pos[index[i]]) <= CaltechDataset.NMS_IOU_THRESHOLD:
+                to_keep.append(i)
+
+        index = index[to_keep]
+
+    return final_pos, np.array(final_scores)
+
+def random_guesses(random_state, num_guesses, tied):
+    heights = random_state.uniform(20, 300, num_guesses)
+    guess_pos = np.stack([random_state.uniform(0, 400, num_guesses), random_state.uniform(0, 600, num_guesses), heights, 0.41 * heights], axis = 1).astype(np.float32)
+    if tied: # Few distinct values, many of them 1.0
+        guess_scores = np.minimum(np.round(random_state.uniform(0.5, 1.5, num_guesses) * 4.0) / 4.0, 1.0).astype(np.float32)
+    else:
+        guess_scores = random_state.rand(num_guesses).astype(np.float32)
+
+    return guess_pos, guess_scores
+
+def check_parity(caltech, guess_pos, guess_scores):
+    expected_pos, expected_scores = reference_NMS(guess_pos, guess_scores)
+    final_pos, final_scores = caltech.NMS(guess_pos, guess_scores)
+
+    assert np.array_equal(final_pos, expected_pos)
+    assert np.array_equal(final_scores, expected_scores)
+
+def run_trials(tied, iou_threshold, block_size):
+    caltech = CaltechDataset()
+    random_state = np.random.RandomState(RANDOM_SEED)
+
+    previous = CaltechDataset.NMS_IOU_THRESHOLD, CaltechDataset.NMS_BLOCK_SIZE
+    CaltechDataset.NMS_IOU_THRESHOLD, CaltechDataset.NMS_BLOCK_SIZE = iou_threshold, block_size
+    try:
+        for i in range(NUM_TRIALS):
+            check_parity(caltech, *random_guesses(random_state, random_state.randint(0, 300), tied))
+    finally:
+        CaltechDataset.NMS_IOU_THRESHOLD, CaltechDataset.NMS_BLOCK_SIZE = previous
+
+def test_distinct_scores():
+    run_trials(False, CaltechDataset.NMS_IOU_THRESHOLD, CaltechDataset.NMS_BLOCK_SIZE)
+
+def test_tied_scores():
+    run_trials(True, CaltechDataset.NMS_IOU_THRESHOLD, CaltechDataset.NMS_BLOCK_SIZE)
+
+def test_tied_scores_overlapping():
+    # Higher threshold, so that many guesses are kept, & small blocks
+    run_trials(True, 0.5, 16)
+
+def test_all_scores_saturated():
+    caltech = CaltechDataset()
+    guess_pos, guess_scores = random_guesses(np.random.RandomState(RANDOM_SEED), 500, True)
+    check_parity(caltech, guess_pos, np.ones_like(guess_scores))
+
+def test_several_frames():
+    caltech = CaltechDataset()
+    random_state = np.random.RandomState(RANDOM_SEED)
+    for i in range(NUM_TRIALS // 10):
+        frames = [random_guesses(random_state, random_state.randint(0, 200), True) for frame in range(4)]
+        guess_pos = np.concatenate([pos for pos, scores in frames])
+        guess_scores = np.concatenate([scores for pos, scores in frames])
+        guess_frames = np.concatenate([np.full(pos.shape[0], frame, dtype = np.int64) for frame, (pos, scores) in enumerate(frames)])
+
+        final_pos, final_scores, final_frames = caltech.NMS(guess_pos, guess_scores, guess_frames)
+        for frame, (pos, scores) in enumerate(frames):
+            expected_pos, expected_scores = reference_NMS(pos, scores)
+            assert np.array_equal(final_pos[final_frames == frame], expected_pos)
+            assert np.array_equal(final_scores[final_frames == frame], expected_scores)
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('{}: ok'.format(name))
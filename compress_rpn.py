@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+import sys, json, argparse
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append('caltech-dataset')
+from caltech import CaltechDataset
+from prefetch import Prefetcher
+
+from inference import load_detector
+from region_proposal import DEFAULT_HEAD, build_inputs, trainer
+from feature_cache import build_feature_cache
+from quantize import evaluate, compare_detections, print_report
+
+# Compression of the first two layers of the RPN of a trained model (3x3x512x4096, then 1x1x4096x4096):
+# - magnitude pruning: channels of layer 1 are ranked by the norm of their filter times the norm of the weights reading
+#   them in layer 2, & channels of layer 2 by the norm of their filter times the one of the cls & reg weights reading them
+# - low-rank factorization: the [inputs, channels] matrix of kept weights is truncated to its rank largest singular values,
+#   giving a convolution to rank channels (same kernel size) followed by a 1x1 convolution (see head_conv2d)
+# The compressed model is saved as a new checkpoint, with its head.json, after an optional brief fine-tuning.
+# It can be tested by region_proposal.py (full_restore_path), or used by inference.py.
+
+def read_rpn(checkpoint_path): # Weights & biases of the RPN of a checkpoint, by variable name
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    return dict((name, reader.get_tensor('RPN/' + name)) for name in
+                ['layer1/weights', 'layer1/biases', 'layer2/weights', 'layer2/biases', 'cls/weights', 'cls/biases', 'reg/weights', 'reg/biases'])
+
+def prune_channels(weights, next_weights, depth): # Indices of the depth channels of weights with most magnitude, in order
+    importance = np.linalg.norm(weights.reshape(-1, weights.shape[-1]), axis = 0) * np.linalg.norm(next_weights, axis = 1)
+    return np.sort(np.argsort(-importance)[:depth])
+
+def factorize(weights, rank): # Returns the two factors of a [height, width, inputs, outputs] convolution truncated to rank
+    U, S, V = np.linalg.svd(weights.reshape(-1, weights.shape[-1]), full_matrices = False)
+    root_S = np.sqrt(S[:rank])
+
+    factor1 = (U[:, :rank] * root_S).reshape(weights.shape[:3] + (rank,))
+    factor2 = (root_S[:, np.newaxis] * V[:rank]).reshape((1, 1, rank, weights.shape[-1]))
+
+    return factor1.astype(np.float32), factor2.astype(np.float32)
+
+def max_rank(weights_shape, depth): # Largest rank giving fewer weights than the convolution, once pruned to depth channels
+    inputs = int(np.prod(weights_shape[:3])) # Rows of the [inputs, channels] matrix factorized
+    return (inputs * depth - 1) // (inputs + depth)
+
+def compress(rpn, head): # Returns the variables of the compressed RPN, by name
+    layer1, layer2 = rpn['layer1/weights'], rpn['layer2/weights'][0, 0]
+    cls, reg = rpn['cls/weights'][0, 0], rpn['reg/weights'][0, 0]
+
+    kept1 = prune_channels(layer1, layer2, head['layer1']['depth'])
+    layer1, layer2 = layer1[:, :, :, kept1], layer2[kept1]
+    kept2 = prune_channels(layer2, np.concatenate([cls, reg], axis = 1), head['layer2']['depth'])
+    layer2, cls, reg = layer2[:, kept2], cls[kept2], reg[kept2]
+
+    compressed = {
+        'layer1/biases': rpn['layer1/biases'][kept1],
+        'layer2/biases': rpn['layer2/biases'][kept2],
+        'cls/weights': cls[np.newaxis, np.newaxis],
+        'cls/biases': rpn['cls/biases'],
+        'reg/weights': reg[np.newaxis, np.newaxis],
+        'reg/biases': rpn['reg/biases']
+    }
+    for name, weights in [('layer1', layer1), ('layer2', layer2[np.newaxis, np.newaxis])]:
+        if head[name]['rank']:
+            compressed[name + '/factor1/weights'], compressed[name + '/factor2/weights'] = factorize(weights, head[name]['rank'])
+        else:
+            compressed[name + '/weights'] = weights
+
+    return compressed
+
+def count_parameters(variables):
+    return sum(int(np.prod(variable.shape)) for variable in variables.values())
+
+def assign_rpn(sess, variables):
+    for name, value in variables.items():
+        with tf.variable_scope('RPN', reuse = True):
+            variable = tf.get_variable(name, value.shape)
+        placeholder = tf.placeholder(variable.dtype.base_dtype, value.shape)
+        sess.run(variable.assign(placeholder), feed_dict = {placeholder: value})
+
+def fine_tune(sess, caltech, train_step, input_placeholder, clas_placeholders, reg_placeholders, num_steps):
+    training_minibatches = Prefetcher(caltech.training_minibatches(input_placeholder, clas_placeholders, reg_placeholders), CaltechDataset.PREFETCH_DEPTH)
+    for step, (feed_dict, epoch) in enumerate(training_minibatches):
+        if step == num_steps:
+            break
+
+        sess.run(train_step, feed_dict = feed_dict)
+        if (step + 1) % 100 == 0:
+            print('{}/{} fine-tuning steps'.format(step + 1, num_steps))
+
+    training_minibatches.close()
+
+def save_compressed(caltech, checkpoint_path, output_path, head, compressed, fine_tune_steps):
+    # Builds the model with the compressed head, from the checkpoint (except the RPN), & saves it with its head.json
+    with tf.Graph().as_default():
+        input_placeholder, clas_placeholders, reg_placeholders, image_placeholder, cached_features = build_inputs(caltech)
+        global_step, learning_rate, train_step, train_summaries, test_steps, vgg = trainer(caltech, input_placeholder, clas_placeholders, reg_placeholders, head = head)
+        vgg_saver = tf.train.Saver(vgg.get_all_variables(), name = 'vgg_saver')
+        full_saver = tf.train.Saver(name = 'full_saver')
+
+        with tf.Session() as sess:
+            tf.initialize_all_variables().run()
+            vgg_saver.restore(sess, checkpoint_path)
+            assign_rpn(sess, compressed)
+
+            if fine_tune_steps:
+                if CaltechDataset.FEATURE_CACHE:
+                    build_feature_cache(sess, caltech, image_placeholder, cached_features)
+                fine_tune(sess, caltech, train_step, input_placeholder, clas_placeholders, reg_placeholders, fine_tune_steps)
+
+            full_saver.save(sess, output_path)
+
+    with open(output_path + '.head.json', 'w') as file:
+        json.dump(head, file, indent = 1, sort_keys = True)
+    print('Compressed model saved: {}'.format(output_path))
+
+def evaluate_checkpoint(caltech, checkpoint_path, batch_size):
+    with tf.Graph().as_default(), tf.Session() as sess:
+        input_placeholder, outputs = load_detector(sess, caltech, checkpoint_path)
+        return evaluate(sess, caltech, input_placeholder, outputs, batch_size)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compresses the RPN of a trained model, by pruning & low-rank factorization of its first two layers.')
+    parser.add_argument('checkpoint', help = 'checkpoint saved by region_proposal.py')
+    parser.add_argument('output', help = 'path of the compressed checkpoint')
+    parser.add_argument('--layer1-depth', type = int, default = 1024, help = 'channels of layer 1 kept by pruning')
+    parser.add_argument('--layer1-rank', type = int, default = 256, help = 'rank of layer 1 (0 for no factorization)')
+    parser.add_argument('--layer2-depth', type = int, default = 1024, help = 'channels of layer 2 kept by pruning')
+    parser.add_argument('--layer2-rank', type = int, default = 0, help = 'rank of layer 2 (0 for no factorization)')
+    parser.add_argument('--fine-tune-steps', type = int, default = 0, help = 'training steps after compression')
+    parser.add_argument('--no-report', action = 'store_true', help = 'only compress, without testing')
+    parser.add_argument('--batch-size', type = int, default = 8)
+    args = parser.parse_args()
+
+    head = {
+        'layer1': {'depth': args.layer1_depth, 'rank': args.layer1_rank},
+        'layer2': {'depth': args.layer2_depth, 'rank': args.layer2_rank}
+    }
+    for name in ['layer1', 'layer2']:
+        if not 0 < head[name]['depth'] <= DEFAULT_HEAD[name]['depth']:
+            parser.error('the depth of {} must be in [1, {}]'.format(name, DEFAULT_HEAD[name]['depth']))
+
+    caltech = CaltechDataset()
+
+    rpn = read_rpn(args.checkpoint)
+    weights_shapes = {'layer1': rpn['layer1/weights'].shape, 'layer2': rpn['layer2/weights'].shape[:2] + (head['layer1']['depth'],)} # After pruning layer 1
+    for name in ['layer1', 'layer2']:
+        if not 0 <= head[name]['rank'] <= max_rank(weights_shapes[name], head[name]['depth']):
+            parser.error('the rank of {} must be in [0, {}] (above, the factors have more weights than the layer)'.format(name, max_rank(weights_shapes[name], head[name]['depth'])))
+
+    compressed = compress(rpn, head)
+    print('RPN parameters: {} -> {} ({:.1f}%)'.format(count_parameters(rpn), count_parameters(compressed), 100.0 * count_parameters(compressed) / count_parameters(rpn)))
+
+    save_compressed(caltech, args.checkpoint, args.output, head, compressed, args.fine_tune_steps)
+
+    if args.no_report:
+        return
+
+    CaltechDataset.FEATURE_CACHE = None # The detectors are fed images
+    original_confusion, original_evaluator, original_guesses, original_detections, original_time = evaluate_checkpoint(caltech, args.checkpoint, args.batch_size)
+    print_report('Original', original_confusion, original_evaluator)
+    print('{:.1f} frames/s'.format(float(original_evaluator.num_frames) / max(original_time, 1e-6)))
+
+    compressed_confusion, compressed_evaluator, compressed_guesses, compressed_detections, compressed_time = evaluate_checkpoint(caltech, args.output, args.batch_size)
+    print_report('Compressed', compressed_confusion, compressed_evaluator)
+    print('{:.1f} frames/s'.format(float(compressed_evaluator.num_frames) / max(compressed_time, 1e-6)))
+
+    found_ratio, score_difference = compare_detections(original_detections, compressed_detections)
+    print('#### Compressed vs original ####')
+    print('Anchors with the same guess: {:.3f}%'.format(100.0 * np.mean(original_guesses == compressed_guesses)))
+    print('Detections found again: {:.2f}% (mean score difference {:.4f})'.format(100.0 * found_ratio, score_difference))
+    print('Log-average miss rate: {:+.2f}%'.format(100.0 * (compressed_evaluator.log_average_miss_rate() - original_evaluator.log_average_miss_rate())))
+    print('Speed: {:.2f}x'.format(original_time / max(compressed_time, 1e-6)))
+
+if __name__ == '__main__':
+    main()
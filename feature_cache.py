@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import sys
+
+import tensorflow as tf
+
+sys.path.append('caltech-dataset')
+from caltech import CaltechDataset
+
+sys.path.append('vgg16')
+from vgg16 import VGG16D
+
+# Activations of VGG16D at a cut point (CaltechDataset.FEATURE_CACHE), computed once per frame & stored as float16
+# in memory-mapped shards (dataset/features-<cut point>/), so that training only runs the layers after the cut:
+# - 'm4_5': after layers 1-4, which are not trainable (the rest of VGG16D & the RPN are still trained)
+# - 'l13': after the whole VGG16D, to only train the RPN
+# Frames already cached are kept: delete the cache when the prepared frames or the weights before the cut change.
+
+def build_prefix(image_placeholder, cut_point): # Layers of VGG16D before the cut point, from [?, height, width, RGB] images
+    vgg = VGG16D()
+    features = vgg.build(tf.cast(image_placeholder, tf.float32), end = cut_point)
+
+    return vgg, features
+
+def build_feature_cache(sess, caltech, image_placeholder, features, minibatches = None, batch_size = 16):
+    # Runs the prefix (already restored in sess) on all frames missing from the cache
+    caltech.cache_features(lambda batch: sess.run(features, feed_dict = {image_placeholder: batch}), minibatches, batch_size)
+
+if __name__ == '__main__':
+    # Usage: ./feature_cache.py [cut point] [checkpoint], with weights from the VGG16D checkpoint by default
+    if len(sys.argv) > 1:
+        CaltechDataset.FEATURE_CACHE = sys.argv[1]
+    elif CaltechDataset.FEATURE_CACHE is None:
+        CaltechDataset.FEATURE_CACHE = 'm4_5'
+    restore_path = sys.argv[2] if len(sys.argv) > 2 else 'vgg16/VGG16D.ckpt'
+
+    caltech = CaltechDataset()
+
+    image_placeholder = tf.placeholder(tf.uint8, [None, caltech.INPUT_SIZE[0], caltech.INPUT_SIZE[1], 3])
+    vgg, features = build_prefix(image_placeholder, CaltechDataset.FEATURE_CACHE)
+    vgg_saver = tf.train.Saver(vgg.get_all_variables(end = CaltechDataset.FEATURE_CACHE), name = 'vgg_saver')
+
+    with tf.Session() as sess:
+        vgg_saver.restore(sess, restore_path)
+        print('VGG model restored from: {}.'.format(restore_path))
+
+        build_feature_cache(sess, caltech, image_placeholder, features)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import sys, os, glob, time, argparse
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+from PIL import Image
+
+sys.path.append('caltech-dataset')
+from caltech import CaltechDataset, decode_image
+from prefetch import Prefetcher
+
+sys.path.append('vgg16')
+from vgg16 import VGG16D
+
+from region_proposal import RPN, load_head
+
+# Inference only: VGG16D & RPN, without the training part of the graph (losses, optimizer, summaries, labels),
+# restored from a checkpoint saved by region_proposal.py, or loaded from a frozen graph exported from it.
+# Guesses are decoded & filtered by NMS like during testing, and written in the Caltech text layout.
+
+OUTPUT_NAMES = ['clas_guess', 'clas_prob', 'reg'] # Names of the outputs in the graph (& in frozen graphs)
+
+def build_detector(input_placeholder, num_anchors, head = None):
+    input_data = tf.cast(input_placeholder, tf.float32)
+
+    vgg = VGG16D()
+    shared_cnn = vgg.build(input_data)
+
+    clas_rpn, reg_rpn = RPN(shared_cnn, num_anchors, head = head)
+    clas_prob = tf.nn.softmax(tf.reshape(clas_rpn, [-1, 2]), name = 'clas_prob') # Big lists over all anchors of the batch
+    clas_guess = tf.argmax(clas_prob, 1, name = 'clas_guess')
+    reg = tf.reshape(reg_rpn, [-1, 4], name = 'reg')
+
+    return clas_guess, clas_prob, reg
+
+def load_detector(sess, caltech, checkpoint_path = None, frozen_graph_path = None):
+    # Returns the input placeholder & outputs, restored from a full_saver checkpoint or a frozen graph
+    if frozen_graph_path:
+        graph_def = tf.GraphDef()
+        with open(frozen_graph_path, 'rb') as file:
+            graph_def.ParseFromString(file.read())
+        tf.import_graph_def(graph_def, name = '')
+        print('Frozen graph loaded from: {}.'.format(frozen_graph_path))
+
+        graph = sess.graph
+        return graph.get_tensor_by_name('input:0'), [graph.get_tensor_by_name(name + ':0') for name in OUTPUT_NAMES]
+
+    input_placeholder = tf.placeholder(tf.uint8, [None, caltech.INPUT_SIZE[0], caltech.INPUT_SIZE[1], 3], name = 'input')
+    outputs = build_detector(input_placeholder, caltech.anchors.num, load_head(checkpoint_path)) # Compressed heads are described next to their checkpoint
+
+    # Variables of the detector have the same names as in the full model, the rest of the checkpoint is ignored
+    saver = tf.train.Saver(tf.all_variables(), name = 'detector_saver')
+    saver.restore(sess, checkpoint_path)
+    print('Model restored from: {}.'.format(checkpoint_path))
+
+    return input_placeholder, list(outputs)
+
+def export_frozen_graph(sess, path): # Variables are turned into constants, so the graph can be loaded without checkpoint
+    frozen_graph_def = graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), OUTPUT_NAMES)
+    tf.train.write_graph(frozen_graph_def, os.path.dirname(path) or '.', os.path.basename(path), as_text = False)
+    print('Frozen graph exported to: {}.'.format(path))
+
+def image_batches(paths, input_size, batch_size):
+    # Yields (paths, original sizes as (width, height), [?, height, width, RGB] batch), images resized to the input size
+    size = (input_size[1], input_size[0])
+    for start in range(0, len(paths), batch_size):
+        batch_paths = paths[start:start + batch_size]
+        original_sizes = [Image.open(path).size for path in batch_paths] # Only reads the header
+        batch = np.stack([decode_image(path, size) for path in batch_paths])
+        yield batch_paths, original_sizes, batch
+
+def save_guesses(path, guess_pos, guess_scores):
+    with open(path, 'w') as file:
+        for pos, score in zip(guess_pos, guess_scores):
+            file.write('{}, {}, {}, {}, {}\n'.format(pos[1], pos[0], pos[3], pos[2], score))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Detects pedestrians in a directory of images.')
+    parser.add_argument('images', help = 'directory of images (.jpg or .png)')
+    parser.add_argument('output', help = 'directory where guesses are written, one text file per image')
+    parser.add_argument('--checkpoint', help = 'checkpoint saved by region_proposal.py')
+    parser.add_argument('--frozen-graph', help = 'frozen graph, used instead of a checkpoint')
+    parser.add_argument('--export-frozen-graph', help = 'path where the restored model is exported as a frozen graph')
+    parser.add_argument('--batch-size', type = int, default = 8)
+    args = parser.parse_args()
+
+    if not args.checkpoint and not args.frozen_graph:
+        parser.error('either --checkpoint or --frozen-graph is needed')
+
+    paths = sorted(glob.glob(os.path.join(args.images, '*.jpg')) + glob.glob(os.path.join(args.images, '*.png')))
+    print('{} images found in {}'.format(len(paths), args.images))
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    caltech = CaltechDataset() # Only for anchors, decoding & NMS
+
+    with tf.Session() as sess:
+        input_placeholder, outputs = load_detector(sess, caltech, args.checkpoint, args.frozen_graph)
+        if args.export_frozen_graph:
+            export_frozen_graph(sess, args.export_frozen_graph)
+
+        num_done = 0
+        num_timed = 0
+        start_time = None
+        for batch_paths, original_sizes, batch in Prefetcher(image_batches(paths, caltech.INPUT_SIZE, args.batch_size), CaltechDataset.PREFETCH_DEPTH):
+            clas_guess, clas_prob, reg = sess.run(outputs, feed_dict = {input_placeholder: batch})
+
+            clas_guess, guess_pos, guess_scores, guess_frames = caltech.parse_batch_results(clas_guess, clas_prob, reg)
+            final_pos, final_scores, final_frames = caltech.NMS(guess_pos, guess_scores, guess_frames)
+
+            for i, path in enumerate(batch_paths):
+                # Back to the size of the original image
+                scale = np.array([original_sizes[i][1], original_sizes[i][0]], dtype = np.float64) / np.array(caltech.INPUT_SIZE, dtype = np.float64)
+                pos = np.round(final_pos[final_frames == i] * np.tile(scale, 2)).astype(np.int64)
+                save_guesses(os.path.join(args.output, os.path.splitext(os.path.basename(path))[0] + '.txt'), pos, final_scores[final_frames == i])
+
+            # The first batch is left out of the speed, as it includes the setup of the session
+            num_done += len(batch_paths)
+            if start_time is None:
+                start_time = time.time()
+                print('{}/{} images'.format(num_done, len(paths)))
+            else:
+                num_timed += len(batch_paths)
+                elapsed = time.time() - start_time
+                print('{}/{} images ({:.1f} frames/s)'.format(num_done, len(paths), float(num_timed) / max(elapsed, 1e-6)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import os, time, json, collections, contextlib
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+# Time spent in each stage of a loop (waiting for minibatches, sess.run, statistics, summaries, checkpoints...),
+# averaged over the last steps. Every interval steps, averages per step are printed & written as TensorBoard
+# scalars (profile/<stage>, in ms), with 'other' for the time of a step outside of all stages.
+# Chosen steps of sess.run can also be traced, & their timeline saved as a Chrome trace (chrome://tracing).
+class StageProfiler:
+    def __init__(self, name, interval, writer = None, trace_steps = (), trace_directory = 'log/timeline'):
+        self.name = name
+        self.interval = interval
+        self.writer = writer
+        self.trace_steps = set(trace_steps)
+        self.trace_directory = trace_directory
+
+        self.stages = [] # In order of first use
+        self.current = {} # Stage -> seconds spent in it during the current step
+        self.window = collections.deque(maxlen = interval) # Seconds per stage of the last steps
+        self.num_steps = 0
+        self.step_start_time = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start_time)
+
+    def add(self, name, seconds):
+        if name not in self.stages:
+            self.stages.append(name)
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def iterate(self, iterable, name): # Yields the items of iterable, with the time waited for each one in stage name
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def run(self, sess, fetches, feed_dict, name = 'sess_run'):
+        # sess.run in stage name, traced if the step is one of trace_steps
+        if self.num_steps not in self.trace_steps:
+            with self.stage(name):
+                return sess.run(fetches, feed_dict = feed_dict)
+
+        run_options = tf.RunOptions(trace_level = tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        with self.stage(name):
+            results = sess.run(fetches, feed_dict = feed_dict, options = run_options, run_metadata = run_metadata)
+
+        if not os.path.isdir(self.trace_directory):
+            os.makedirs(self.trace_directory)
+        path = self.trace_directory + '/{}-{}.json'.format(self.name, self.num_steps)
+        with open(path, 'w') as file:
+            file.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        print('Timeline of {} step {} saved to: {}'.format(self.name, self.num_steps, path))
+
+        return results
+
+    def step(self, global_step = None): # Ends a step, reporting every interval steps
+        self.current['total'] = time.time() - self.step_start_time
+        self.window.append(self.current)
+        self.current = {}
+        self.num_steps += 1
+        self.step_start_time = time.time()
+
+        if self.num_steps % self.interval == 0:
+            self.report(global_step)
+
+    def averages(self): # Seconds per step spent in each stage (& in none of them), over the last steps
+        num_steps = float(max(len(self.window), 1))
+        averages = collections.OrderedDict((stage, sum(times.get(stage, 0.0) for times in self.window) / num_steps) for stage in self.stages)
+        total = sum(times['total'] for times in self.window) / num_steps
+        averages['other'] = max(total - sum(averages.values()), 0.0)
+
+        return averages, total
+
+    def report(self, global_step = None):
+        if not self.window:
+            return
+
+        averages, total = self.averages()
+        print('[{}] {} steps: {:.1f} ms/step ({})'.format(self.name, self.num_steps, 1000.0 * total,
+              ', '.join('{} {:.1f} ms {:.0f}%'.format(stage, 1000.0 * seconds, 100.0 * seconds / max(total, 1e-9)) for stage, seconds in averages.items())))
+
+        if self.writer:
+            values = [tf.Summary.Value(tag = 'profile/' + stage, simple_value = 1000.0 * seconds) for stage, seconds in averages.items()]
+            values.append(tf.Summary.Value(tag = 'profile/total', simple_value = 1000.0 * total))
+            self.writer.add_summary(tf.Summary(value = values), global_step = self.num_steps if global_step is None else global_step)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import sys, time, argparse
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append('caltech-dataset')
+from caltech import CaltechDataset, IoU_matrix
+from evaluation import MissRateAccumulator
+
+from inference import load_detector
+from region_proposal import accumulate_confusion_matrix
+
+# Accuracy of VGG16D & the RPN with the weights of all their convolutions quantized to int8, compared with the float
+# model on the testing set. Weights are quantized per output channel & symmetrically, w ~= scale[c] * q with q an int8
+# in [-127, 127], then dequantized in place of the float weights: the model computes exactly what int8 weights give,
+# with the float32 kernels (there is no int8 inference mode, so nothing is saved).
+
+QUANTIZED_SCOPES = ['VGG16D/', 'RPN/']
+MATCH_THRESHOLD = 0.5 # IoU for a detection of the float model to be found by the quantized model
+
+def get_conv_weights(): # Weights of all quantized convolutions, by layer (as 'VGG16D/layer1')
+    return dict((v.op.name[:-len('/weights')], v) for v in tf.all_variables()
+                if v.op.name.endswith('/weights') and any(v.op.name.startswith(scope) for scope in QUANTIZED_SCOPES))
+
+def quantize_weights(weights): # Returns (int8 values, float32 scales), per output channel (last axis)
+    scales = np.max(np.abs(weights.reshape(-1, weights.shape[-1])), axis = 0) / 127.0
+    scales = np.where(scales > 0.0, scales, 1.0).astype(np.float32) # Channels of zeros
+    quantized = np.clip(np.round(weights / scales), -127, 127).astype(np.int8)
+
+    return quantized, scales
+
+def dequantize_weights(quantized, scales):
+    return quantized.astype(np.float32) * scales
+
+def apply_quantized_weights(sess): # Replaces the weights of all quantized convolutions by their int8 values, dequantized
+    # Returns the relative RMS error of the weights of each layer
+    errors = {}
+    for layer, variable in get_conv_weights().items():
+        weights = sess.run(variable)
+        dequantized = dequantize_weights(*quantize_weights(weights))
+        errors[layer] = np.sqrt(np.sum(np.square(dequantized - weights)) / max(np.sum(np.square(weights)), 1e-20))
+
+        placeholder = tf.placeholder(variable.dtype.base_dtype, variable.get_shape())
+        sess.run(variable.assign(placeholder), feed_dict = {placeholder: dequantized})
+
+    return errors
+
+def evaluate(sess, caltech, input_placeholder, outputs, batch_size):
+    # Runs the model on all testing frames: returns the confusion matrix of labelled anchors, the miss rate accumulator,
+    # the guesses of all anchors, the detections of each frame after NMS & the time spent in the model
+    num_anchors = np.prod(caltech.anchor_grid.shape)
+    confusion_matrix = np.zeros((2, 2), dtype = np.int64) # Truth as rows, guess as columns
+    evaluator = MissRateAccumulator()
+    all_guesses = []
+    detections = []
+    run_time = 0.0
+
+    for start in range(0, len(caltech.testing), batch_size):
+        minibatches_used = caltech.testing[start:start + batch_size]
+        frames = [caltech.load_frame(*minibatch) for minibatch in minibatches_used]
+
+        start_time = time.time()
+        clas_guess, clas_prob, reg = sess.run(outputs, feed_dict = {input_placeholder: np.concatenate([frame[0] for frame in frames])})
+        run_time += time.time() - start_time
+
+        clas_examples = np.zeros(clas_guess.shape[0], dtype = np.int64)
+        clas_answer = np.zeros(clas_guess.shape[0], dtype = np.int64)
+        for i, (frame_input, clas_negative, clas_positive, reg_positive) in enumerate(frames):
+            clas_examples[clas_negative + i * num_anchors] = 1
+            clas_examples[clas_positive + i * num_anchors] = 1
+            clas_answer[clas_positive + i * num_anchors] = 1
+        confusion_matrix = accumulate_confusion_matrix(confusion_matrix, clas_examples, clas_answer, clas_guess)
+        all_guesses.append(clas_guess.astype(np.int8))
+
+        clas_guess, guess_pos, guess_scores, guess_frames = caltech.parse_batch_results(clas_guess, clas_prob, reg)
+        final_pos, final_scores, final_frames = caltech.NMS(guess_pos, guess_scores, guess_frames)
+        for i, minibatch_used in enumerate(minibatches_used):
+            evaluator.add_frame(caltech, minibatch_used, final_pos[final_frames == i], final_scores[final_frames == i], original_image = True)
+            detections.append((final_pos[final_frames == i], final_scores[final_frames == i]))
+
+    return confusion_matrix, evaluator, np.concatenate(all_guesses), detections, run_time
+
+def compare_detections(float_detections, quantized_detections):
+    # Returns the ratio of detections of the float model found by the quantized one, & the mean score difference of those
+    num_found = 0
+    num_detections = 0
+    score_differences = []
+    for (float_pos, float_scores), (quantized_pos, quantized_scores) in zip(float_detections, quantized_detections):
+        num_detections += float_pos.shape[0]
+        if float_pos.shape[0] == 0 or quantized_pos.shape[0] == 0:
+            continue
+
+        iou = IoU_matrix(float_pos, quantized_pos)
+        found = np.max(iou, axis = 1) >= MATCH_THRESHOLD
+        num_found += np.count_nonzero(found)
+        score_differences.append(np.abs(float_scores[found] - quantized_scores[np.argmax(iou, axis = 1)[found]]))
+
+    score_differences = np.concatenate(score_differences) if score_differences else np.zeros(0)
+    return float(num_found) / float(max(num_detections, 1)), float(np.mean(score_differences)) if score_differences.shape[0] > 0 else 0.0
+
+def print_report(name, confusion_matrix, evaluator):
+    print('#### {} ####'.format(name))
+    print('Confusion matrix:\n{}'.format(confusion_matrix))
+    print('Accuracy: {:.2f}%'.format(100.0 * float(np.trace(confusion_matrix)) / float(max(np.sum(confusion_matrix), 1))))
+    print(evaluator.summary())
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compares the accuracy of a trained model with its weights quantized to int8 with the float model, on the testing set.')
+    parser.add_argument('checkpoint', help = 'checkpoint saved by region_proposal.py')
+    parser.add_argument('--batch-size', type = int, default = 8)
+    args = parser.parse_args()
+
+    CaltechDataset.FEATURE_CACHE = None # The detector is fed images
+    caltech = CaltechDataset()
+
+    with tf.Session() as sess:
+        input_placeholder, outputs = load_detector(sess, caltech, args.checkpoint)
+
+        float_confusion, float_evaluator, float_guesses, float_detections, float_time = evaluate(sess, caltech, input_placeholder, outputs, args.batch_size)
+        print_report('float32', float_confusion, float_evaluator)
+
+        weight_errors = apply_quantized_weights(sess)
+        for layer in sorted(weight_errors):
+            print('{}: {:.3f}% error of the int8 weights'.format(layer, 100.0 * weight_errors[layer]))
+
+        quantized_confusion, quantized_evaluator, quantized_guesses, quantized_detections, quantized_time = evaluate(sess, caltech, input_placeholder, outputs, args.batch_size)
+        print_report('int8 weights', quantized_confusion, quantized_evaluator)
+
+        found_ratio, score_difference = compare_detections(float_detections, quantized_detections)
+        print('#### int8 weights vs float32 ####')
+        print('Anchors with the same guess: {:.3f}%'.format(100.0 * np.mean(float_guesses == quantized_guesses)))
+        print('Detections found again: {:.2f}% (mean score difference {:.4f})'.format(100.0 * found_ratio, score_difference))
+        print('Log-average miss rate: {:+.2f}%'.format(100.0 * (quantized_evaluator.log_average_miss_rate() - float_evaluator.log_average_miss_rate())))
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 
-import sys, time
+import sys, os, json, time
+from math import ceil
 
 import numpy as np
 import tensorflow as tf
 
 sys.path.append('caltech-dataset')
 from caltech import CaltechDataset
+from prefetch import Prefetcher
+from evaluation import MissRateAccumulator
+from feature_cache import build_prefix, build_feature_cache
+from profiler import StageProfiler
+from summaries import SummaryScheduler
 
 sys.path.append('vgg16')
 from vgg16 import VGG16D
@@ -16,29 +22,53 @@ def get_weights(shape):
 def get_biases(shape):
     return tf.get_variable('biases', shape, initializer = tf.zeros_initializer)
 
+# Depth of the first two layers of the RPN, and rank of their low-rank factorization (0 for none)
+# Compressed heads are written by compress_rpn.py, in a head.json file next to their checkpoint
+DEFAULT_HEAD = {'layer1': {'depth': 4096, 'rank': 0}, 'layer2': {'depth': 4096, 'rank': 0}}
+
+def load_head(checkpoint_path): # Head of the RPN saved in a checkpoint, None for the default one
+    if checkpoint_path and os.path.isfile(checkpoint_path + '.head.json'):
+        with open(checkpoint_path + '.head.json') as file:
+            return json.load(file)
+
+    return None
+
+def head_conv2d(X, shape, rank): # Convolution by shape weights, as two convolutions (shape[:3] + [rank], then 1x1) if rank is not 0
+    if not rank:
+        return tf.nn.conv2d(X, get_weights(shape), strides = [1, 1, 1, 1], padding = 'SAME')
+
+    with tf.variable_scope('factor1'):
+        factor1 = tf.nn.conv2d(X, get_weights(shape[:3] + [rank]), strides = [1, 1, 1, 1], padding = 'SAME')
+    with tf.variable_scope('factor2'):
+        return tf.nn.conv2d(factor1, get_weights([1, 1, rank, shape[3]]), strides = [1, 1, 1, 1], padding = 'SAME')
+
 # Implementing additional layers for classification
 # This is based on http://arxiv.org/pdf/1506.01497.pdf, but without RoI pooling
 # and instead a deeper RPN
-def RPN(X, num_anchors, training = False):
+def RPN(X, num_anchors, training = False, head = None):
+    head = head if head else DEFAULT_HEAD
+    depth1 = head['layer1']['depth']
+    depth2 = head['layer2']['depth']
+
     with tf.variable_scope('RPN'):
         # First, a conv3-4096 layer to increase the receptive field
         with tf.variable_scope('layer1'): # Layer 1, 3x3 depth 4096
-            l1 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(X, get_weights([3, 3, 512, 4096]), strides = [1, 1, 1, 1], padding = 'SAME'),
-                            get_biases([4096])))
+            l1 = tf.nn.relu(tf.nn.bias_add(head_conv2d(X, [3, 3, 512, depth1], head['layer1']['rank']),
+                            get_biases([depth1])))
 
         # Second, a conv1-4096 layer to increase depth
         with tf.variable_scope('layer2'): # Layer 2, 1x1 depth 4096
-            l2 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(l1, get_weights([1, 1, 4096, 4096]), strides = [1, 1, 1, 1], padding = 'SAME'),
-                            get_biases([4096])))
+            l2 = tf.nn.relu(tf.nn.bias_add(head_conv2d(l1, [1, 1, depth1, depth2], head['layer2']['rank']),
+                            get_biases([depth2])))
 
         # Third, a classification layer
         with tf.variable_scope('cls'): # Classification layer, 1x1 depth 2 * num_anchors
-            clas_layer = tf.nn.bias_add(tf.nn.conv2d(l2, get_weights([1, 1, 4096, 2 * num_anchors]), strides = [1, 1, 1, 1], padding = 'SAME'),
+            clas_layer = tf.nn.bias_add(tf.nn.conv2d(l2, get_weights([1, 1, depth2, 2 * num_anchors]), strides = [1, 1, 1, 1], padding = 'SAME'),
                             get_biases([2 * num_anchors]))
 
         # And a classification layer
         with tf.variable_scope('reg'): # Regression layer, 1x1 depth 4 * num_anchors
-            reg_layer = tf.nn.bias_add(tf.nn.conv2d(l2, get_weights([1, 1, 4096, 4 * num_anchors]), strides = [1, 1, 1, 1], padding = 'SAME'),
+            reg_layer = tf.nn.bias_add(tf.nn.conv2d(l2, get_weights([1, 1, depth2, 4 * num_anchors]), strides = [1, 1, 1, 1], padding = 'SAME'),
                             get_biases([4 * num_anchors]))
 
     return clas_layer, reg_layer
@@ -58,7 +88,11 @@ def create_train_summaries(learning_rate, clas_loss, reg_loss, rpn_loss, clas_ac
         VGG16D_histogram = tf.histogram_summary('activations/VGG16D', VGG16D_activations)
         clas_histogram = tf.histogram_summary('activations/clas', clas_activations)
 
-        return tf.merge_summary([learning_rate_summary, loss_clas_summary, loss_reg_summary, loss_rpn_summary, stat_accuracy_summary, stat_positive_percentage_summary, stat_positive_accuracy_summary, VGG16D_histogram, clas_histogram])
+        # Groups with their own interval (see SUMMARY_INTERVALS)
+        return {
+            'scalars': tf.merge_summary([learning_rate_summary, loss_clas_summary, loss_reg_summary, loss_rpn_summary, stat_accuracy_summary, stat_positive_percentage_summary, stat_positive_accuracy_summary]),
+            'histograms': tf.merge_summary([VGG16D_histogram, clas_histogram])
+        }
 
 def compute_test_stats(test_placeholders, confusion_matrix):
     print('Confusion matrix:\n{}'.format(confusion_matrix))
@@ -111,31 +145,52 @@ def create_test_summaries(test_placeholders):
 
         return tf.merge_summary([accuracy_summary, positive_recall_summary, negative_recall_summary, recall_summary, positive_precision_summary, negative_precision_summary,precision_summary, F_score_summary])
 
-def trainer(caltech, input_placeholder, clas_placeholder, reg_placeholder):
-    # Shared CNN
+def build_inputs(caltech):
+    # Returns the input, classification & regression placeholders, and with a feature cache, the placeholder
+    # of images & activations at the cut point used to fill it (None otherwise)
+    input_placeholder = tf.placeholder(tf.uint8, [None, caltech.INPUT_SIZE[0], caltech.INPUT_SIZE[1], 3]) # 640x480 images, RGB (depth 3)
+    clas_placeholders = (tf.placeholder(tf.int32, [None]), tf.placeholder(tf.int32, [None])) # Indices of examples in all anchors of the minibatch, and their labels (0 for negative, 1 for positive)
+    reg_placeholders = (tf.placeholder(tf.int32, [None]), tf.placeholder(tf.float32, [None, 4])) # Indices of positive examples, and their regression targets
+
+    image_placeholder = cached_features = None
+    if CaltechDataset.FEATURE_CACHE:
+        # The layers before the cut are only run to fill the cache, but stay in the graph so that checkpoints hold the whole model
+        image_placeholder = input_placeholder
+        _, cached_features = build_prefix(image_placeholder, CaltechDataset.FEATURE_CACHE)
+        input_placeholder = tf.placeholder(tf.float16, [None] + VGG16D.get_shape(caltech.INPUT_SIZE, CaltechDataset.FEATURE_CACHE)) # Cached activations
+
+    return input_placeholder, clas_placeholders, reg_placeholders, image_placeholder, cached_features
+
+def trainer(caltech, input_placeholder, clas_placeholders, reg_placeholders, head = None):
+    # Shared CNN, from the images or from cached activations at CaltechDataset.FEATURE_CACHE (see feature_cache.py)
     input_data = tf.cast(input_placeholder, tf.float32)
 
     vgg = VGG16D()
-    shared_cnn = vgg.build(input_data)
+    shared_cnn = vgg.build(input_data, start = CaltechDataset.FEATURE_CACHE or 'input')
 
     # RPN
-    clas_rpn, reg_rpn = RPN(shared_cnn, caltech.anchors.num)
+    clas_rpn, reg_rpn = RPN(shared_cnn, caltech.anchors.num, head = head)
     clas_rpn = tf.reshape(clas_rpn, [-1, 2]) # Reshape to a big list
     reg_rpn = tf.reshape(reg_rpn, [-1, 4]) # Reshape to a big list
 
+    # Labels are fed sparsely (see CaltechDataset.build_minibatch), so scatter them as big lists over all anchors
+    num_anchors = tf.shape(clas_rpn)[0]
+    clas_indices, clas_labels = clas_placeholders
+    reg_indices, reg_targets = reg_placeholders
+
     # Get classification truth, to be used to learn the regression only on positive examples
-    clas_truth = tf.reshape(tf.cast(clas_placeholder, tf.float32), [-1, 2]) # Reshape to a big list
+    clas_truth = tf.unsorted_segment_sum(tf.one_hot(clas_labels, 2, dtype = tf.float32), clas_indices, num_anchors)
     clas_examples = tf.reduce_sum(clas_truth, reduction_indices = 1) # All examples (positive or negative, but not unknown) set to 1.0
     clas_positive_examples = tf.squeeze(tf.slice(clas_truth, [0, 1], [-1, 1])) # Only positive examples set to 1.0
 
     # Get regression truth
-    reg_truth = tf.reshape(tf.cast(reg_placeholder, tf.float32), [-1, 4]) # Reshape to a big list
+    reg_truth = tf.unsorted_segment_sum(reg_targets, reg_indices, num_anchors)
 
     # Declare loss functions
     clas_loss = tf.nn.softmax_cross_entropy_with_logits(clas_rpn, clas_truth)
     clas_positive_weight = tf.Variable(CaltechDataset.CLAS_POSITIVE_WEIGHT, trainable = False, name = 'clas_positive_weight')
     clas_loss = tf.reduce_sum((tf.mul(clas_loss, clas_examples) + (clas_positive_weight - 1.0) * tf.mul(clas_loss, clas_positive_examples)) / clas_positive_weight)
-    clas_loss = tf.div(clas_loss, tf.reduce_sum(clas_examples)) # Normalization
+    clas_loss = tf.div(clas_loss, tf.reduce_sum(clas_examples)) # Normalization, by the number of examples in all images of the minibatch
 
     reg_loss = tf.abs(tf.sub(reg_rpn, reg_truth))
     # # This is Smooth L1 as defined in http://www.cv-foundation.org/openaccess/content_iccv_2015/papers/Girshick_Fast_R-CNN_ICCV_2015_paper.pdf
@@ -143,7 +198,7 @@ def trainer(caltech, input_placeholder, clas_placeholder, reg_placeholder):
     # # |x| - 0.5 otherwise
     reg_loss = tf.select(tf.less(reg_loss, 1), tf.mul(tf.square(reg_loss), 0.5), tf.sub(reg_loss, 0.5))
     reg_loss = tf.reduce_sum(reg_loss, reduction_indices = 1)
-    reg_loss = tf.reduce_mean(tf.mul(reg_loss, clas_positive_examples))
+    reg_loss = tf.reduce_mean(tf.mul(reg_loss, clas_positive_examples)) # Normalization, by the number of anchors in all images of the minibatch
     lambda_ = tf.Variable(CaltechDataset.LOSS_LAMBDA, trainable = False, name = 'lambda') # Roughly reg_loss & clas_loss are equal, because 100.0 ~ 6000 (num total anchors) / 64 (minibatch size)
     reg_loss = tf.mul(reg_loss, lambda_) # Scaling
 
@@ -160,10 +215,11 @@ def trainer(caltech, input_placeholder, clas_placeholder, reg_placeholder):
     clas_positive_accuracy = tf.div(tf.reduce_sum(tf.mul(clas_comparison, clas_positive_examples)), tf.reduce_sum(clas_positive_examples))
 
     global_step = tf.Variable(0, trainable = False, name = 'global_step')
+    steps_per_epoch = int(ceil(float(len(caltech.training)) / float(CaltechDataset.IMAGES_PER_STEP)))
     learning_rate = tf.train.exponential_decay(
         0.001,                  # Base learning rate.
         global_step,            # Current index into the dataset.
-        len(caltech.training),  # Decay step.
+        steps_per_epoch,        # Decay step.
         0.95,                   # Decay rate.
         staircase = True)
 
@@ -196,12 +252,13 @@ if __name__ == '__main__':
     caltech = CaltechDataset()
 
     ### Declare input & output ###
-    input_placeholder = tf.placeholder(tf.uint8, [None, caltech.INPUT_SIZE[0], caltech.INPUT_SIZE[1], 3]) # 640x480 images, RGB (depth 3)
-    clas_placeholder = tf.placeholder(tf.uint8, [None, caltech.OUTPUT_SIZE[0], caltech.OUTPUT_SIZE[1], caltech.anchors.num, 2])
-    reg_placeholder = tf.placeholder(tf.uint8, [None, caltech.OUTPUT_SIZE[0], caltech.OUTPUT_SIZE[1], caltech.anchors.num, 4])
+    input_placeholder, clas_placeholders, reg_placeholders, image_placeholder, cached_features = build_inputs(caltech)
+
+    vgg_restore_path = 'vgg16/VGG16D.ckpt'
+    full_restore_path = None # '2016-09-13-64minibatch-1posratio-norelu-withreg-4000training-cropped-undesirables-mul2reg/model.14.ckpt'
 
     ### Creating the trainer ###
-    global_step, learning_rate, train_step, train_summaries, test_steps, vgg = trainer(caltech, input_placeholder, clas_placeholder, reg_placeholder)
+    global_step, learning_rate, train_step, train_summaries, test_steps, vgg = trainer(caltech, input_placeholder, clas_placeholders, reg_placeholders, head = load_head(full_restore_path))
 
     ### Creating test summaries ###
     test_placeholders = [tf.placeholder(tf.float32) for i in range(8)]
@@ -215,9 +272,6 @@ if __name__ == '__main__':
         # Initialize variables
         tf.initialize_all_variables().run()
 
-        vgg_restore_path = 'vgg16/VGG16D.ckpt'
-        full_restore_path = None # '2016-09-13-64minibatch-1posratio-norelu-withreg-4000training-cropped-undesirables-mul2reg/model.14.ckpt'
-
         if full_restore_path:
             # Restore variables from disk.
             full_saver.restore(sess, full_restore_path)
@@ -227,6 +281,9 @@ if __name__ == '__main__':
             vgg_saver.restore(sess, vgg_restore_path)
             print('VGG model restored from: {}.'.format(vgg_restore_path))
 
+        if CaltechDataset.FEATURE_CACHE:
+            build_feature_cache(sess, caltech, image_placeholder, cached_features)
+
         # Start summary writers
         train_writer = tf.train.SummaryWriter('log/train', sess.graph, flush_secs = 10)
         valid_writer = tf.train.SummaryWriter('log/valid', flush_secs = 10)
@@ -237,59 +294,99 @@ if __name__ == '__main__':
             last_epoch = 0
             confusion_matrix = np.zeros((2, 2), dtype = np.int64) # Truth as rows, guess as columns
             print('#### EPOCH {:02d} ####'.format(last_epoch))
-            while caltech.epoch < CaltechDataset.MAX_EPOCHS:
-                results = sess.run([train_step, train_summaries] + test_steps, feed_dict = caltech.get_training_minibatch(input_placeholder, clas_placeholder, reg_placeholder))
-                train_writer.add_summary(results[1], global_step = tf.train.global_step(sess, global_step))
-
-                confusion_matrix = accumulate_confusion_matrix(confusion_matrix, results[2], results[3], results[4])
-
-                if caltech.epoch != last_epoch:
-                    last_epoch = caltech.epoch
-
-                    # Write training evaluation
-                    results = sess.run(test_summaries, feed_dict = compute_test_stats(test_placeholders, confusion_matrix))
-                    train_writer.add_summary(results, global_step = tf.train.global_step(sess, global_step))
-
-                    # Do one pass of the whole validation set
-                    print('Validating...')
-                    confusion_matrix = np.zeros((2, 2), dtype = np.int64)
-                    last_frame = False
-                    while not last_frame:
-                        feed_dict, last_frame = caltech.get_validation_minibatch(input_placeholder, clas_placeholder, reg_placeholder)
-                        results = sess.run(test_steps, feed_dict = feed_dict)
-
-                        confusion_matrix = accumulate_confusion_matrix(confusion_matrix, results[0], results[1], results[2])
-
-                    results = sess.run(test_summaries, feed_dict = compute_test_stats(test_placeholders, confusion_matrix))
-                    valid_writer.add_summary(results, global_step = tf.train.global_step(sess, global_step))
-
-                    # Reset for training accumulation
-                    confusion_matrix = np.zeros((2, 2), dtype = np.int64)
-
-                    # Save the model to disk
-                    save_path = full_saver.save(sess, 'model.{}.ckpt'.format(caltech.epoch - 1))
-                    print('Model saved: {}'.format(save_path))
-
-                    if caltech.epoch != CaltechDataset.MAX_EPOCHS:
-                        print('#### EPOCH {:02d} ####'.format(last_epoch))
+            # Minibatches are prepared in a background thread, so caltech.epoch may be ahead: use the epoch given with each minibatch
+            training_minibatches = Prefetcher(caltech.training_minibatches(input_placeholder, clas_placeholders, reg_placeholders), CaltechDataset.PREFETCH_DEPTH)
+            profiler = StageProfiler('training', CaltechDataset.PROFILE_INTERVAL, train_writer, CaltechDataset.TRACE_STEPS)
+            summary_scheduler = SummaryScheduler(train_writer, train_summaries, CaltechDataset.SUMMARY_INTERVALS)
+            step = tf.train.global_step(sess, global_step)
+            try:
+                for feed_dict, epoch in profiler.iterate(training_minibatches, 'minibatch'):
+                    step += 1 # Global step once train_step is run
+                    results = profiler.run(sess, [train_step] + test_steps + summary_scheduler.fetches(step), feed_dict)
+                    with profiler.stage('summaries'):
+                        summary_scheduler.write(step, results[1 + len(test_steps):])
+
+                    with profiler.stage('confusion_matrix'):
+                        confusion_matrix = accumulate_confusion_matrix(confusion_matrix, results[1], results[2], results[3])
+
+                    if epoch != last_epoch:
+                        last_epoch = epoch
+                        print(training_minibatches.stats())
+
+                        # Write training evaluation
+                        with profiler.stage('summaries'):
+                            results = sess.run(test_summaries, feed_dict = compute_test_stats(test_placeholders, confusion_matrix))
+                            train_writer.add_summary(results, global_step = step)
+
+                        # Do one pass of the whole validation set
+                        print('Validating...')
+                        # The training minibatches are paused meanwhile, as both would use caltech from their own thread
+                        with profiler.stage('validation'), training_minibatches.paused():
+                            confusion_matrix = np.zeros((2, 2), dtype = np.int64)
+                            validation_profiler = StageProfiler('validation', CaltechDataset.PROFILE_INTERVAL, valid_writer)
+                            validation_minibatches = Prefetcher(caltech.validation_minibatches(input_placeholder, clas_placeholders, reg_placeholders), CaltechDataset.PREFETCH_DEPTH)
+                            try:
+                                for feed_dict in validation_profiler.iterate(validation_minibatches, 'minibatch'):
+                                    results = validation_profiler.run(sess, test_steps, feed_dict)
+
+                                    with validation_profiler.stage('confusion_matrix'):
+                                        confusion_matrix = accumulate_confusion_matrix(confusion_matrix, results[0], results[1], results[2])
+                                    validation_profiler.step(step)
+                            finally:
+                                validation_minibatches.close()
+                            validation_profiler.report(step)
+
+                            results = sess.run(test_summaries, feed_dict = compute_test_stats(test_placeholders, confusion_matrix))
+                            valid_writer.add_summary(results, global_step = step)
+
+                        # Reset for training accumulation
+                        confusion_matrix = np.zeros((2, 2), dtype = np.int64)
+
+                        # Save the model to disk
+                        with profiler.stage('checkpoint'):
+                            save_path = full_saver.save(sess, 'model.{}.ckpt'.format(epoch - 1))
+                        print('Model saved: {}'.format(save_path))
+
+                        if epoch != CaltechDataset.MAX_EPOCHS:
+                            print('#### EPOCH {:02d} ####'.format(last_epoch))
+
+                    profiler.step(step)
+            finally:
+                training_minibatches.close()
+
+            summary_scheduler.close()
 
         # Do one pass of the whole testing set
         print('Testing...')
         confusion_matrix = np.zeros((2, 2), dtype = np.int64)
-        last_frame = False
-        global_matched_scores = np.zeros([0])
-        global_default = np.array([0, 0])
-
-        while not last_frame:
-            feed_dict, minibatch_used, last_frame = caltech.get_testing_minibatch(input_placeholder, clas_placeholder, reg_placeholder)
-            results = sess.run(test_steps, feed_dict = feed_dict)
-
-            confusion_matrix = accumulate_confusion_matrix(confusion_matrix, results[0], results[1], results[2])
-
-            if CaltechDataset.TESTING_SIZE == -1: # Save results only when doing full testing
-                clas_guess, guess_pos, guess_scores = caltech.parse_results(results[2], results[3], results[4])
-                final_pos, final_scores = caltech.NMS(guess_pos, guess_scores)
-                caltech.save_results(minibatch_used[0], minibatch_used[1], minibatch_used[2], final_pos, final_scores, original_image = True)
+        evaluator = MissRateAccumulator() # Miss rate vs FPPI, frame by frame
+
+        profiler = StageProfiler('testing', CaltechDataset.PROFILE_INTERVAL, test_writer)
+        testing_minibatches = Prefetcher(caltech.testing_minibatches(input_placeholder, clas_placeholders, reg_placeholders), CaltechDataset.PREFETCH_DEPTH)
+        try:
+            for feed_dict, minibatches_used in profiler.iterate(testing_minibatches, 'minibatch'):
+                results = profiler.run(sess, test_steps, feed_dict)
+
+                with profiler.stage('confusion_matrix'):
+                    confusion_matrix = accumulate_confusion_matrix(confusion_matrix, results[0], results[1], results[2])
+
+                with profiler.stage('NMS'):
+                    clas_guess, guess_pos, guess_scores, guess_frames = caltech.parse_batch_results(results[2], results[3], results[4])
+                    final_pos, final_scores, final_frames = caltech.NMS(guess_pos, guess_scores, guess_frames)
+                with profiler.stage('evaluation'):
+                    for i, minibatch_used in enumerate(minibatches_used):
+                        evaluator.add_frame(caltech, minibatch_used, final_pos[final_frames == i], final_scores[final_frames == i], original_image = True)
+                        if CaltechDataset.TESTING_SIZE == -1: # Save results only when doing full testing
+                            caltech.save_results(minibatch_used[0], minibatch_used[1], minibatch_used[2], final_pos[final_frames == i], final_scores[final_frames == i], original_image = True)
+                profiler.step()
+        finally:
+            testing_minibatches.close()
+        profiler.report()
+
+        caltech.close_results() # Results left are written (export them for the Caltech evaluation code with results.py)
 
         results = sess.run(test_summaries, feed_dict = compute_test_stats(test_placeholders, confusion_matrix))
         test_writer.add_summary(results, global_step = tf.train.global_step(sess, global_step))
+
+        print(evaluator.summary())
+        evaluator.save('log/test/mr-fppi.npz')
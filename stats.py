@@ -1,34 +1,33 @@
 #!/usr/bin/env python
 
-import os
+import sys
 from math import ceil
 
-def statsSeq(folder):
-    images = [f for f in os.listdir(folder) if os.path.isfile(folder + '/' + f)]
+sys.path.append('caltech-dataset')
+from caltech import CaltechDataset
 
-    numImages = len(images)
+def statsSeq(manifest, set_number, seq_number):
+    numImages = manifest.num_frames(set_number, seq_number)
     numImages1FPS = int(ceil(numImages / 30.0))
 
     return numImages, numImages1FPS
 
-def statsSet(folder):
-    sequences = [f for f in os.listdir(folder) if os.path.isdir(folder + '/' + f)]
-
+def statsSet(manifest, set_number):
     numImages = 0
     numImages1FPS = 0
-    for seq in sequences:
-        (a, b) = statsSeq(folder + '/' + seq)
+    for seq_number in manifest.get_sequence_numbers(set_number):
+        (a, b) = statsSeq(manifest, set_number, seq_number)
         numImages += a
         numImages1FPS += b
 
     return numImages, numImages1FPS
 
-def statsTrainset(folder):
+def statsTrainset(manifest):
     numImages = 0
     numImages1FPS = 0
 
     for s in range(0, 6):
-        (a, b) = statsSet(folder + '/set{:02d}'.format(s))
+        (a, b) = statsSet(manifest, s)
         numImages += a
         numImages1FPS += b
 
@@ -36,12 +35,12 @@ def statsTrainset(folder):
     print('Total images: {}'.format(numImages))
     print('Total images (@ 1FPS): {}'.format(numImages1FPS))
 
-def statsTestset(folder):
+def statsTestset(manifest):
     numImages = 0
     numImages1FPS = 0
 
     for s in range(6, 11):
-        (a, b) = statsSet(folder + '/set{:02d}'.format(s))
+        (a, b) = statsSet(manifest, s)
         numImages += a
         numImages1FPS += b
 
@@ -50,5 +49,7 @@ def statsTestset(folder):
     print('Total images (@ 1FPS): {}'.format(numImages1FPS))
 
 if __name__ == '__main__':
-    statsTrainset('caltech-dataset/images')
-    statsTestset('caltech-dataset/images')
+    # Same manifest as CaltechDataset (images or .seq videos), only built if they changed
+    manifest = CaltechDataset().get_manifest()
+    statsTrainset(manifest)
+    statsTestset(manifest)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import threading
+
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+# Training summaries split in groups (scalars, histograms...), each computed every so many steps: only the groups
+# due at a step are added to its fetches, so expensive summaries (histograms over the VGG16D activations) are not
+# computed at every step. Summaries fetched are written by a background thread, out of the training loop.
+class SummaryScheduler:
+    def __init__(self, writer, summaries, intervals):
+        self.writer = writer
+        self.summaries = summaries # Group name -> summary op
+        self.intervals = intervals # Group name -> number of steps between two summaries
+        self.error = None
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self.write_summaries)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def due(self, step): # Names of the groups to compute at a step
+        return [name for name in sorted(self.summaries) if step % self.intervals[name] == 0]
+
+    def fetches(self, step):
+        return [self.summaries[name] for name in self.due(step)]
+
+    def write(self, step, results): # Results of the fetches of a step, as serialized summaries
+        if results:
+            self.queue.put((step, results))
+
+    def write_summaries(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+
+            step, results = task
+            try:
+                for summary in results:
+                    self.writer.add_summary(summary, global_step = step)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
@@ -1,3 +1,5 @@
+from math import ceil
+
 import tensorflow as tf
 
 # Implementing CNN part of VGG based on http://arxiv.org/pdf/1409.1556v6.pdf
@@ -28,76 +30,72 @@ class VGG16:
 
 # Model D (16 layers)
 class VGG16D(VGG16):
-    def get_all_variables(self):
+    # Weights shapes of each layer
+    LAYER_SHAPES = [[3, 3, 3, 64], [3, 3, 64, 64],
+                    [3, 3, 64, 128], [3, 3, 128, 128],
+                    [3, 3, 128, 256], [3, 3, 256, 256], [3, 3, 256, 256],
+                    [3, 3, 256, 512], [3, 3, 512, 512], [3, 3, 512, 512],
+                    [3, 3, 512, 512], [3, 3, 512, 512], [3, 3, 512, 512]]
+
+    # Points where the network can be cut, with the number of layers before them,
+    # & the downscaling & depth of their activations
+    CUT_POINTS = {
+        'input': (0, 1, 3),
+        'm4_5': (4, 4, 128), # After the layers that are not trainable
+        'l13': (13, 16, 512) # Output
+    }
+
+    @staticmethod
+    def get_shape(input_size, cut_point): # Shape of the activations at a cut point, as [height, width, depth]
+        num_layers, downscaling, depth = VGG16D.CUT_POINTS[cut_point]
+        return [int(ceil(float(input_size[0]) / downscaling)), int(ceil(float(input_size[1]) / downscaling)), depth]
+
+    def get_all_variables(self, start = 'input', end = 'l13'): # Variables of the layers between two cut points
         variables = []
         with tf.variable_scope('VGG16D', reuse = True):
-            with tf.variable_scope('layer1'):
-                variables.append(get_weights([3, 3, 3, 64]))
-                variables.append(get_biases([64]))
-            with tf.variable_scope('layer2'):
-                variables.append(get_weights([3, 3, 64, 64]))
-                variables.append(get_biases([64]))
-            with tf.variable_scope('layer3'):
-                variables.append(get_weights([3, 3, 64, 128]))
-                variables.append(get_biases([128]))
-            with tf.variable_scope('layer4'):
-                variables.append(get_weights([3, 3, 128, 128]))
-                variables.append(get_biases([128]))
-            with tf.variable_scope('layer5'):
-                variables.append(get_weights([3, 3, 128, 256]))
-                variables.append(get_biases([256]))
-            with tf.variable_scope('layer6'):
-                variables.append(get_weights([3, 3, 256, 256]))
-                variables.append(get_biases([256]))
-            with tf.variable_scope('layer7'):
-                variables.append(get_weights([3, 3, 256, 256]))
-                variables.append(get_biases([256]))
-            with tf.variable_scope('layer8'):
-                variables.append(get_weights([3, 3, 256, 512]))
-                variables.append(get_biases([512]))
-            with tf.variable_scope('layer9'):
-                variables.append(get_weights([3, 3, 512, 512]))
-                variables.append(get_biases([512]))
-            with tf.variable_scope('layer10'):
-                variables.append(get_weights([3, 3, 512, 512]))
-                variables.append(get_biases([512]))
-            with tf.variable_scope('layer11'):
-                variables.append(get_weights([3, 3, 512, 512]))
-                variables.append(get_biases([512]))
-            with tf.variable_scope('layer12'):
-                variables.append(get_weights([3, 3, 512, 512]))
-                variables.append(get_biases([512]))
-            with tf.variable_scope('layer13'):
-                variables.append(get_weights([3, 3, 512, 512]))
-                variables.append(get_biases([512]))
+            for layer_id in range(VGG16D.CUT_POINTS[start][0] + 1, VGG16D.CUT_POINTS[end][0] + 1):
+                with tf.variable_scope('layer{}'.format(layer_id)):
+                    shape = VGG16D.LAYER_SHAPES[layer_id - 1]
+                    variables.append(get_weights(shape))
+                    variables.append(get_biases(shape[3:]))
 
         return variables
 
-    def build(self, X):
-        input_data = tf.sub(X, VGG16.VGG_MEAN)
+    def build(self, X, start = 'input', end = 'l13'):
+        # Builds the layers between two cut points (see CUT_POINTS), X being the input images or the activations at start
+        # Variables keep the same scopes whatever the cut points, so checkpoints of the whole network still apply
+        if VGG16D.CUT_POINTS[start][0] >= VGG16D.CUT_POINTS[end][0]:
+            return X
 
         with tf.variable_scope('VGG16D'):
-            # First, two conv3-64
-            with tf.variable_scope('layer1'): # Layer 1, 3x3 depth 64
-                l1 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(input_data, get_weights([3, 3, 3, 64]), strides = [1, 1, 1, 1], padding = 'SAME'),
-                                get_biases([64])))
-            with tf.variable_scope('layer2'): # Layer 2, 3x3 depth 64
-                l2 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(l1, get_weights([3, 3, 64, 64]), strides = [1, 1, 1, 1], padding = 'SAME'),
-                                get_biases([64])))
-
-            # Maxpooling
-            m2_3 = tf.nn.max_pool(l2, ksize = [1, 2, 2, 1], strides = [1, 2, 2, 1], padding = 'SAME')
-
-            # Second, two conv3-128
-            with tf.variable_scope('layer3'): # Layer 3, 3x3 depth 128
-                l3 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(m2_3, get_weights([3, 3, 64, 128]), strides = [1, 1, 1, 1], padding = 'SAME'),
-                                get_biases([128])))
-            with tf.variable_scope('layer4'): # Layer 4, 3x3 depth 128
-                l4 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(l3, get_weights([3, 3, 128, 128]), strides = [1, 1, 1, 1], padding = 'SAME'),
-                                get_biases([128])))
-
-            # Maxpooling
-            m4_5 = tf.nn.max_pool(l4, ksize = [1, 2, 2, 1], strides = [1, 2, 2, 1], padding = 'SAME')
+            if start == 'input':
+                input_data = tf.sub(X, VGG16.VGG_MEAN)
+
+                # First, two conv3-64
+                with tf.variable_scope('layer1'): # Layer 1, 3x3 depth 64
+                    l1 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(input_data, get_weights([3, 3, 3, 64]), strides = [1, 1, 1, 1], padding = 'SAME'),
+                                    get_biases([64])))
+                with tf.variable_scope('layer2'): # Layer 2, 3x3 depth 64
+                    l2 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(l1, get_weights([3, 3, 64, 64]), strides = [1, 1, 1, 1], padding = 'SAME'),
+                                    get_biases([64])))
+
+                # Maxpooling
+                m2_3 = tf.nn.max_pool(l2, ksize = [1, 2, 2, 1], strides = [1, 2, 2, 1], padding = 'SAME')
+
+                # Second, two conv3-128
+                with tf.variable_scope('layer3'): # Layer 3, 3x3 depth 128
+                    l3 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(m2_3, get_weights([3, 3, 64, 128]), strides = [1, 1, 1, 1], padding = 'SAME'),
+                                    get_biases([128])))
+                with tf.variable_scope('layer4'): # Layer 4, 3x3 depth 128
+                    l4 = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(l3, get_weights([3, 3, 128, 128]), strides = [1, 1, 1, 1], padding = 'SAME'),
+                                    get_biases([128])))
+
+                # Maxpooling
+                m4_5 = tf.nn.max_pool(l4, ksize = [1, 2, 2, 1], strides = [1, 2, 2, 1], padding = 'SAME')
+                if end == 'm4_5':
+                    return m4_5
+            else:
+                m4_5 = X
 
             # Third, three conv3-256
             with tf.variable_scope('layer5'): # Layer 5, 3x3 depth 256